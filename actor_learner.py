@@ -0,0 +1,219 @@
+import os
+import copy
+import time
+import queue
+import random
+from collections import deque
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from coolname import generate_slug
+from torch.utils.tensorboard import SummaryWriter
+from util import get_graph_json, create_graph, output_json
+from preproc import PreInput
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from ppo_discrete import PPO, RolloutPolicy, actor_critic
+from profiler import PhaseTimer
+from train import get_args, run_episode, warm_start
+
+TRAJECTORY_FIELDS = ['states', 'actions', 'logprobs', 'rewards', 'is_terminals', 'masks', 'node_ids']
+
+def _put(trajectories, trajectory, stop):
+    '''
+    blocking put that gives up once the learner is done
+    '''
+    while not stop.is_set():
+        try:
+            trajectories.put(trajectory, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _get(trajectories, actors, timeout=1.0):
+    '''
+    blocking get that fails once no actor is left to produce an episode
+    '''
+    while True:
+        try:
+            return trajectories.get(timeout=timeout)
+        except queue.Empty:
+            if not any(actor.is_alive() for actor in actors):
+                raise RuntimeError(f'All actors exited, exit codes {[actor.exitcode for actor in actors]}')
+
+def _actor(rank, args, graphs, shared_policy, version, trajectories, stop):
+    '''
+    run episodes with a copy of the shared policy, refreshed whenever the learner publishes new weights,
+    and stream them to the learner
+    '''
+    torch.set_num_threads(1)
+    torch.manual_seed(rank + 1)
+    random.seed(rank + 1)
+    np.random.seed(rank + 1)
+    device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+    env = StreamingEngineEnv(args,
+                             graphdef = graphs[0],
+                             tile_count = args.device_topology[0],
+                             spoke_count = args.device_topology[1],
+                             pipeline_depth = args.pipeline_depth)
+    policy = RolloutPolicy(actor_critic(args, graphs[0], device, env.observation_space.n))
+    policy_version = -1
+    reward_buf = deque(maxlen=100)
+    while not stop.is_set():
+        if version.value != policy_version:
+            with version.get_lock():
+                policy.policy_old.load_state_dict(shared_policy.state_dict())
+                policy_version = version.value
+
+        graph_idx = random.randrange(len(graphs))
+        if len(graphs) > 1:
+            env.set_graph(graphs[graph_idx])
+        total_reward, placed_nodes, ready_time = run_episode(args, env, policy, graphs[graph_idx], reward_buf)
+
+        buffer = policy.buffer
+        trajectory = {'actor': rank, 'version': policy_version, 'graph_idx': graph_idx,
+                      'total_reward': total_reward, 'placed_nodes': placed_nodes, 'ready_time': ready_time,
+                      'nodes_placed': len(env.placed_nodes)}
+        for name in TRAJECTORY_FIELDS:
+            trajectory[name] = getattr(buffer, name).cpu().numpy()
+        buffer.clear()
+        _put(trajectories, trajectory, stop)
+
+def run_actor_learner(args, graphs, writer=None):
+    '''
+    PPO with args.actors rollout processes collecting episodes while the learner updates
+
+    Actors send episodes over a bounded queue together with the version of the policy that collected them.
+    The learner trains on episodes at most args.max_policy_lag updates old (PPO clipping corrects for the
+    remaining lag, the logprobs are those of the collecting policy) and publishes its weights to a policy
+    in shared memory after every update.
+    return: best graph ready time, mean reward when it was found
+    '''
+    args.device_topology = tuple(args.device_topology)
+    print(args)
+
+    # Tensorboard logging
+    if writer is None:
+        writer = SummaryWriter(comment=f'_{generate_slug(2)}')
+        print(f'[INFO] Saving log data to {writer.log_dir}')
+        writer.add_text('experiment config', str(args))
+        writer.flush()
+
+    graphs = graphs if isinstance(graphs, list) else [graphs]
+    args.nodes = graphs[0]['graph'].number_of_nodes()
+
+    # SE Device attributes
+    device = {}
+    device['topology'] = args.device_topology
+    device['action_dim'] = np.prod(args.device_topology)
+
+    preproc = PreInput(args)
+    graphs = [preproc.pre_graph(graphdef, device) for graphdef in graphs]
+
+    # Learner and the weights it publishes to the actors
+    ppo = PPO(args,
+              graphdef = graphs[0],
+              device = device,
+              state_dim = int(device['action_dim']))
+    if args.warm_start:
+        warm_start(args, ppo, graphs)
+    shared_policy = copy.deepcopy(ppo.policy_old).cpu().share_memory()
+
+    ctx = mp.get_context('spawn')
+    version = ctx.Value('i', 0)
+    trajectories = ctx.Queue(maxsize=2 * args.actors)
+    stop = ctx.Event()
+    actors = [ctx.Process(target=_actor,
+                          args=(rank, args, graphs, shared_policy, version, trajectories, stop),
+                          daemon=True)
+              for rank in range(args.actors)]
+    for actor in actors:
+        actor.start()
+
+    # Setup logging variables
+    reward_buf = deque(maxlen=100)
+    reward_buf.append(0)
+    start = time.time()
+    best_ready_time = float('inf')
+    best_reward = 0
+    policy_version = 0
+    accepted = 0
+    stale = 0
+    timer = PhaseTimer(enabled=args.profile)
+
+    # Every episode is checked for a better mapping, only the recent enough ones are trained on
+    for i_episode in range(1, args.epochs + 1):
+        with timer.phase('wait_episode'):
+            trajectory = _get(trajectories, actors)
+        reward_buf.extend(trajectory['rewards'])
+        lag = policy_version - trajectory['version']
+
+        if not args.quiet:
+            writer.add_scalar('No. of nodes placed', trajectory['nodes_placed'], i_episode)
+            writer.add_scalar('Policy lag', lag, i_episode)
+
+        placed_nodes, ready_time = trajectory['placed_nodes'], trajectory['ready_time']
+        if placed_nodes is not None and ready_time < best_ready_time:
+            best_ready_time = ready_time
+            best_reward = np.mean(reward_buf)
+            if not args.quiet:
+                print(f'\nEpisode {i_episode}: {placed_nodes}')
+                print(f'Best graph ready time yet: {best_ready_time}')
+                # Save mapping json
+                suffix = os.path.basename(args.input)
+                output_json(placed_nodes,
+                            no_of_tiles=args.device_topology[0],
+                            spoke_count=args.device_topology[1],
+                            out_file_name=f'mappings/mapping_{suffix}')
+
+        # learning:
+        if lag > args.max_policy_lag:
+            stale += 1
+        else:
+            with timer.phase('add_buffer'):
+                graph = ppo.device_graph(graphs[trajectory['graph_idx']]['graph'])
+                t = {name: torch.from_numpy(trajectory[name]) for name in TRAJECTORY_FIELDS}
+                ppo.buffer.add(t['states'], t['actions'], graph, t['logprobs'], t['masks'], t['node_ids'],
+                               t['rewards'], t['is_terminals'])
+            accepted += 1
+            if accepted % args.update_timestep == 0:
+                with timer.phase('update'):
+                    ppo.update()
+                with timer.phase('publish'):
+                    with version.get_lock():
+                        shared_policy.load_state_dict(ppo.policy.state_dict())
+                        version.value += 1
+                policy_version += 1
+
+        # logging
+        if i_episode % args.log_interval == 0:
+            end = time.time()
+            print(f'\rEpisode: {i_episode} | best time {best_ready_time} | Total reward: {trajectory["total_reward"]} | Mean Reward: {np.mean(reward_buf):.2f} | Nodes placed: {trajectory["nodes_placed"]} | Policy version: {policy_version} | Stale: {stale} | Time elpased: {end - start:.2f}s', end='')
+            if not args.quiet:
+                writer.add_scalar('Mean reward/episode', np.mean(reward_buf), i_episode)
+                writer.add_scalar('Stale episodes', stale, i_episode)
+                timer.log(writer, i_episode)
+                writer.flush()
+                torch.save(ppo.policy.state_dict(), 'model_epoch.pth')
+
+    # Actors exit once they see stop, the queue is drained so none blocks on its feeder thread
+    stop.set()
+    while any(actor.is_alive() for actor in actors):
+        try:
+            trajectories.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    for actor in actors:
+        actor.join()
+
+    if args.profile:
+        profile_dir = f'{writer.log_dir}_profile'
+        os.makedirs(profile_dir, exist_ok=True)
+        timer.save(os.path.join(profile_dir, 'profile.json'))
+    return best_ready_time, best_reward
+
+if __name__ == "__main__":
+    args = get_args()  # Holds all the input arguments
+    graph_json = get_graph_json(args.input)# Get computation graph definition
+    graphdef = create_graph(graph_json)
+    run_actor_learner(args, graphdef)
@@ -0,0 +1,222 @@
+import os
+import glob
+import json
+import time
+import random
+import argparse
+from collections import deque
+import numpy as np
+import torch
+from util import get_graph_json, create_graph, get_nodes_rand
+from preproc import PreInput
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from envs.evaluate import evaluate_placements
+from ppo_discrete import PPO
+from decode import load_policy, quantize_policy, greedy_decode
+from profiler import PhaseTimer
+from greedy import greedy_placement
+import train
+
+BENCHMARKS = ['env', 'ppo', 'sa', 'es', 'quant', 'greedy']
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Streaming Engine mapper benchmarks')
+    arg = parser.add_argument
+
+    arg('--device-topology', nargs='+', type=int, default=(16, 6), help='Device topology of Streaming Engine')
+    arg('--pipeline-depth', type=int, default=3, help='processing pipeline depth')
+    arg('--inputs', type=str, default='input_graphs/*.json', help='glob of input json graphs to benchmark')
+    arg('--synthetic-nodes', nargs='+', type=int, default=[10, 25, 50, 100, 200], help='sizes of synthetic graphs to benchmark')
+    arg('--synthetic-graphs', type=int, default=2, help='number of synthetic graphs per size')
+    arg('--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS, help='benchmarks to run')
+    arg('--episodes', type=int, default=50, help='random episodes per graph for the env benchmark')
+    arg('--ppo-episodes', type=int, default=10, help='policy episodes per graph collected before timing PPO.update')
+    arg('--nnmode', type=str, default='ff_gnn_attention', help='actor/critic model used by the ppo and quant benchmarks')
+    arg('--sa-rollouts', type=int, default=50, help='random SA rollouts per graph')
+    arg('--es-candidates', type=int, default=4096, help='ES candidates scored per graph')
+    arg('--model', type=str, default='', help='checkpoint compared fp32 vs int8 by the quant benchmark, random weights if empty')
+    arg('--quant-repeats', type=int, default=5, help='timed greedy mappings per graph and precision')
+    arg('--output', type=str, default='benchmark.json', help='save results to json file')
+    arg('--compare', type=str, default='', help='json file of a previous run to compare against')
+
+    # Constraints
+    arg('--no-sibling-constr', action='store_true', help='disable sibling nodes constraint')
+    arg('--no-tm-constr', action='store_true', help='disable tile memory constraint')
+    arg('--no-sf-constr', action='store_true', help='disable sync flow constraint')
+    args = parser.parse_args()
+    args.device_topology = tuple(args.device_topology)
+    return args
+
+def load_graphs(args):
+    '''
+    return list of (name, graphdef) for the input graphs and the synthetic graphs
+    '''
+    graphs = []
+    for path in sorted(glob.glob(args.inputs)):
+        graphs.append((os.path.basename(path), create_graph(get_graph_json(path))))
+    for numnodes in args.synthetic_nodes:
+        for i in range(args.synthetic_graphs):
+            graphs.append((f'synthetic_{numnodes}_{i}', create_graph(None, numnodes=numnodes)))
+    return graphs
+
+def make_env(args, graphdef):
+    return StreamingEngineEnv(args,
+                              graphdef=graphdef,
+                              tile_count=args.device_topology[0],
+                              spoke_count=args.device_topology[1],
+                              pipeline_depth=args.pipeline_depth)
+
+def bench_env(args, graphdef):
+    '''
+    place nodes at random feasible slices and time every env.get_mask and env.step call
+    return: microseconds per mask, number of masks computed, env steps per second
+    '''
+    env = make_env(args, graphdef)
+    lnodes = env.plan.topo_order.tolist()
+    mask_time, masks, step_time, steps = 0., 0, 0., 0
+    for _ in range(args.episodes):
+        env.reset()
+        for node_id in lnodes:
+            start = time.perf_counter()
+            mask = env.get_mask(node_id)
+            mask_time += time.perf_counter() - start
+            masks += 1
+            if not mask.any():
+                break
+            tile, spoke = np.unravel_index(random.choice(np.flatnonzero(mask)), args.device_topology)
+            start = time.perf_counter()
+            env.step([node_id, tile, spoke])
+            step_time += time.perf_counter() - start
+            steps += 1
+    return {'mask_us': 1e6 * mask_time / masks, 'masks': masks, 'steps_per_s': steps / max(step_time, 1e-9)}
+
+def bench_ppo(args, graphdef):
+    '''
+    run policy episodes with the training loop of train.py, then time one PPO.update on the collected transitions
+    return: microseconds per select_action, seconds per update, number of transitions
+    '''
+    ppo_args = train.get_args([])
+    ppo_args.device_topology = args.device_topology
+    ppo_args.pipeline_depth = args.pipeline_depth
+    ppo_args.nnmode = args.nnmode
+    ppo_args.nodes = graphdef['graph'].num_nodes()
+    device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+    graphdef = PreInput(ppo_args).pre_graph(graphdef, device)
+    env = make_env(args, graphdef)
+    ppo = PPO(ppo_args, graphdef=graphdef, device=device, state_dim=env.observation_space.n)
+
+    timer = PhaseTimer()
+    reward_buf = deque(maxlen=100)
+    for _ in range(args.ppo_episodes):
+        train.run_episode(ppo_args, env, ppo, graphdef, reward_buf, timer)
+    transitions = len(ppo.buffer)
+    with timer.phase('update'):
+        ppo.update()
+    stats = timer.summary()['phases']
+    return {'select_action_us': stats['select_action']['mean_us'], 'update_s': stats['update']['total_s'],
+            'transitions': transitions}
+
+def bench_sa(args, graphdef):
+    '''
+    time random rollouts of get_nodes_rand from an empty placement, the candidates SA proposes
+    return: rollouts per second, fraction of rollouts placing every node
+    '''
+    env = make_env(args, graphdef)
+    device = {'action_dim': np.prod(args.device_topology)}
+    reward_buf = deque(maxlen=100)
+    feasible = 0
+    start = time.perf_counter()
+    for _ in range(args.sa_rollouts):
+        env.reset()
+        get_nodes_rand([], args, env, graphdef, device, reward_buf)
+        feasible += env.all_nodes_placed
+    elapsed = time.perf_counter() - start
+    return {'sa_rollouts_per_s': args.sa_rollouts / elapsed, 'sa_feasible': feasible / args.sa_rollouts}
+
+def bench_es(args, graphdef):
+    '''
+    score random ES candidates with evaluate_placements
+    return: candidates per second
+    '''
+    env = make_env(args, graphdef)
+    placements = np.random.randint(env.mask_engine.slice_count, size=(args.es_candidates, env.num_nodes))
+    start = time.perf_counter()
+    evaluate_placements(env.plan, placements, env.mask_engine)
+    elapsed = time.perf_counter() - start
+    return {'es_candidates_per_s': args.es_candidates / elapsed}
+
+def bench_quant(args, graphdef):
+    '''
+    greedy mapping with the fp32 policy and its dynamic int8 copy
+    return: graph ready time (inf if no complete placement) and median milliseconds per mapping of both,
+    nothing for graphs whose node features don't match --model
+    '''
+    policy_args = train.get_args([])
+    policy_args.device_topology = args.device_topology
+    policy_args.nnmode = args.nnmode
+    device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+    graphdef = PreInput(policy_args).pre_graph(graphdef, device)
+    torch.manual_seed(0)
+    try:
+        policy = load_policy(policy_args, graphdef, device, args.model)
+    except RuntimeError:
+        print(f'[INFO] quant: {args.model} does not match the node features of this graph, skipped')
+        return {}
+    graph = graphdef['graph']
+    env = make_env(args, graphdef)
+
+    result = {}
+    for name, model in [('fp32', policy), ('int8', quantize_policy(policy))]:
+        times = []
+        with torch.inference_mode():
+            for _ in range(args.quant_repeats):
+                model.invalidate_graph_cache()
+                start = time.perf_counter()
+                placed_nodes, ready_time = greedy_decode(model, env, graph)
+                times.append(time.perf_counter() - start)
+        result[f'{name}_ready_time'] = float(ready_time)
+        result[f'{name}_map_ms'] = 1e3 * float(np.median(times))
+    return result
+
+def bench_greedy(args, graphdef):
+    '''
+    time the critical path greedy mapper
+    return: mapping latency in ms, graph ready time (100 if it hits a dead end)
+    '''
+    env = make_env(args, graphdef)
+    start = time.perf_counter()
+    ready_time, _ = greedy_placement(env)
+    return {'greedy_ms': (time.perf_counter() - start) * 1e3, 'greedy_ready_time': ready_time}
+
+def compare(results, path):
+    '''
+    print the ratio new / old of every metric of the graphs found in both runs
+    '''
+    with open(path) as f:
+        old = {r['graph']: r for r in json.load(f)['results']}
+    print(f'\nRatio to {path}')
+    for result in results:
+        if result['graph'] not in old:
+            continue
+        ratios = [f'{k}={v / old[result["graph"]][k]:.2f}' for k, v in result.items()
+                  if k not in ('graph', 'nodes') and old[result['graph']].get(k)]
+        print(f'{result["graph"]:<28}' + ' '.join(ratios))
+
+if __name__ == "__main__":
+    args = get_args()
+    benchmarks = {'env': bench_env, 'ppo': bench_ppo, 'sa': bench_sa, 'es': bench_es, 'quant': bench_quant,
+                  'greedy': bench_greedy}
+    results = []
+    for name, graphdef in load_graphs(args):
+        result = {'graph': name, 'nodes': graphdef['graph'].num_nodes()}
+        for bench in args.benchmarks:
+            result.update(benchmarks[bench](args, graphdef))
+        print(' '.join(f'{k}={v:.3g}' if isinstance(v, float) else f'{k}={v}' for k, v in result.items()))
+        results.append(result)
+
+    with open(args.output, 'w') as f:
+        json.dump({'config': vars(args), 'torch': torch.__version__, 'results': results}, f, indent=2)
+    print(f'[INFO] Saved benchmark results to {args.output}')
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,178 @@
+import time
+import numpy as np
+from util import output_json
+
+class BranchAndBound:
+    """Depth-first branch and bound over the env placement order (topological order)
+
+    Every search node is an env snapshot. It branches on the slices of the env mask of the next node to
+    place, children with the smallest lower bound first, and prunes children that hit a dead end or whose
+    lower bound is not below the best complete placement found so far.
+
+    The lower bound follows the env ready time recurrence: a node is ready pipeline_depth cycles after its
+    last predecessor plus the tile hops between them. Unplaced roots take the smallest free spoke of their
+    domain, unplaced nodes the smallest hop distance their domain allows from a placed last predecessor
+    (0 if it is not placed yet), so the bound is the critical path through the last predecessors times
+    pipeline_depth plus the minimal hops, never above the ready time of a completion. Successors with a
+    single predecessor next to be placed look two steps ahead: the cheapest slice of their predecessor
+    plus the cheapest slice of theirs that passes the timing constraint from it, which catches the spoke
+    collisions of chains kept on one tile. With the sibling constraint the k nodes sharing a last
+    predecessor sit on k different tiles, one of them at least the k-th smallest hop away from it.
+
+    Hop distances and constraints only depend on tile differences, a placement mirrored over the tiles has
+    the same ready time, so the first node is only branched on the lower half of the tiles.
+    """
+    def __init__(self, env, incumbent=100, verbose=True):
+        self.env = env
+        self.plan = env.plan
+        self.verbose = verbose
+        self.order = env.plan.topo_order.tolist()
+        self.depth = env.se.pipeline_depth
+        self.spoke_count = env.se.spoke_count
+        mask_engine = env.mask_engine
+        self.slice_tile = mask_engine.slice_tile
+        self.slice_spoke = np.tile(np.arange(self.spoke_count), env.se.tile_count)
+        self.is_root = self.plan.pred_count == 0
+        self.unreachable = 10 * mask_engine.slice_count  # hop/spoke of an empty domain, above any ready time
+
+        # Successors with a single predecessor, slice to slice hops and timing table for the two step lookahead
+        self.chain_succs = [succs[self.plan.pred_count[succs] == 1] for succs in map(self.plan.succs, range(self.plan.num_nodes))]
+        self.slice_hops = np.abs(self.slice_tile[:, None] - self.slice_tile[None, :])
+        self.other_slice = ~np.eye(mask_engine.slice_count, dtype=bool)
+        self.timing = mask_engine.timing_table.reshape(mask_engine.slice_count, mask_engine.slice_count)
+
+        # Nodes with several successors whose last predecessor they are, and the k-th smallest hop from every tile
+        tiles = np.arange(env.se.tile_count)
+        self.sorted_hops = np.sort(np.abs(tiles[:, None] - tiles[None, :]), axis=1)
+        self.fanout_count = np.bincount(self.plan.pred_last, minlength=self.plan.num_nodes + 1)[:-1]
+        self.fanout = np.flatnonzero(self.fanout_count > 1) if mask_engine.sibling_constr else np.zeros(0, dtype=np.int64)
+
+        self.best_ready_time = incumbent  # 100: no complete placement (get_nodes_rand)
+        self.best_placed_nodes = None
+        self.nodes = 0  # search nodes generated, one env step each
+
+        env.reset()
+        self.root_bound = self.lower_bound()
+        self.stack = [(self.root_bound, 0, env.snapshot())]  # (lower bound, depth, snapshot), DFS pops the last
+
+    def lower_bound(self):
+        '''
+        admissible lower bound on the graph ready time of any completion of the current env placement
+        '''
+        env, plan = self.env, self.plan
+        unplaced = env.node_tile < 0
+        est = np.zeros(plan.num_nodes + 1, dtype=np.int64)  # est[num_nodes]: no predecessor
+        est[:-1] = np.where(unplaced, 0, env.node_ready)
+
+        # smallest spoke (roots) or hop from the placed last predecessor (others) left in every domain
+        pred_tile = np.append(env.node_tile, -1)[plan.pred_last]
+        hops = np.abs(self.slice_tile[None, :] - pred_tile[:, None])
+        hops[pred_tile < 0] = 0
+        cost = np.where(self.is_root[:, None], self.slice_spoke[None, :], hops)
+        base = np.where(env.domains, cost, self.unreachable).min(axis=1) + self.depth
+
+        # two step lookahead from the nodes to place next
+        est2 = np.zeros(plan.num_nodes, dtype=np.int64)
+        for node in np.flatnonzero(unplaced & (pred_tile >= 0)).tolist():
+            succs = self.chain_succs[node]
+            slices = np.flatnonzero(env.domains[node])
+            if not len(succs) or not len(slices):
+                continue
+            first = hops[node, slices]
+            for succ in succs.tolist():
+                feasible = self.timing[slices] & env.domains[succ] & self.other_slice[slices]
+                second = np.where(feasible, self.slice_hops[slices], self.unreachable).min(axis=1)
+                est2[succ] = est[plan.pred_last[node]] + (first + second).min() + 2 * self.depth
+
+        for level in plan.levels:
+            level = level[unplaced[level]]
+            est[level] = np.maximum(est[plan.pred_last[level]] + base[level], est2[level])
+        bound = max(env.graph_ready_time, est.max())
+
+        # siblings on different tiles, k//2 is the best case of an unplaced predecessor in the middle of the device
+        if len(self.fanout):
+            count = self.fanout_count[self.fanout]
+            tile = env.node_tile[self.fanout]
+            hops = np.where(tile >= 0, self.sorted_hops[tile, np.minimum(count, len(self.sorted_hops)) - 1], count // 2)
+            bound = max(bound, (est[self.fanout] + hops).max() + self.depth)
+        return bound
+
+    def expand(self, bound, depth, snapshot):
+        '''
+        children of a search node that are not pruned, best first
+        return: [(lower bound, depth, snapshot)]
+        '''
+        env = self.env
+        node = self.order[depth]
+        env.restore(snapshot)
+        slices = np.flatnonzero(env.get_mask(node))
+        if depth == 0:  # mirror symmetry
+            slices = slices[self.slice_tile[slices] <= (env.se.tile_count - 1) // 2]
+        children = []
+        for tile_slice in slices.tolist():
+            env.restore(snapshot)
+            tile, spoke = divmod(tile_slice, self.spoke_count)
+            _, _, done, info = env.step([node, tile, spoke])
+            self.nodes += 1
+            if info['dead_end']:
+                continue
+            child_bound = self.lower_bound()
+            if child_bound >= self.best_ready_time:
+                continue
+            if done:
+                self.best_ready_time = env.graph_ready_time
+                self.best_placed_nodes = {placed: dict(data) for placed, data in env.placed_nodes.items()}
+                if self.verbose:
+                    print(f'\nBest graph ready time yet: {self.best_ready_time} ({self.nodes} nodes)')
+                continue
+            children.append((child_bound, depth + 1, env.snapshot()))
+        children.sort(key=lambda child: child[0])
+        return children
+
+    def run(self, node_limit=None, time_limit=None):
+        '''
+        search until the tree is exhausted (optimal), node_limit search nodes are generated or time_limit
+        seconds have passed, can be called again to continue
+        return: best graph ready time, lower bound on the optimum
+        '''
+        deadline = time.perf_counter() + time_limit if time_limit else None
+        while self.stack:
+            if node_limit is not None and self.nodes >= node_limit:
+                break
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            bound, depth, snapshot = self.stack.pop()
+            if bound >= self.best_ready_time:  # incumbent improved since it was pushed
+                continue
+            self.stack.extend(reversed(self.expand(bound, depth, snapshot)))
+        return self.best_ready_time, self.lower()
+
+    @property
+    def optimal(self):
+        return not self.stack
+
+    def lower(self):
+        '''
+        lower bound on the optimal graph ready time: smallest bound of the open search nodes
+        '''
+        return min([self.best_ready_time] + [bound for bound, _, _ in self.stack])
+
+    def gap(self):
+        '''
+        relative optimality gap (best - lower bound) / best, 0 once the search is exhausted
+        '''
+        if self.best_placed_nodes is None:
+            return float('inf')
+        return (self.best_ready_time - self.lower()) / self.best_ready_time
+
+    def best(self, out_file_name=None, device_topology=(16, 6)):
+        '''
+        best placement found, saved with output_json to out_file_name if given
+        return: best graph ready time, placed nodes {node: {'tile_slice', 'ready_time'}} (None if none found)
+        '''
+        if out_file_name and self.best_placed_nodes is not None:
+            output_json(self.best_placed_nodes,
+                        no_of_tiles=device_topology[0],
+                        spoke_count=device_topology[1],
+                        out_file_name=out_file_name)
+        return self.best_ready_time, self.best_placed_nodes
@@ -0,0 +1,146 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from modules import ActorCritic, CategoricalMasked, _engine
+
+def load_policy(args, graphdef, device, checkpoint):
+    '''
+    one ActorCritic with the weights of checkpoint (randomly initialized if empty), in eval mode for inference
+    '''
+    policy = ActorCritic(args=args,
+                         device=device,
+                         state_dim=int(device['action_dim']),
+                         emb_size=args.emb_size,
+                         action_dim=int(device['action_dim']),
+                         graph_feat_size=args.graph_feat_size,
+                         gnn_in=graphdef['graph'].ndata['feat'].shape[1]).to(_engine)
+    if checkpoint:
+        policy.load_state_dict(torch.load(checkpoint, map_location=_engine))
+    return policy.eval()
+
+def quantize_policy(policy):
+    '''
+    copy of the policy with dynamic int8 nn.Linear layers (ACFF heads, graph convolutions, transformer
+    feed-forward): weights quantized once, activations quantized per batch. CPU only
+    '''
+    assert _engine.type == 'cpu', 'dynamic int8 quantization runs on CPU only'
+    quantized = torch.quantization.quantize_dynamic(policy, {nn.Linear}, dtype=torch.qint8)
+    quantized.invalidate_graph_cache()  # The deep copy keeps the fp32 graph embeddings
+    return quantized
+
+class ScriptedPolicy:
+    """TorchScript actor saved by export.py, with the ActorCritic.logits interface used by the decoders
+
+    The graph embedding is computed once per graph and reused for every node. optimize runs the module
+    with the profiling executor, which specializes it during the first calls: off by default, its warm-up
+    costs more than a single mapping.
+    """
+    def __init__(self, path, optimize=False):
+        self.module = torch.jit.load(path, map_location=_engine)
+        self.optimize = optimize
+        self._graph = None
+        self._graph_feat = None
+
+    def logits(self, state, graph, node_ids):
+        with torch.jit.optimized_execution(self.optimize):
+            if graph is not self._graph:
+                src, dst = graph.edges()
+                self._graph_feat = self.module.embed(src.long(), dst.long(), graph.ndata['feat'])
+                self._graph = graph
+            return self.module(state, node_ids, self._graph_feat)
+
+def masked_logits(policy, state, graph, node_id, mask):
+    '''
+    actor logits of a state or a batch of states with infeasible slices set to the lowest value
+    return: logits, mask as tensors
+    '''
+    state = torch.atleast_2d(torch.tensor(state, dtype=torch.float32, device=_engine))
+    mask = torch.atleast_2d(torch.tensor(mask, dtype=torch.bool, device=_engine))
+    node_ids = torch.full((state.shape[0], 1), node_id, device=_engine)
+    logits = policy.logits(state, graph, node_ids)
+    return logits.masked_fill(~mask, torch.finfo(logits.dtype).min), mask
+
+def greedy_decode(policy, env, graph):
+    '''
+    place every node at its most likely feasible slice
+    return: placed nodes and graph ready time, (None, inf) if a node can't be placed
+    '''
+    state = env.reset()
+    topology = (env.se.tile_count, env.se.spoke_count)
+    for node_id in env.plan.topo_order.tolist():
+        mask = env.get_mask(node_id)
+        if not mask.any():
+            return None, float('inf')
+        logits, _ = masked_logits(policy, state, graph, node_id, mask)
+        tile, spoke = np.unravel_index(int(logits.argmax()), topology)
+        state, reward, done, info = env.step([node_id, tile, spoke])
+        if info['dead_end']:
+            return None, float('inf')
+    return env.placed_nodes, env.graph_ready_time
+
+def sample_decode(policy, env, graph):
+    '''
+    sample env.num_envs rollouts in lockstep on a VectorStreamingEngineEnv
+    return: placed nodes and graph ready time of the best complete rollout, (None, inf) if none completes
+    '''
+    state = env.reset()
+    topology = (env.tile_count, env.spoke_count)
+    for node_id in env.plan.topo_order.tolist():
+        mask = env.get_mask(node_id)
+        logits, mask = masked_logits(policy, state, graph, node_id, mask)
+        action = CategoricalMasked(logits=logits, mask=mask).sample()
+        tile, spoke = np.unravel_index(action.cpu().numpy(), topology)
+        state, reward, done, info = env.step([node_id, tile, spoke])
+
+    ready_time = np.where(env.all_nodes_placed, env.graph_ready_time, np.inf)
+    best = int(np.argmin(ready_time))
+    if not env.all_nodes_placed[best]:
+        return None, float('inf')
+    return env.get_placed_nodes(best), int(ready_time[best])
+
+def beam_decode(policy, env, graph, beam_width=8, expand=4, score='logprob'):
+    '''
+    beam search over the nodes in topological order on a VectorStreamingEngineEnv
+    every beam is expanded with its `expand` most likely feasible slices (one actor forward for all beams),
+    the beam_width best partial placements are kept by accumulated log-prob or partial graph ready time
+    the episodes of env are grown and pruned with select(), a single episode env is enough
+    return: placed nodes and graph ready time of the best complete placement, (None, inf) if none completes
+    '''
+    assert score in ['logprob', 'ready_time'], 'score must be either "logprob" or "ready_time"'
+    state = env.reset()
+    if env.num_envs > 1:  # The search starts from one empty placement
+        state = env.select([0])
+    beam_logprob = np.zeros(1)
+    topology = (env.tile_count, env.spoke_count)
+    for node_id in env.plan.topo_order.tolist():
+        mask = env.get_mask(node_id)
+        logits, mask_t = masked_logits(policy, state, graph, node_id, mask)
+        logprob = torch.log_softmax(logits, dim=1).masked_fill(~mask_t, -np.inf)
+        top_logprob, top_slice = logprob.topk(min(expand, logprob.shape[1]), dim=1)
+        top_logprob, top_slice = top_logprob.cpu().numpy(), top_slice.cpu().numpy()
+
+        # Candidates: feasible (beam, slice) pairs, stepped all at once then pruned
+        beam, rank = np.nonzero(np.isfinite(top_logprob))
+        if len(beam) == 0:
+            return None, float('inf')
+        candidate_logprob = beam_logprob[beam] + top_logprob[beam, rank]
+        state = env.select(beam)
+        tile, spoke = np.unravel_index(top_slice[beam, rank], topology)
+        state, reward, done, info = env.step([node_id, tile, spoke])
+
+        if info['dead_end'].all():
+            return None, float('inf')
+        if score == 'logprob':
+            order = np.argsort(-candidate_logprob, kind='stable')
+        else:  # Lowest partial ready time first, ties broken by log-prob
+            order = np.lexsort((-candidate_logprob, env.graph_ready_time))
+        keep = order[~info['dead_end'][order]][:beam_width]  # Candidates at a dead end are pruned
+        state = env.select(keep)
+        beam_logprob = candidate_logprob[keep]
+
+    ready_time = np.where(env.all_nodes_placed, env.graph_ready_time, np.inf)
+    best = int(np.argmin(ready_time))
+    if not env.all_nodes_placed[best]:
+        return None, float('inf')
+    return env.get_placed_nodes(best), int(ready_time[best])
@@ -0,0 +1,85 @@
+import numpy as np
+
+
+def evaluate_placements(plan, placements, mask_engine, order=None, return_violations=False):
+    """Score K complete placements of a graph at once, without stepping an env
+
+    Follows StreamingEngineEnv: a candidate is feasible if placing its nodes one by one in `order`
+    never hits a zero mask, and its ready time is the graph ready time the env would reach.
+
+    Args:
+        plan (GraphPlan): compiled graph
+        placements (np.array): [K, num_nodes] tile slice index of every node per candidate
+        mask_engine (MaskEngine): device and enabled constraints
+        order (np.array): node placement order, topological order of the plan by default
+        return_violations (bool): also return the number of violated constraints of every candidate
+
+    Returns:
+        ready_time (np.array): [K] graph ready time, 100 for infeasible candidates like play_placement
+        feasible (np.array): [K] bool, no violated constraint
+        violations (np.array): [K] number of out of range nodes, shared slices, violated constraint pairs
+            and timing failures, if return_violations
+    """
+    placements = np.asarray(placements, dtype=np.int64)
+    num_cand, num_nodes = placements.shape
+    assert num_nodes == plan.num_nodes, f'Placements have {num_nodes} nodes, graph has {plan.num_nodes}'
+    order = plan.topo_order if order is None else np.asarray(order)
+    position = np.empty(num_nodes, dtype=np.int64)
+    position[order] = np.arange(num_nodes)
+
+    in_range = (placements >= 0) & (placements < mask_engine.slice_count)
+    violations = (~in_range).sum(axis=1)
+    slices = np.where(in_range.all(axis=1)[:, None], placements, 0)  # Keep out of range candidates indexable
+    # Extra column for the num_nodes padding of plan.pred_matrix
+    tile = np.zeros((num_cand, num_nodes + 1), dtype=np.int64)
+    spoke = np.zeros((num_cand, num_nodes + 1), dtype=np.int64)
+    tile[:, :num_nodes], spoke[:, :num_nodes] = np.divmod(slices, mask_engine.spoke_count)
+
+    # Predecessors must be placed first
+    violations += (position[plan.pred_idx] > np.repeat(position, plan.pred_count)).sum()
+
+    # One node per slice
+    sorted_slices = np.sort(slices, axis=1)
+    violations += (sorted_slices[:, 1:] == sorted_slices[:, :-1]).sum(axis=1)
+
+    # Sibling and TM constraints hold pairwise whatever the placement order
+    if mask_engine.sibling_constr and len(plan.sib_pairs):
+        violations += (tile[:, plan.sib_pairs[:, 0]] == tile[:, plan.sib_pairs[:, 1]]).sum(axis=1)
+    if mask_engine.tm_constr and len(plan.tm_pairs):
+        violations += (tile[:, plan.tm_pairs[:, 0]] != tile[:, plan.tm_pairs[:, 1]]).sum(axis=1)
+
+    # SF constraint: a root can't go on the tile of a sync flow node placed before it
+    if mask_engine.sf_constr and len(plan.sf_nodes):
+        roots, sf_nodes = np.meshgrid(plan.roots, plan.sf_nodes, indexing='ij')
+        before = (roots != sf_nodes) & (position[sf_nodes] < position[roots])
+        roots, sf_nodes = roots[before], sf_nodes[before]
+        violations += (tile[:, roots] == tile[:, sf_nodes]).sum(axis=1)
+
+    # Ready times level by level, nodes of a level only depend on the previous levels
+    ready = np.full((num_cand, num_nodes + 1), -1, dtype=np.int64)
+    cand = np.arange(num_cand)[:, None]
+    for nodes in plan.levels:
+        has_preds = plan.pred_count[nodes] > 0
+        preds = plan.pred_matrix[nodes]  # [L, D]
+        pred_ready = ready[:, preds]  # [K, L, D]
+
+        # Timing constraint w.r.t. the predecessor with the latest ready time
+        latest = preds[np.arange(len(nodes)), pred_ready.argmax(axis=2)]
+        timing_ok = mask_engine.timing_table[tile[cand, latest], spoke[cand, latest], slices[:, nodes]]
+        violations += (~timing_ok & has_preds).sum(axis=1)
+
+        # Same as StreamingEngineEnv._get_ready_time: last predecessor with positive ready time
+        positive = pred_ready > 0
+        last = preds.shape[1] - 1 - np.argmax(positive[..., ::-1], axis=2)
+        predecessor_ready_time = np.where(positive.any(axis=2),
+                                          np.take_along_axis(pred_ready, last[..., None], axis=2)[..., 0], -1)
+        hops = np.abs(tile[:, plan.pred_last[nodes]] - tile[:, nodes])
+        ready[:, nodes] = np.where(has_preds,
+                                   predecessor_ready_time + hops + mask_engine.pipeline_depth,
+                                   spoke[:, nodes] + mask_engine.pipeline_depth)
+
+    feasible = violations == 0
+    ready_time = np.where(feasible, ready[:, :num_nodes].max(axis=1, initial=-1), 100)
+    if return_violations:
+        return ready_time, feasible, violations
+    return ready_time, feasible
@@ -0,0 +1,95 @@
+import dgl
+import numpy as np
+
+def _to_csr(lists):
+    '''
+    list of int arrays -> (ptr, idx), row i is idx[ptr[i]:ptr[i+1]]
+    '''
+    ptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum([len(l) for l in lists])
+    idx = np.concatenate(lists).astype(np.int64) if len(lists) else np.zeros(0, dtype=np.int64)
+    return ptr, idx
+
+def _pairs(ptr, idx):
+    '''
+    symmetric CSR relation -> [P, 2] array of the pairs (i, j) with i < j
+    '''
+    src = np.repeat(np.arange(len(ptr) - 1), np.diff(ptr))
+    keep = src < idx
+    return np.stack([src[keep], idx[keep]], axis=1)
+
+class GraphPlan:
+    '''
+    Static data of a graphdef compiled once so the env and the mappers never query DGL per step:
+    topological order, CSR predecessors/successors/siblings, TM groups and sync flow nodes
+    '''
+    def __init__(self, graphdef):
+        graph = graphdef['graph']
+        self.num_nodes = graph.num_nodes()
+        nodes = range(self.num_nodes)
+
+        asc = dgl.topological_nodes_generator(graph)
+        self.topo_order = np.array([i.item() for t in asc for i in t], dtype=np.int64)
+        self.topo_level = np.zeros(self.num_nodes, dtype=np.int64)  # depth of each node in the topological order
+        for level, level_nodes in enumerate(asc):
+            self.topo_level[level_nodes.numpy()] = level
+
+        # Keep DGL neighbour order, the env picks predecessors by position
+        preds = [graph.predecessors(node).numpy() for node in nodes]
+        succs = [graph.successors(node).numpy() for node in nodes]
+        self.pred_ptr, self.pred_idx = _to_csr(preds)
+        self.succ_ptr, self.succ_idx = _to_csr(succs)
+        self.pred_count = np.diff(self.pred_ptr)
+        self.roots = np.flatnonzero(self.pred_count == 0)  # Nodes without predecessors
+
+        # Predecessor rows padded with num_nodes, last predecessor and topological levels for batched evaluation
+        self.pred_matrix = np.full((self.num_nodes, max(self.pred_count.max(initial=0), 1)), self.num_nodes, dtype=np.int64)
+        for node in nodes:
+            self.pred_matrix[node, :len(preds[node])] = preds[node]
+        self.pred_last = np.array([p[-1] if len(p) else self.num_nodes for p in preds], dtype=np.int64)
+        self.levels = [np.flatnonzero(self.topo_level == level) for level in range(len(asc))]
+
+        # Siblings: other successors of a node's predecessors
+        siblings = []
+        for node in nodes:
+            sibs = np.unique(np.concatenate([succs[pred] for pred in preds[node]] + [np.zeros(0, dtype=np.int64)]))
+            siblings.append(sibs[sibs != node])
+        self.sib_ptr, self.sib_idx = _to_csr(siblings)
+        self.sib_pairs = _pairs(self.sib_ptr, self.sib_idx)
+
+        # TM groups: other nodes sharing a tile memory variable
+        tm_partners = []
+        for node in nodes:
+            others = set()
+            for tm in graphdef['nodes_to_tm'].get(node, []):
+                others.update(graphdef['tm_to_nodes'][tm])
+            others.discard(node)
+            tm_partners.append(np.array(sorted(others), dtype=np.int64))
+        self.tm_ptr, self.tm_idx = _to_csr(tm_partners)
+        self.tm_pairs = _pairs(self.tm_ptr, self.tm_idx)
+
+        self.sf_nodes = np.array(graphdef['sf_nodes'], dtype=np.int64)
+        self.is_sf = np.zeros(self.num_nodes, dtype=bool)
+        self.is_sf[self.sf_nodes] = True
+
+    def preds(self, node):
+        return self.pred_idx[self.pred_ptr[node]:self.pred_ptr[node + 1]]
+
+    def succs(self, node):
+        return self.succ_idx[self.succ_ptr[node]:self.succ_ptr[node + 1]]
+
+    def siblings(self, node):
+        return self.sib_idx[self.sib_ptr[node]:self.sib_ptr[node + 1]]
+
+    def tm_partners(self, node):
+        return self.tm_idx[self.tm_ptr[node]:self.tm_ptr[node + 1]]
+
+def get_plan(graphdef):
+    '''
+    return the GraphPlan of graphdef, compiled on first use and cached in graphdef['plan']
+    '''
+    plan = graphdef.get('plan')
+    if plan is None or plan.num_nodes != graphdef['graph'].num_nodes():
+        plan = GraphPlan(graphdef)
+        graphdef['plan'] = plan
+    return plan
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+class MaskEngine:
+    """Device tables the feasible tile slice masks of the streaming engine are built from
+
+    All tables only depend on the device, so one engine is built per env and reused for every graph.
+    Placement state is passed in as arrays indexed by node: tile (-1 if unplaced), spoke and ready time.
+
+    The envs read their masks from forward-checked domains built on these tables, the masks computed from
+    scratch they are tested against live in tests/mask_reference.py.
+    """
+    def __init__(self, tile_count, spoke_count, pipeline_depth,
+                 sibling_constr=True, tm_constr=True, sf_constr=True):
+        self.tile_count = tile_count
+        self.spoke_count = spoke_count
+        self.pipeline_depth = pipeline_depth
+        self.slice_count = tile_count * spoke_count
+        self.sibling_constr = sibling_constr
+        self.tm_constr = tm_constr
+        self.sf_constr = sf_constr
+
+        tiles = np.arange(tile_count)
+        # Index tables: tile of every slice and slices of every tile
+        self.slice_tile = np.repeat(tiles, spoke_count)
+        self.tile_slices = np.arange(self.slice_count).reshape(tile_count, spoke_count)
+
+        # timing_table[pred_tile, pred_spoke]: slices that satisfy the timing constraint when the latest
+        # predecessor sits at [pred_tile, pred_spoke], one spoke per tile (assumes passthrough)
+        hops = np.abs(tiles[:, None] - tiles[None, :])  # [pred_tile, tile]
+        spokes = (np.arange(spoke_count)[None, :, None] + pipeline_depth + hops[:, None, :]) % spoke_count
+        table = np.zeros((tile_count, spoke_count, tile_count, spoke_count), dtype=bool)
+        pt, ps, t = np.meshgrid(np.arange(tile_count), np.arange(spoke_count), tiles, indexing='ij')
+        table[pt, ps, t, spokes] = True
+        self.timing_table = table.reshape(tile_count, spoke_count, self.slice_count)
+
+    @classmethod
+    def from_args(cls, args, tile_count, spoke_count, pipeline_depth):
+        return cls(tile_count, spoke_count, pipeline_depth,
+                   sibling_constr=not getattr(args, 'no_sibling_constr', False),
+                   tm_constr=not getattr(args, 'no_tm_constr', False),
+                   sf_constr=not getattr(args, 'no_sf_constr', False))
+
+    def zero_mask(self):
+        return np.zeros(self.slice_count, dtype=bool)
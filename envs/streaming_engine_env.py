@@ -5,44 +5,54 @@ from gym import spaces
 import numpy as np
 import logging
 
+from envs.mask_engine import MaskEngine
+from envs.graph_plan import get_plan
+
 class Tile:
     """class for a Tile """
-    def __init__(self, index, spoke_count):
+    def __init__(self, index, spoke_count, spokes=None, free_spokes=None):
         self.index = index
         self.spoke_count = spoke_count
-        self.spokes = [None] * self.spoke_count
+        # spokes/free_spokes are views into the StreamingEngine occupancy arrays, -1 marks an empty spoke
+        self.spokes = np.full(spoke_count, -1.) if spokes is None else spokes
+        self.free_spokes = np.array([spoke_count]) if free_spokes is None else free_spokes
+        self._free_idx = 0 if free_spokes is None else index
 
     def place(self, node, spoke_idx):
         assert spoke_idx >=0 and spoke_idx < self.spoke_count, f"Spoke index needs to be in range [0,{self.spoke_count}])"
-        assert self.spokes[spoke_idx] == None, f"Can't place node {node} at [Tile, Spoke]: [{self.spokes[spoke_idx]}, {self.index}]. Node {self.spokes[spoke_idx]} previously placed here"
+        assert self.spokes[spoke_idx] == -1, f"Can't place node {node} at [Tile, Spoke]: [{self.index}, {spoke_idx}]. Node {int(self.spokes[spoke_idx])} previously placed here"
         self.spokes[spoke_idx] = node
+        self.free_spokes[self._free_idx] -= 1
         return True  # return True for successful placement
 
     def reset(self):
-        self.spokes = [None] * self.spoke_count
+        self.spokes.fill(-1)
+        self.free_spokes[self._free_idx] = self.spoke_count
 
 class StreamingEngine:
     def __init__(self, tile_count=16, spoke_count=3, pipeline_depth=3):
         self.tile_count = tile_count
         self.spoke_count = spoke_count
         self.pipeline_depth = pipeline_depth
-        self.tiles = [Tile(idx, spoke_count) for idx in range(tile_count)]
+        # Occupancy of every tile slice (node_idx or -1) and number of free spokes per tile,
+        # updated in place by the tiles so the state never has to be rebuilt
+        self.state = np.full(tile_count * spoke_count, -1.)
+        self.free_spokes = np.full(tile_count, spoke_count)
+        occupancy = self.state.reshape(tile_count, spoke_count)
+        self.tiles = [Tile(idx, spoke_count, occupancy[idx], self.free_spokes) for idx in range(tile_count)]
+        self._state_view = self.state.view()
+        self._state_view.flags.writeable = False
 
     def get_state(self, view=''):
-        """Returns array with node_idx where node has been placed, -1 otherwise"""
-        state = np.ones(self.tile_count * self.spoke_count) * -1
-        for tile_idx, tile in enumerate(self.tiles):
-            for spoke_idx, spoke in enumerate(tile.spokes):
-                if spoke != None:
-                    state[tile_idx*self.spoke_count + spoke_idx] = self.tiles[tile_idx].spokes[spoke_idx]  # or can be 1
-
+        """Returns read-only view of array with node_idx where node has been placed, -1 otherwise"""
+        state = self._state_view
         if view == 'human':
             state = state.reshape(self.tile_count, self.spoke_count)
         return state
 
     def reset(self):
-        for tile in self.tiles:
-            tile.reset()
+        self.state.fill(-1)
+        self.free_spokes.fill(self.spoke_count)
 
 class StreamingEngineEnv(gym.Env):
     # TODO: Implement sibling nodes constraint
@@ -59,13 +69,30 @@ class StreamingEngineEnv(gym.Env):
         self.action_space = spaces.MultiDiscrete([self.num_nodes, self.se.tile_count, self.se.spoke_count])
         # Observation: Vector containing info about each tile slice
         self.observation_space = spaces.Discrete(self.se.tile_count * self.se.spoke_count)
+        self.mask_engine = MaskEngine.from_args(args, tile_count, spoke_count, pipeline_depth)
         self.placed_nodes = {}  # Keys: node_idx, values: [(tile_idx, spoke_idx]), ready_time]
         self.all_nodes_placed = False
         self.graph_ready_time = -1
+        self._init_placement()
 
     def set_graph(self, graphdef):
         self.graphdef = graphdef
         self.num_nodes = graphdef['graph'].num_nodes()
+        self._init_placement()
+
+    def _init_placement(self):
+        self.plan = get_plan(self.graphdef)  # Compiled once per graph
+        # Placement of every node, tile is -1 while unplaced
+        self.node_tile = np.full(self.num_nodes, -1)
+        self.node_spoke = np.full(self.num_nodes, -1)
+        self.node_ready = np.full(self.num_nodes, -1)
+        # Forward checking: feasible slices of every unplaced node given the nodes placed so far,
+        # the timing constraint is applied once all predecessors of a node are placed
+        self.domains = np.ones((self.num_nodes, self.se.tile_count * self.se.spoke_count), dtype=bool)
+        self._domains_view = self.domains.view()
+        self._domains_view.flags.writeable = False
+        self.preds_left = self.plan.pred_count.copy()
+        self.dead_end = False
 
     def step(self, action):
         node, tile_idx, spoke_idx = action
@@ -75,7 +102,8 @@ class StreamingEngineEnv(gym.Env):
             obs = self.se.get_state()
             reward = -10.0
             done = True
-            return obs, reward, done, {'ready_time': 100}
+            self.dead_end = True
+            return obs, reward, done, {'ready_time': 100, 'dead_end': True}
         if not self._predecessors_placed(node):  # Check if predecessors have been placed
             raise ValueError(f'All predecessors of node {node} not placed')
         if self.placed_nodes.get(node) != None:  # Check if node hasn't been placed already
@@ -90,16 +118,24 @@ class StreamingEngineEnv(gym.Env):
         if ready_time > self.graph_ready_time:  # Keep track of highest ready time of nodes
             self.graph_ready_time = ready_time
         self.placed_nodes[node] = {'tile_slice': (tile_idx, spoke_idx), 'ready_time': ready_time}
+        self.node_tile[node], self.node_spoke[node], self.node_ready[node] = tile_idx, spoke_idx, ready_time
+        self._forward_check(node, tile_idx, spoke_idx)
         if len(self.placed_nodes) == self.num_nodes:
             self.all_nodes_placed = True
         obs = self.se.get_state()  # Can change to boolean obs
         reward = self._calculate_reward(ready_time, predecessor_ready_time)
         done = len(self.placed_nodes) == self.num_nodes
-        return obs, reward, done, {'ready_time': ready_time}
+        return obs, reward, done, {'ready_time': ready_time, 'dead_end': self.dead_end}
 
     def reset(self):
         self.se.reset()
         self.placed_nodes = {}
+        self.node_tile.fill(-1)
+        self.node_spoke.fill(-1)
+        self.node_ready.fill(-1)
+        self.domains.fill(True)
+        self.preds_left[:] = self.plan.pred_count
+        self.dead_end = False
         self.all_nodes_placed = False
         self.graph_ready_time = -1
         return self.se.get_state()
@@ -107,6 +143,66 @@ class StreamingEngineEnv(gym.Env):
     def render(self):
         pass
 
+    def snapshot(self):
+        """Return a copy of the placement state as compact arrays, restore() it to branch from this depth
+        without replaying the steps"""
+        return {'occupancy': self.se.state.copy(),
+                'free_spokes': self.se.free_spokes.copy(),
+                'order': np.fromiter(self.placed_nodes, dtype=np.int64, count=len(self.placed_nodes)),
+                'node_tile': self.node_tile.copy(),
+                'node_spoke': self.node_spoke.copy(),
+                'node_ready': self.node_ready.copy(),
+                'domains': self.domains.copy(),
+                'preds_left': self.preds_left.copy(),
+                'graph_ready_time': self.graph_ready_time,
+                'dead_end': self.dead_end}
+
+    def restore(self, snapshot):
+        """Set the placement state back to a snapshot() of the same graph"""
+        assert len(snapshot['node_tile']) == self.num_nodes, 'Snapshot taken on another graph'
+        self.se.state[:] = snapshot['occupancy']
+        self.se.free_spokes[:] = snapshot['free_spokes']
+        self.node_tile[:] = snapshot['node_tile']
+        self.node_spoke[:] = snapshot['node_spoke']
+        self.node_ready[:] = snapshot['node_ready']
+        self.domains[:] = snapshot['domains']
+        self.preds_left[:] = snapshot['preds_left']
+        self.graph_ready_time = snapshot['graph_ready_time']
+        self.dead_end = snapshot['dead_end']
+        tiles, spokes, ready = self.node_tile.tolist(), self.node_spoke.tolist(), self.node_ready.tolist()
+        self.placed_nodes = {node: {'tile_slice': (tiles[node], spokes[node]), 'ready_time': ready[node]}
+                             for node in snapshot['order'].tolist()}
+        self.all_nodes_placed = len(self.placed_nodes) == self.num_nodes
+        return self.se.get_state()
+
+    def _forward_check(self, node, tile_idx, spoke_idx):
+        """Remove slices made infeasible by placing node from the domains of the unplaced nodes
+        and flag a dead end as soon as one of them is empty"""
+        spoke_count = self.se.spoke_count
+        tile_start, tile_end = tile_idx * spoke_count, (tile_idx + 1) * spoke_count
+        self.domains[node] = False
+        self.domains[:, tile_start + spoke_idx] = False  # Occupied slice
+
+        if self.mask_engine.sibling_constr:
+            self.domains[self.plan.siblings(node), tile_start:tile_end] = False
+        if self.mask_engine.tm_constr:
+            tm_partners = self.plan.tm_partners(node)
+            self.domains[tm_partners, :tile_start] = False
+            self.domains[tm_partners, tile_end:] = False
+        if self.mask_engine.sf_constr and self.plan.is_sf[node]:
+            self.domains[self.plan.roots, tile_start:tile_end] = False
+
+        # Timing constraint for successors whose predecessors are now all placed
+        succs = self.plan.succs(node)
+        np.subtract.at(self.preds_left, succs, 1)
+        for succ in succs[self.preds_left[succs] == 0]:
+            preds = self.plan.preds(succ)
+            latest_pred = preds[np.argmax(self.node_ready[preds])]
+            self.domains[succ] &= self.mask_engine.timing_table[self.node_tile[latest_pred], self.node_spoke[latest_pred]]
+
+        if not self.dead_end:
+            self.dead_end = bool(((self.node_tile < 0) & ~self.domains.any(axis=1)).any())
+
     def _get_ready_time(self, action):
         # Assumes that node has already been placed, along with its predecessors
         node, tile_idx, spoke_idx = action
@@ -140,104 +236,25 @@ class StreamingEngineEnv(gym.Env):
         Returns:
             predecessors_placed: True if predecessors have been placed for `node`, False otherwise
         """
-        predecessors_placed = True  # Assume predecessors_placed
-        # Check if predecessors_placed
-        for predecessor in self._get_predecessors(node):
-            if self.placed_nodes.get(predecessor) == None:
-                predecessors_placed = False
-                break
+        predecessors_placed = bool((self.node_tile[self.plan.preds(node)] >= 0).all())
         return predecessors_placed
 
     def get_mask(self, node):
         """Return boolean mask of feasible tile slice locations given node to place
+
+        The mask is a read-only view of the node domain kept by forward checking, valid until the next step
         """
-        zero_mask = np.zeros(self.se.tile_count * self.se.spoke_count)
         # If node is already placed, return mask with all zeros
-        if self.placed_nodes.get(node) != None:
+        if self.node_tile[node] >= 0:
             logging.debug(f'Node {node} already placed, zero mask returned')
-            return zero_mask
+            return self.mask_engine.zero_mask()
 
         # Check if predecessors have been placed
-        elif not self._predecessors_placed(node):
+        elif self.preds_left[node] > 0:
             logging.debug(f'All predecessors not placed for node {node}, zero mask returned')
-            return zero_mask
-        
-        # Node can be placed at any open tile slice if no constraint is applied
-        mask = 1 - (self.se.get_state() > -1).astype(int)
-        
-        predecessors = tuple(self._get_predecessors(node))
-
-        # Mask according to timing constraints
-        if len(predecessors) != 0:
-            latest_pred= max(predecessors, key=lambda predecessor: self.placed_nodes.get(predecessor)['ready_time'])  # Get spoke of predecessor that has latest ready time
-            pred_tile = self.placed_nodes.get(latest_pred)['tile_slice'][0]
-            pred_spoke = self.placed_nodes.get(latest_pred)['tile_slice'][1]
-            for tile_idx in range(self.se.tile_count):
-                # Determine spoke idx in each tile which satisfies timing constraint (w/o considering delay)
-                avail_spoke_idx_in_tile = (pred_spoke + self.se.pipeline_depth + abs(tile_idx-pred_tile)) % self.se.spoke_count  # Assumes passthrough
-                avail_mask_idx = tile_idx * self.se.spoke_count + avail_spoke_idx_in_tile
-                unavail_idxs = self._get_spoke_idxs_in_tile(tile_idx)
-                unavail_idxs.remove(avail_mask_idx)
-                mask[unavail_idxs] = 0
-
-        # predecessor_spoke = self.placed_nodes.get()
-
-        # Mask for sibling constraint
-        if not self.args.no_sibling_constr:
-            siblings = []
-            for predecessor in predecessors:
-                successors = self._get_successors(predecessor)
-                for successor in successors:
-                    if successor != node:
-                        siblings.append(successor)
-
-            for sibling in siblings:
-                sibling_placement = self.placed_nodes.get(sibling)
-                if sibling_placement != None:
-                    sibling_tile = sibling_placement['tile_slice'][0]
-                    # Make spokes in sibling_tile unavailable
-                    unavail_idxs = self._get_spoke_idxs_in_tile(sibling_tile)
-                    mask[unavail_idxs] = 0
-
-        # Mask for TM constraint
-        if not self.args.no_tm_constr and node in self.graphdef['nodes_to_tm']:
-            # What TMs does node use
-            tms_used = self.graphdef['nodes_to_tm'][node]
-
-            # What other nodes use these TMs?
-            other_nodes = set()
-            for tm in tms_used:
-                for other_node in self.graphdef['tm_to_nodes'][tm]:
-                    if other_node != node:
-                        other_nodes.add(other_node)
-            other_nodes = list(other_nodes)
-
-            # If other nodes are already placed, only the tile they are placed on should be available
-            for other_node in other_nodes:
-                other_node_placement = self.placed_nodes.get(other_node)
-                if other_node_placement != None:
-                    other_node_tile = other_node_placement['tile_slice'][0]  # Tile idx
-                    # Make every idx in except those in other_node_tile unavailable
-                    exculde_idxs = self._get_spoke_idxs_in_tile(other_node_tile)
-                    unavail_idxs = [j for j in range(len(mask)) if j not in exculde_idxs]
-                    mask[unavail_idxs] = 0
-
-        # Mask for SF constraint
-        if not self.args.no_sf_constr:
-            predecessors = self._get_predecessors(node)
-            if len(predecessors) == 0:
-                # Iterate over other sf nodes
-                for sf_node in self.graphdef['sf_nodes']:
-                    if sf_node != node:
-                        sf_node_placement = self.placed_nodes.get(sf_node)
-                        if sf_node_placement != None:
-                            sf_node_tile = sf_node_placement['tile_slice'][0]
-                            # Make spokes in sf_node_tile unavailable
-                            unavail_idxs = self._get_spoke_idxs_in_tile(sf_node_tile)
-                            mask[unavail_idxs] = 0
-
-        return mask
+            return self.mask_engine.zero_mask()
 
+        return self._domains_view[node]
 
     def _calculate_reward(self, ready_time, predecessor_ready_time):
         # Ready time of node - ready time of parent
@@ -245,11 +262,7 @@ class StreamingEngineEnv(gym.Env):
         return reward
 
     def _get_predecessors(self, node):
-        return self.graphdef['graph'].predecessors(node).numpy()
+        return self.plan.preds(node)
 
     def _get_successors(self, node):
-        return self.graphdef['graph'].successors(node).numpy()
-
-    def _get_spoke_idxs_in_tile(self, tile_idx):
-        idxs = [i for i in range(tile_idx * self.se.spoke_count, tile_idx * self.se.spoke_count + self.se.spoke_count)]
-        return idxs
\ No newline at end of file
+        return self.plan.succs(node)
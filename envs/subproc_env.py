@@ -0,0 +1,190 @@
+import multiprocessing as mp
+from collections import deque
+import numpy as np
+from gym import spaces
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from envs.graph_plan import get_plan
+from envs.evaluate import evaluate_placements
+from util import get_nodes_rand, play_placement
+
+def _worker(remote, parent_remote, args, graphs, env_kwargs, obs_buf, mask_buf, env_idx):
+    '''
+    step a StreamingEngineEnv on commands from remote, obs and masks are written to the shared buffers
+    '''
+    parent_remote.close()
+    slice_count = env_kwargs['tile_count'] * env_kwargs['spoke_count']
+    obs = np.frombuffer(obs_buf, dtype=np.float64).reshape(-1, slice_count)[env_idx]
+    mask = np.frombuffer(mask_buf, dtype=bool).reshape(-1, slice_count)[env_idx]
+    device = {'topology': args.device_topology, 'action_dim': slice_count}
+    env = StreamingEngineEnv(args, graphdef=graphs[0], **env_kwargs)
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            if env.dead_end:  # Episode over, not stepped anymore like in VectorStreamingEngineEnv
+                remote.send((0., True, 100, env.graph_ready_time, len(env.placed_nodes), True))
+                continue
+            state, reward, done, info = env.step(data)
+            obs[:] = state
+            remote.send((reward, done or info['dead_end'], info['ready_time'], env.graph_ready_time, len(env.placed_nodes),
+                         info['dead_end']))
+        elif cmd == 'mask':
+            mask[:] = env.get_mask(data)
+            remote.send(None)
+        elif cmd == 'reset':
+            obs[:] = env.reset()
+            remote.send(None)
+        elif cmd == 'set_graph':
+            env.set_graph(graphs[data])
+            remote.send(None)
+        elif cmd == 'placed_nodes':
+            remote.send(env.placed_nodes)
+        elif cmd == 'get_nodes_rand':
+            results = []
+            for init_nodes in data:
+                env.reset()
+                reward_buf = deque()
+                readytime, place_nodes = get_nodes_rand(init_nodes, args, env, env.graphdef, device, reward_buf)
+                results.append((readytime, place_nodes, list(reward_buf)))
+            remote.send(results)
+        elif cmd == 'play_placement':
+            remote.send([play_placement(env, actions, args) for actions in data])
+        elif cmd == 'evaluate_placements':
+            placements, order, return_violations = data
+            remote.send(evaluate_placements(env.plan, placements, env.mask_engine, order, return_violations))
+        elif cmd == 'close':
+            remote.close()
+            break
+
+class SubprocStreamingEngineEnv:
+    """StreamingEngineEnv instances stepped in lockstep by worker processes
+
+    Drop-in replacement of VectorStreamingEngineEnv where every episode lives in its own process.
+    Observations and masks are written by the workers to shared memory buffers, only the small
+    step results go through the pipes. get_nodes_rand/play_placement run whole SA/ES rollouts
+    in the workers for a batch of candidates.
+    """
+    def __init__(self, args, graphs, num_envs=4, tile_count=16, spoke_count=3, pipeline_depth=3):
+        self.args = args
+        self.graphs = graphs if isinstance(graphs, list) else [graphs]
+        self.num_envs = num_envs
+        self.tile_count = tile_count
+        self.spoke_count = spoke_count
+        self.slice_count = tile_count * spoke_count
+        self.observation_space = spaces.Discrete(self.slice_count)
+        for graphdef in self.graphs:
+            get_plan(graphdef)  # Compile plans once, workers receive them with the graphs
+
+        obs_buf = mp.RawArray('d', num_envs * self.slice_count)
+        mask_buf = mp.RawArray('B', num_envs * self.slice_count)
+        self._obs = np.frombuffer(obs_buf, dtype=np.float64).reshape(num_envs, self.slice_count)
+        self._mask = np.frombuffer(mask_buf, dtype=bool).reshape(num_envs, self.slice_count)
+        self._obs_view = self._obs.view()
+        self._obs_view.flags.writeable = False
+        self._mask_view = self._mask.view()
+        self._mask_view.flags.writeable = False
+
+        env_kwargs = {'tile_count': tile_count, 'spoke_count': spoke_count, 'pipeline_depth': pipeline_depth}
+        self.remotes, self.processes = [], []
+        for env_idx in range(num_envs):
+            remote, work_remote = mp.Pipe()
+            process = mp.Process(target=_worker,
+                                 args=(work_remote, remote, args, self.graphs, env_kwargs, obs_buf, mask_buf, env_idx),
+                                 daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+        self.graph_ready_time = np.full(num_envs, -1)
+        self.placed_count = np.zeros(num_envs, dtype=int)
+        self.graphdef = self.graphs[0]
+        self.num_nodes = self.graphdef['graph'].num_nodes()
+        self.plan = get_plan(self.graphdef)
+
+    def _call(self, cmd, data=None):
+        for remote in self.remotes:
+            remote.send((cmd, data))
+        return [remote.recv() for remote in self.remotes]
+
+    def _call_batch(self, cmd, items):
+        '''
+        split items over the workers and return the results in order
+        '''
+        chunks = np.array_split(np.arange(len(items)), self.num_envs)
+        for remote, chunk in zip(self.remotes, chunks):
+            remote.send((cmd, [items[i] for i in chunk]))
+        return [result for remote in self.remotes for result in remote.recv()]
+
+    @property
+    def all_nodes_placed(self):
+        return self.placed_count == self.num_nodes
+
+    def set_graph(self, graphdef):
+        graph_idx = next(i for i, g in enumerate(self.graphs) if g is graphdef)
+        self._call('set_graph', graph_idx)
+        self.graphdef = graphdef
+        self.num_nodes = graphdef['graph'].num_nodes()
+        self.plan = get_plan(graphdef)
+
+    def reset(self):
+        self._call('reset')
+        self.graph_ready_time.fill(-1)
+        self.placed_count.fill(0)
+        return self._obs_view
+
+    def get_mask(self, node):
+        """Return [num_envs, slices] boolean masks of feasible tile slice locations for node in every episode
+
+        The masks are a read-only view of the shared buffer, valid until the next get_mask call
+        """
+        self._call('mask', node)
+        return self._mask_view
+
+    def step(self, action):
+        """action: [node, tile_idx[num_envs], spoke_idx[num_envs]], returns batched obs, reward, done, info"""
+        node, tile_idx, spoke_idx = action
+        for remote, tile, spoke in zip(self.remotes, tile_idx, spoke_idx):
+            remote.send(('step', [node, tile, spoke]))
+        results = [remote.recv() for remote in self.remotes]
+        reward, done, ready_time, self.graph_ready_time[:], self.placed_count[:], dead_end = map(np.array, zip(*results))
+        return self._obs_view, reward, done, {'ready_time': ready_time, 'dead_end': dead_end}
+
+    def get_placed_nodes(self, env_idx):
+        """Return placed_nodes dict of episode env_idx"""
+        self.remotes[env_idx].send(('placed_nodes', None))
+        return self.remotes[env_idx].recv()
+
+    def get_nodes_rand(self, init_nodes_list, reward_buf):
+        '''
+        run get_nodes_rand for every list of already placed nodes in init_nodes_list on the workers
+        return: list of (readytime, place_nodes)
+        '''
+        results = self._call_batch('get_nodes_rand', init_nodes_list)
+        for _, _, rewards in results:
+            reward_buf.extend(rewards)
+        return [(readytime, place_nodes) for readytime, place_nodes, _ in results]
+
+    def play_placement(self, actions_list):
+        '''
+        run play_placement for every list of (node_id, tile_slice_idx) in actions_list on the workers
+        return: list of (graph ready time, mean reward)
+        '''
+        return self._call_batch('play_placement', actions_list)
+
+    def evaluate_placements(self, placements, order=None, return_violations=False):
+        '''
+        evaluate_placements of the current graph, the rows of placements [K, nodes] split over the workers
+        return: ready_time [K] (100 if infeasible), feasible [K] and violations [K] if return_violations
+        '''
+        chunks = np.array_split(placements, self.num_envs)
+        for remote, chunk in zip(self.remotes, chunks):
+            remote.send(('evaluate_placements', (chunk, order, return_violations)))
+        results = [remote.recv() for remote in self.remotes]
+        return tuple(np.concatenate(outputs) for outputs in zip(*results))
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
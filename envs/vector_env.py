@@ -0,0 +1,178 @@
+import numpy as np
+from gym import spaces
+
+from envs.mask_engine import MaskEngine
+from envs.graph_plan import get_plan
+
+class VectorStreamingEngineEnv:
+    """B independent placements of the same graph on the streaming engine, stepped in lockstep
+
+    Follows StreamingEngineEnv semantics per episode, forward checking included: an episode is flagged
+    as a dead end as soon as an unplaced node has no feasible slice left, is done, and is no longer
+    stepped. All episodes place the same node at each step, so constraints are computed for the whole
+    batch with one set of numpy operations.
+    """
+    def __init__(self, args, graphdef, num_envs=8, tile_count=16, spoke_count=3, pipeline_depth=3):
+        self.args = args
+        self.num_envs = num_envs
+        self.tile_count = tile_count
+        self.spoke_count = spoke_count
+        self.pipeline_depth = pipeline_depth
+        self.slice_count = tile_count * spoke_count
+        self.mask_engine = MaskEngine.from_args(args, tile_count, spoke_count, pipeline_depth)
+        # Observation: Vector containing info about each tile slice, per episode
+        self.observation_space = spaces.Discrete(self.slice_count)
+        self.state = np.full((num_envs, self.slice_count), -1.)
+        self._state_view = self.state.view()
+        self._state_view.flags.writeable = False
+        self.graph_ready_time = np.full(num_envs, -1)
+        self.node_tile = None
+        self.set_graph(graphdef)
+
+    def set_graph(self, graphdef):
+        self.graphdef = graphdef
+        self.num_nodes = graphdef['graph'].num_nodes()
+        self.plan = get_plan(graphdef)
+        shape = (self.num_envs, self.num_nodes)
+        if self.node_tile is None or self.node_tile.shape != shape:  # Reused while the shapes don't change
+            # Placement of every node per episode, tile is -1 while unplaced
+            self.node_tile = np.empty(shape, dtype=int)
+            self.node_spoke = np.empty(shape, dtype=int)
+            self.node_ready = np.empty(shape, dtype=int)
+            self.placed_count = np.empty(self.num_envs, dtype=int)
+            # Forward checking per episode, see StreamingEngineEnv._forward_check
+            self.domains = np.empty(shape + (self.slice_count,), dtype=bool)
+            self.preds_left = np.empty_like(self.plan.pred_count)
+            self.dead_end = np.empty(self.num_envs, dtype=bool)
+        self.node_tile.fill(-1)
+        self.node_spoke.fill(-1)
+        self.node_ready.fill(-1)
+        self.placed_count.fill(0)
+        self.domains.fill(True)
+        self.preds_left[:] = self.plan.pred_count
+        self.dead_end.fill(False)
+
+    @property
+    def all_nodes_placed(self):
+        return self.placed_count == self.num_nodes
+
+    def reset(self):
+        self.state.fill(-1)
+        self.node_tile.fill(-1)
+        self.node_spoke.fill(-1)
+        self.node_ready.fill(-1)
+        self.placed_count.fill(0)
+        self.graph_ready_time.fill(-1)
+        self.domains.fill(True)
+        self.preds_left[:] = self.plan.pred_count
+        self.dead_end.fill(False)
+        return self._state_view
+
+    def select(self, indices):
+        """Keep the episodes at indices in that order, duplicates allowed, num_envs becomes len(indices)
+
+        Used by beam search to branch and prune partial placements.
+        """
+        indices = np.asarray(indices)
+        self.state = self.state[indices]
+        self._state_view = self.state.view()
+        self._state_view.flags.writeable = False
+        self.node_tile = self.node_tile[indices]
+        self.node_spoke = self.node_spoke[indices]
+        self.node_ready = self.node_ready[indices]
+        self.placed_count = self.placed_count[indices]
+        self.graph_ready_time = self.graph_ready_time[indices]
+        self.domains = self.domains[indices]
+        self.dead_end = self.dead_end[indices]
+        self.num_envs = len(indices)
+        return self._state_view
+
+    def get_mask(self, node):
+        """Return [num_envs, slices] boolean masks of feasible tile slice locations for node in every episode
+        """
+        preds = self.plan.preds(node)
+        # Zero mask where node is already placed or its predecessors are not
+        placeable = (self.node_tile[:, node] < 0) & (self.node_tile[:, preds] >= 0).all(axis=1)
+        return self.domains[:, node] & placeable[:, None]
+
+    def step(self, action):
+        """action: [node, tile_idx[num_envs], spoke_idx[num_envs]], returns batched obs, reward, done, info
+
+        Episodes already at a dead end are not stepped, they get reward 0
+        """
+        node, tile_idx, spoke_idx = action
+        tile_idx, spoke_idx = np.asarray(tile_idx), np.asarray(spoke_idx)
+        assert ((tile_idx >= 0) & (tile_idx < self.tile_count)).all(), f"Tile index not in range [0, {self.tile_count-1}]"
+        slice_idx = tile_idx * self.spoke_count + spoke_idx
+        mask = self.get_mask(node)
+        # If no action is possible, return high negative reward and end the episode
+        stepped = ~self.dead_end
+        failed = stepped & ~mask.any(axis=1)
+        self.dead_end |= failed
+        ok = stepped & ~failed
+        if not mask[ok, slice_idx[ok]].all():
+            raise ValueError(f'Illegal placement, action not allowed by mask in episodes {np.flatnonzero(ok & ~mask[np.arange(self.num_envs), slice_idx])}')
+
+        rows = np.flatnonzero(ok)
+        tile_idx, spoke_idx = tile_idx[rows], spoke_idx[rows]
+        preds = self.plan.preds(node)
+        if len(preds) == 0:
+            # If node doesn't have any predecessor, processing starts immediately
+            predecessor_ready_time = np.zeros(len(rows), dtype=int)
+            ready_time = spoke_idx + self.pipeline_depth
+        else:
+            # Same as StreamingEngineEnv._get_ready_time: last predecessor with positive ready time
+            pred_ready = self.node_ready[rows][:, preds]
+            positive = pred_ready > 0
+            last = len(preds) - 1 - np.argmax(positive[:, ::-1], axis=1)
+            predecessor_ready_time = np.where(positive.any(axis=1), pred_ready[np.arange(len(rows)), last], -1)
+            predecessor_tile_idx = self.node_tile[rows, preds[-1]]
+            ready_time = predecessor_ready_time + np.abs(predecessor_tile_idx - tile_idx) + self.pipeline_depth
+
+        self.state[rows, slice_idx[rows]] = node
+        self.node_tile[rows, node] = tile_idx
+        self.node_spoke[rows, node] = spoke_idx
+        self.node_ready[rows, node] = ready_time
+        self.placed_count[rows] += 1
+        self.graph_ready_time[rows] = np.maximum(self.graph_ready_time[rows], ready_time)
+        self._forward_check(node, rows, tile_idx, slice_idx[rows])
+
+        reward = np.zeros(self.num_envs)
+        reward[failed] = -10.
+        reward[rows] = ready_time - predecessor_ready_time
+        done = self.dead_end | self.all_nodes_placed
+        info_ready_time = np.full(self.num_envs, 100)
+        info_ready_time[rows] = ready_time
+        return self._state_view, reward, done, {'ready_time': info_ready_time, 'dead_end': self.dead_end.copy()}
+
+    def _forward_check(self, node, rows, tile_idx, slice_idx):
+        """StreamingEngineEnv._forward_check for the episodes in rows, which placed node on tile_idx/slice_idx"""
+        on_tile = self.mask_engine.slice_tile[None, :] == tile_idx[:, None]  # [rows, slices]
+        self.domains[rows, node] = False
+        self.domains[rows, :, slice_idx] = False  # Occupied slice
+
+        siblings = self.plan.siblings(node)
+        if self.mask_engine.sibling_constr and len(siblings):
+            self.domains[np.ix_(rows, siblings)] &= ~on_tile[:, None, :]
+        tm_partners = self.plan.tm_partners(node)
+        if self.mask_engine.tm_constr and len(tm_partners):
+            self.domains[np.ix_(rows, tm_partners)] &= on_tile[:, None, :]
+        if self.mask_engine.sf_constr and self.plan.is_sf[node]:
+            self.domains[np.ix_(rows, self.plan.roots)] &= ~on_tile[:, None, :]
+
+        # Timing constraint for successors whose predecessors are now all placed
+        succs = self.plan.succs(node)
+        np.subtract.at(self.preds_left, succs, 1)
+        for succ in succs[self.preds_left[succs] == 0].tolist():
+            preds = self.plan.preds(succ)
+            latest_pred = preds[np.argmax(self.node_ready[rows][:, preds], axis=1)]
+            self.domains[rows, succ] &= self.mask_engine.timing_table[self.node_tile[rows, latest_pred], self.node_spoke[rows, latest_pred]]
+
+        unplaced = self.node_tile[rows] < 0
+        self.dead_end[rows] |= (unplaced & ~self.domains[rows].any(axis=2)).any(axis=1)
+
+    def get_placed_nodes(self, env_idx):
+        """Return placed_nodes dict of episode env_idx in the StreamingEngineEnv format"""
+        placed = np.flatnonzero(self.node_tile[env_idx] >= 0)
+        return {int(node): {'tile_slice': (int(self.node_tile[env_idx, node]), int(self.node_spoke[env_idx, node])),
+                            'ready_time': int(self.node_ready[env_idx, node])} for node in placed}
@@ -0,0 +1,132 @@
+import json
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from util import get_graph_json, create_graph
+from preproc import PreInput
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from modules import _engine
+from decode import load_policy
+
+class ScriptActor(nn.Module):
+    """Actor of an ActorCritic without DGL, for torch.jit.script
+
+    The SGConv layers (k=1, self loops, both sides normalized by in-degree) run as a dense normalized
+    adjacency product followed by their linear layer, then attention, mean pooling and the ACFF head.
+
+    embed(src, dst, feat) -> graph embedding [1, graph_feat_size], once per graph
+    forward(state, node_ids, graph_feat) -> actor logits [B, action_dim], before masking
+    """
+    def __init__(self, policy):
+        super(ScriptActor, self).__init__()
+        self.nnmode = policy.args.nnmode
+        self.use_graph = self.nnmode in ['ff_gnn', 'ff_gnn_attention', 'ff_transf_attention']
+        self.convs = nn.ModuleList([layer.fc for layer in policy.graph_model])
+        self.pam_attention = policy.pam_attention
+        self.transf_atten = policy.transf_atten
+        self.actor = policy.actor
+
+    @torch.jit.export
+    def embed(self, src, dst, feat):
+        num_nodes = feat.shape[0]
+        loops = torch.arange(num_nodes, device=feat.device)
+        src, dst = torch.cat([src, loops]), torch.cat([dst, loops])
+        adj = torch.zeros(num_nodes, num_nodes, dtype=feat.dtype, device=feat.device)  # adj[v, u]: edges u -> v
+        adj.index_put_((dst, src), torch.ones_like(src, dtype=feat.dtype), accumulate=True)
+        norm = adj.sum(1).clamp(min=1).pow(-0.5)
+        adj = norm.unsqueeze(1) * adj * norm.unsqueeze(0)
+        for conv in self.convs:
+            feat = conv(torch.mm(adj, feat))
+
+        if self.nnmode == 'ff_gnn_attention':
+            feat = self.pam_attention(feat.unsqueeze(0)).squeeze(0)
+        elif self.nnmode == 'ff_transf_attention':
+            feat, attn = self.transf_atten(feat.unsqueeze(1))
+            feat = feat.squeeze(1)
+        return feat.mean(0, keepdim=True)
+
+    def forward(self, state, node_ids, graph_feat):
+        node_ids = node_ids.to(state.dtype)
+        if self.use_graph:
+            return self.actor(torch.cat((state, node_ids, graph_feat.expand(state.shape[0], -1)), dim=1))
+        return self.actor(torch.cat((state, node_ids), dim=1))
+
+def export_actor(policy):
+    '''
+    script the actor of an ActorCritic in eval mode, frozen: weights inlined as constants and the graph
+    optimized once here instead of on the first calls of every mapping
+    '''
+    scripted = torch.jit.script(ScriptActor(policy.eval()).eval())
+    return torch.jit.freeze(scripted, preserved_attrs=['embed'])
+
+def check_parity(policy, scripted, graphdef, env, episodes=5):
+    '''
+    compare the scripted logits with ActorCritic.logits on the states of random episodes
+    return: max absolute logit difference
+    '''
+    graph = graphdef['graph'].to(_engine)
+    src, dst = graph.edges()
+    max_diff = 0.
+    with torch.inference_mode():
+        graph_feat = scripted.embed(src.long(), dst.long(), graph.ndata['feat'])
+        for _ in range(episodes):
+            state = env.reset()
+            for node_id in env.plan.topo_order.tolist():
+                mask = env.get_mask(node_id)
+                if not mask.any():
+                    break
+                state_t = torch.tensor(state, dtype=torch.float32, device=_engine).unsqueeze(0)
+                node_ids = torch.tensor([[node_id]], device=_engine)
+                diff = (scripted(state_t, node_ids, graph_feat) - policy.logits(state_t, graph, node_ids)).abs().max()
+                max_diff = max(max_diff, diff.item())
+                tile, spoke = np.unravel_index(np.random.choice(np.flatnonzero(mask)), (env.se.tile_count, env.se.spoke_count))
+                state, reward, done, info = env.step([node_id, tile, spoke])
+                if info['dead_end']:
+                    break
+    return max_diff
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Export the actor of a trained policy to TorchScript')
+    arg = parser.add_argument
+
+    arg('--device-topology', nargs='+', type=int, default=(16, 6), help='Device topology of Streaming Engine')
+    arg('--pipeline-depth', type=int, default=3, help='processing pipeline depth')
+    arg('--input', type=str, default='input_graphs/vectorAdd_ir.json', help='graph used for the parity check')
+    arg('--model', type=str, required=True, help='trained policy checkpoint')
+    arg('--output', type=str, default='actor_scripted.pt', help='TorchScript file')
+    arg('--tolerance', type=float, default=1e-4, help='max absolute logit difference allowed by the parity check')
+
+    # Policy, must match the checkpoint
+    arg('--nnmode', type=str, default='ff_gnn_attention', help='select nn to use as actor/critic model: simple_ff, ff_gnn, ff_gnn_attention, ff_transf_attention')
+    arg('--graph_feat_size', type=int, default=128, help='graph_feat_size')
+    arg('--emb_size', type=int, default=64, help='embedding size')
+
+    # Constraints
+    arg('--no-sibling-constr', action='store_true', help='disable sibling nodes constraint')
+    arg('--no-tm-constr', action='store_true', help='disable tile memory constraint')
+    arg('--no-sf-constr', action='store_true', help='disable sync flow constraint')
+    args = parser.parse_args()
+    args.device_topology = tuple(args.device_topology)
+    return args
+
+if __name__ == "__main__":
+    args = get_args()
+    device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+    graphdef = PreInput(args).pre_graph(create_graph(get_graph_json(args.input)), device)
+    policy = load_policy(args, graphdef, device, args.model)
+    scripted = export_actor(policy)
+
+    env = StreamingEngineEnv(args,
+                             graphdef=graphdef,
+                             tile_count=args.device_topology[0],
+                             spoke_count=args.device_topology[1],
+                             pipeline_depth=args.pipeline_depth)
+    max_diff = check_parity(policy, scripted, graphdef, env)
+    print(f'Parity check on {args.input}: max logit difference {max_diff:.2e}')
+    assert max_diff <= args.tolerance, f'Scripted actor differs from ActorCritic.logits by {max_diff}'
+
+    config = {'nnmode': args.nnmode, 'device_topology': args.device_topology, 'graph_feat_size': args.graph_feat_size}
+    torch.jit.save(scripted, args.output, _extra_files={'config.json': json.dumps(config)})
+    print(f'[INFO] Saved TorchScript actor to {args.output}')
@@ -0,0 +1,85 @@
+import heapq
+import numpy as np
+
+def critical_path_priority(plan, pipeline_depth):
+    '''
+    longest path from every node to a sink in cycles, pipeline_depth per node on the path (the node included)
+    '''
+    priority = np.zeros(plan.num_nodes, dtype=np.int64)
+    for node in plan.topo_order[::-1].tolist():
+        succs = plan.succs(node)
+        priority[node] = pipeline_depth + (priority[succs].max() if len(succs) else 0)
+    return priority
+
+def critical_path_order(plan, pipeline_depth):
+    '''
+    list scheduling order: of the nodes whose predecessors are all placed, the one with the longest path
+    to a sink first (smallest node id on ties)
+    '''
+    priority = critical_path_priority(plan, pipeline_depth)
+    preds_left = plan.pred_count.copy()
+    ready = [(-priority[node], node) for node in plan.roots.tolist()]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, node = heapq.heappop(ready)
+        order.append(node)
+        for succ in plan.succs(node).tolist():
+            preds_left[succ] -= 1
+            if preds_left[succ] == 0:
+                heapq.heappush(ready, (-priority[succ], succ))
+    return np.array(order, dtype=np.int64)
+
+def greedy_placement(env, order=None, retries=4):
+    '''
+    place the nodes of env one by one in order (critical_path_order by default) on the slice of get_mask
+    that gives them the smallest ready time
+
+    TM lookahead: slices on a tile without a free spoke left for every unplaced node of the node's TM
+    groups are only used if there is no other choice. A slice whose step makes another node unplaceable
+    (dead end) is undone from a snapshot and the next best one tried, up to retries times per node.
+
+    SA and PPO place nodes in topological order, pass order=env.plan.topo_order for their initial state
+    or demonstrations.
+    return: graph ready time and placed nodes [(node_id, tile_slice_idx)], (100, []) on a dead end
+    '''
+    plan, se = env.plan, env.se
+    if order is None:
+        order = critical_path_order(plan, se.pipeline_depth)
+    slice_tile = env.mask_engine.slice_tile
+    slice_spoke = np.tile(np.arange(se.spoke_count), se.tile_count)
+
+    env.reset()
+    place_nodes = []
+    for node_id in order.tolist():
+        slices = np.flatnonzero(env.get_mask(node_id))
+        if not len(slices):
+            return 100, []
+
+        # ready time on every feasible slice, from the last predecessor like the env
+        tile = slice_tile[slices]
+        preds = plan.preds(node_id)
+        if len(preds):
+            pred = preds[-1]
+            ready = env.node_ready[pred] + np.abs(tile - env.node_tile[pred]) + se.pipeline_depth
+        else:
+            ready = slice_spoke[slices] + se.pipeline_depth
+
+        tm_partners = plan.tm_partners(node_id)
+        tm_unplaced = np.count_nonzero(env.node_tile[tm_partners] < 0) if env.mask_engine.tm_constr else 0
+        tm_short = se.free_spokes[tile] - 1 < tm_unplaced
+        candidates = slices[np.lexsort((slices, ready, tm_short))][:retries + 1]
+
+        snapshot = env.snapshot() if len(candidates) > 1 else None
+        for k, tile_slice_idx in enumerate(candidates.tolist()):
+            if k:
+                env.restore(snapshot)
+            tile_idx, spoke_idx = divmod(tile_slice_idx, se.spoke_count)
+            _, _, done, info = env.step([node_id, tile_idx, spoke_idx])
+            if not info['dead_end']:
+                break
+        if info['dead_end']:
+            return 100, []
+        place_nodes.append((node_id, tile_slice_idx))
+
+    return env.graph_ready_time, place_nodes
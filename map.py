@@ -0,0 +1,99 @@
+import os
+import time
+import random
+import argparse
+import numpy as np
+import torch
+from util import get_graph_json, create_graph, output_json
+from preproc import PreInput
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from envs.vector_env import VectorStreamingEngineEnv
+from modules import _engine
+from decode import load_policy, quantize_policy, ScriptedPolicy, greedy_decode, sample_decode, beam_decode
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Streaming Engine mapper inference with a trained policy')
+    arg = parser.add_argument
+
+    arg('--device-topology', nargs='+', type=int, default=(16, 6), help='Device topology of Streaming Engine')
+    arg('--pipeline-depth', type=int, default=3, help='processing pipeline depth')
+    arg('--input', type=str, default='input_graphs/vectorAdd_ir.json', help='load input json from file')
+    arg('--model', type=str, required=True, help='trained policy checkpoint')
+    arg('--torchscript', action='store_true', help='--model is an actor exported by export.py')
+    arg('--quantize', action='store_true', help='map with dynamic int8 linear layers (CPU), smaller weights at some accuracy cost, not faster at these topologies')
+    arg('--output', type=str, default='', help='mapping json file, mappings/mapping_<input> by default')
+    arg('--decode', type=str, default='greedy', choices=['greedy', 'sample', 'beam'], help='most likely slice per node, best of sampled rollouts or beam search')
+    arg('--rollouts', type=int, default=16, help='number of rollouts sampled in lockstep with --decode sample')
+    arg('--beam_width', type=int, default=8, help='partial placements kept per node with --decode beam')
+    arg('--beam_expand', type=int, default=4, help='most likely slices expanded per partial placement with --decode beam')
+    arg('--beam_score', type=str, default='logprob', choices=['logprob', 'ready_time'], help='rank partial placements by accumulated log-prob or partial ready time')
+    arg('--seed', type=int, default=0, help='random seed of the sampled rollouts')
+
+    # Policy, must match the checkpoint
+    arg('--nnmode', type=str, default='ff_gnn_attention', help='select nn to use as actor/critic model: simple_ff, ff_gnn, ff_gnn_attention, ff_transf_attention')
+    arg('--graph_feat_size', type=int, default=128, help='graph_feat_size')
+    arg('--emb_size', type=int, default=64, help='embedding size')
+
+    # Constraints
+    arg('--no-sibling-constr', action='store_true', help='disable sibling nodes constraint')
+    arg('--no-tm-constr', action='store_true', help='disable tile memory constraint')
+    arg('--no-sf-constr', action='store_true', help='disable sync flow constraint')
+    args = parser.parse_args()
+    if args.quantize and args.torchscript:
+        parser.error('--quantize applies to a checkpoint, not to a --torchscript actor')
+    args.device_topology = tuple(args.device_topology)
+    return args
+
+def map_graph(args, policy, graphdef):
+    '''
+    decode a placement of graphdef with the policy
+    return: placed nodes and graph ready time, (None, inf) if no complete placement was found
+    '''
+    graph = graphdef['graph'].to(_engine)
+    with torch.inference_mode():
+        if args.decode == 'greedy':
+            env = StreamingEngineEnv(args,
+                                     graphdef=graphdef,
+                                     tile_count=args.device_topology[0],
+                                     spoke_count=args.device_topology[1],
+                                     pipeline_depth=args.pipeline_depth)
+            return greedy_decode(policy, env, graph)
+        env = VectorStreamingEngineEnv(args,
+                                       graphdef=graphdef,
+                                       num_envs=args.rollouts if args.decode == 'sample' else 1,  # beam_decode grows its beams
+                                       tile_count=args.device_topology[0],
+                                       spoke_count=args.device_topology[1],
+                                       pipeline_depth=args.pipeline_depth)
+        if args.decode == 'beam':
+            return beam_decode(policy, env, graph, args.beam_width, args.beam_expand, args.beam_score)
+        return sample_decode(policy, env, graph)
+
+if __name__ == "__main__":
+    args = get_args()
+    torch.manual_seed(args.seed)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+
+    device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+    start = time.perf_counter()
+    graphdef = PreInput(args).pre_graph(create_graph(get_graph_json(args.input)), device)
+    policy = ScriptedPolicy(args.model) if args.torchscript else load_policy(args, graphdef, device, args.model)
+    if args.quantize:
+        policy = quantize_policy(policy)
+    loaded = time.perf_counter()
+    placed_nodes, ready_time = map_graph(args, policy, graphdef)
+    end = time.perf_counter()
+    print(f'[INFO] Loaded graph and policy in {1e3 * (loaded - start):.1f}ms, mapped in {1e3 * (end - loaded):.1f}ms')
+
+    if placed_nodes is None:
+        print(f'No complete placement found for {args.input}')
+    else:
+        print(f'Graph ready time: {ready_time}')
+        out_file_name = args.output or f'mappings/mapping_{os.path.basename(args.input)}'
+        os.makedirs(os.path.dirname(out_file_name) or '.', exist_ok=True)
+        output_json(placed_nodes,
+                    no_of_tiles=args.device_topology[0],
+                    spoke_count=args.device_topology[1],
+                    out_file_name=out_file_name)
+        print(f'[INFO] Saved mapping to {out_file_name}')
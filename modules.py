@@ -18,25 +18,72 @@ _engine = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 torch.manual_seed(0)
 
 class RolloutBuffer:
-    def __init__(self):
-        self.actions = []
-        self.states = []
+    """Preallocated rollout storage, capacity doubles when full
+
+    States hold node indexes (-1 for free slices) and are stored as int16, masks as bool.
+    Every transition refers to its graph by index in self.graphs, the distinct graphs of the rollout.
+    Fields are read as views of the first len(buffer) rows: buffer.states, buffer.rewards, ...
+    """
+    _fields = {'states': torch.int16, 'actions': torch.long, 'logprobs': torch.float32, 'rewards': torch.float32,
+               'is_terminals': torch.bool, 'masks': torch.bool, 'node_ids': torch.long, 'graph_idx': torch.long}
+
+    def __init__(self, capacity=1024, device='cpu'):
+        self.capacity = capacity
+        self.device = device
+        self.size = 0
+        self._data = None
         self.graphs = []
-        self.logprobs = []
-        self.rewards = []
-        self.is_terminals = []
-        self.masks = []
-        self.node_ids = []
+        self._graph_ids = {}
+
+    def __len__(self):
+        return self.size
+
+    def __getattr__(self, name):
+        if name in RolloutBuffer._fields:
+            if self._data is None:
+                return torch.zeros(0, dtype=RolloutBuffer._fields[name])
+            return self._data[name][:self.size]
+        raise AttributeError(name)
+
+    def _reserve(self, count, state_dim, action_dim):
+        if self._data is None:
+            shapes = {'states': (state_dim,), 'masks': (action_dim,), 'node_ids': (1,)}
+            self._data = {name: torch.zeros((self.capacity,) + shapes.get(name, ()), dtype=dtype, device=self.device)
+                          for name, dtype in RolloutBuffer._fields.items()}
+        if self.size + count > self.capacity:
+            while self.size + count > self.capacity:
+                self.capacity *= 2
+            for name, data in self._data.items():
+                grown = data.new_zeros((self.capacity,) + data.shape[1:])
+                grown[:self.size] = data[:self.size]
+                self._data[name] = grown
+
+    def graph_index(self, graph):
+        cached = self._graph_ids.get(id(graph))
+        if cached is None:
+            self.graphs.append(graph)
+            cached = self._graph_ids[id(graph)] = len(self.graphs) - 1
+        return cached
+
+    def add(self, state, action, graph, logprob, mask, node_id, reward, done):
+        """Append T transitions of one graph, state/mask [T, dim] and the other fields [T]"""
+        count = state.shape[0]
+        self._reserve(count, state.shape[1], mask.shape[1])
+        rows = slice(self.size, self.size + count)
+        self._data['states'][rows] = state.to(self.device)
+        self._data['actions'][rows] = action.reshape(count).to(self.device)
+        self._data['logprobs'][rows] = logprob.reshape(count).to(self.device)
+        self._data['rewards'][rows] = torch.as_tensor(reward, dtype=torch.float32).reshape(count)
+        self._data['is_terminals'][rows] = torch.as_tensor(done, dtype=torch.bool).reshape(count)
+        self._data['masks'][rows] = mask.to(self.device)
+        self._data['node_ids'][rows] = node_id.reshape(count, 1).to(self.device)
+        self._data['graph_idx'][rows] = self.graph_index(graph)
+        self.size += count
 
     def clear(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.graphs[:]
-        del self.logprobs[:]
-        del self.rewards[:]
-        del self.is_terminals[:]
-        del self.masks[:]
-        del self.node_ids[:]
+        self.size = 0
+        self.graphs = []
+        self._graph_ids = {}
 
 # From https://boring-guy.sh/posts/masking-rl/
 class CategoricalMasked(Categorical):
@@ -123,7 +170,7 @@ class TransformerEncode(nn.Module):
             state['activation'] = F.relu
         super(TransformerEncode, self).__setstate__(state)
 
-    def forward(self, src, src_mask = None, src_key_padding_mask = None):
+    def forward(self, src, src_mask: Optional[torch.Tensor] = None, src_key_padding_mask: Optional[torch.Tensor] = None):
         src2, attn = self.self_attn(src, src, src, attn_mask=src_mask,
                               key_padding_mask=src_key_padding_mask)
         src = src + self.dropout1(src2)
@@ -145,10 +192,10 @@ class TransformerAttentionModel(nn.Module):
         mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
         return mask
 
-    def forward(self, src, src_mask=None):
+    def forward(self, src, src_mask: Optional[torch.Tensor] = None, src_key_padding_mask: Optional[torch.Tensor] = None):
         src = self.pos_encoder(src)
-        tmp, attn = self.encoder_layer1(src)
-        output, _ = self.encoder_layer1(tmp)
+        tmp, attn = self.encoder_layer1(src, src_key_padding_mask=src_key_padding_mask)
+        output, _ = self.encoder_layer1(tmp, src_key_padding_mask=src_key_padding_mask)
         return output, attn
 
 
@@ -161,12 +208,17 @@ class PAM_ModuleM(nn.Module):
         self.value_conv = nn.Conv1d(in_channels=in_dim, out_channels=in_dim, kernel_size=1)
         self.gamma = nn.Parameter(torch.zeros(1))
         self.softmax = nn.Softmax(dim=-1)
-    def forward(self, x):
+    def forward(self, x, mask: Optional[torch.Tensor] = None):
+        # mask: [B, N] valid positions when x holds padded sequences
         x = x.permute(0, 2, 1)
         proj_query = self.query_conv(x).permute(0, 2, 1)
         proj_key = self.key_conv(x)
         energy = torch.bmm(proj_query, proj_key)
+        if mask is not None:
+            energy = energy.masked_fill(~mask[:, None, :], float('-inf'))
         attention = self.softmax(energy)
+        if mask is not None:
+            attention = attention * mask[:, :, None]  # Padded positions don't contribute
         proj_value = self.value_conv(x)
         out = torch.bmm(proj_value, attention)
         out = self.gamma * out + x
@@ -271,63 +323,105 @@ class ActorCritic(nn.Module):
             self.actor = ACFF(state_dim+graph_feat_size, emb_size, action_dim, mode='soft')  # earlier: state_dim+graph_feat_size
             self.critic = ACFF(state_dim+graph_feat_size, emb_size, 1, mode='')
 
+        # Graph embeddings computed by act, keyed by (graph identity, policy version)
+        self.policy_version = 0
+        self._graph_cache = {}
+
     def forward(self):
         raise NotImplementedError
 
-    def act(self, state, graph_info, node_id_or_ids, mask):
-
+    def load_state_dict(self, *args, **kwargs):
+        self.invalidate_graph_cache()  # New weights, cached graph embeddings are stale
+        return super(ActorCritic, self).load_state_dict(*args, **kwargs)
+
+    def invalidate_graph_cache(self):
+        """Drop cached graph embeddings, needed whenever the weights change (load_state_dict does it)"""
+        self.policy_version += 1
+        self._graph_cache.clear()
+
+    def batch_graphs(self, graphs):
+        """dgl.batch of graphs with self loops, the input of graph_embedding"""
+        return dgl.batch([dgl.add_self_loop(graph) for graph in graphs], ndata=['feat'], edata=[])
+
+    def graph_embedding(self, graph):
+        """Pooled embeddings [num_graphs, graph_feat_size] of a batch of graphs with self loops"""
+        graph_feat = graph.ndata['feat']
+        for layer in self.graph_model:
+            graph_feat = layer(graph, graph_feat)
+
+        if self.args.nnmode == 'ff_gnn_attention' or self.args.nnmode == 'ff_transf_attention':
+            # Attention within each graph: nodes padded to [num_graphs, max nodes, feat]
+            num_nodes = graph.batch_num_nodes()
+            valid = torch.arange(int(num_nodes.max()), device=num_nodes.device)[None, :] < num_nodes[:, None]
+            padded = graph_feat.new_zeros(valid.shape + graph_feat.shape[-1:])
+            padded[valid] = graph_feat
+            if self.args.nnmode == 'ff_gnn_attention':
+                padded = self.pam_attention(padded, valid) # attention module
+                # graph_feat = self.cam_attention(graph_feat.unsqueeze(0)).squeeze(0)
+            else:
+                padded, attn = self.transf_atten(padded.transpose(0, 1), src_key_padding_mask=~valid)
+                padded = padded.transpose(0, 1)
+            graph_feat = padded[valid]
+
+        return self.graph_avg_pool(graph, graph_feat)
+
+    def cached_graph_embedding(self, graph_info):
+        """graph_embedding of one graph computed once per policy version, only cached outside autograd
+
+        The cached embedding is computed in eval mode (no transformer dropout) and the training mode restored:
+        a dropout sample would otherwise be frozen and reused by every act() of the policy version.
+        """
+        if torch.is_grad_enabled():
+            return self.graph_embedding(self.batch_graphs([graph_info]))
+        key = (id(graph_info), self.policy_version)
+        cached = self._graph_cache.get(key)
+        if cached is None or cached[0] is not graph_info:  # Keep the graph so its id can't be reused
+            training = self.training
+            self.eval()
+            try:
+                graph_feat = self.graph_embedding(self.batch_graphs([graph_info]))
+            finally:
+                self.train(training)
+            cached = self._graph_cache[key] = (graph_info, graph_feat)
+        return cached[1]
+
+    def logits(self, state, graph_info, node_id_or_ids):
+        """Actor logits over the tile slices, before masking"""
         state = torch.atleast_2d(state)
 
         if (self.args.nnmode == 'ff_gnn' or
             self.args.nnmode == 'ff_gnn_attention' or
             self.args.nnmode == 'ff_transf_attention'):
 
-            graph = dgl.add_self_loop(graph_info)
-            graph_feat = graph.ndata['feat']
-            for layer in self.graph_model:
-                graph_feat = layer(graph, graph_feat)
-
-            if self.args.nnmode == 'ff_gnn_attention':
-                graph_feat = self.pam_attention(graph_feat.unsqueeze(0)).squeeze(0) # attention module
-                # graph_feat = self.cam_attention(graph_feat.unsqueeze(0)).squeeze(0)
-            if self.args.nnmode == 'ff_transf_attention':
-                graph_feat, attn = self.transf_atten(graph_feat.unsqueeze(1))
-                # graph_feat = graph_feat[0]#.squeeze(1)
-
-            graph_feat = self.graph_avg_pool(graph, graph_feat)
+            graph_feat = self.cached_graph_embedding(graph_info)
+            graph_feat = graph_feat.broadcast_to(state.shape[0], -1)  # Same graph for a batch of states
             state = torch.cat((state, node_id_or_ids, graph_feat), dim=1)# Add node id and graph embedding
         else:
             state = torch.cat((state, node_id_or_ids), dim=1) # Add node id
 
-        logits = self.actor(state)
+        return self.actor(state)
+
+    def act(self, state, graph_info, node_id_or_ids, mask):
+        logits = self.logits(state, graph_info, node_id_or_ids)
         dist = CategoricalMasked(logits=logits, mask=mask)
         action = dist.sample() # flattened index of a tile slice coord
         action_logprob = dist.log_prob(action)
         return action.detach(), action_logprob.detach()
 
-    def evaluate(self, state, action, graph_info, mask, node_id_or_ids=None):
+    def evaluate(self, state, action, graph_info, mask, node_id_or_ids=None, graph_idx=None):
+        """graph_info: batch_graphs() of the distinct graphs of the transitions,
+        graph_idx: [B] index in graph_info of the graph of every transition, all the first graph if None"""
         state = torch.atleast_2d(state)
 
         if (self.args.nnmode == 'ff_gnn' or
             self.args.nnmode == 'ff_gnn_attention' or
             self.args.nnmode == 'ff_transf_attention'):
 
-            graph = graph_info[0]
-            graph = dgl.add_self_loop(graph)
-            graph_feat = graph.ndata['feat']
-            for layer in self.graph_model:
-                graph_feat = layer(graph, graph_feat)
-
-            if self.args.nnmode == 'ff_gnn_attention':
-                graph_feat = self.pam_attention(graph_feat.unsqueeze(0)).squeeze(0) # attention module
-                # graph_feat = self.cam_attention(graph_feat.unsqueeze(-1)).squeeze(-1)
-
-            if self.args.nnmode == 'ff_transf_attention':
-                graph_feat, attn0, attn1 = self.transf_atten(graph_feat.unsqueeze(1))
-                # graph_feat = graph_feat[0]
-
-            graph_feat = self.graph_avg_pool(graph, graph_feat)
-            gnn_feat = graph_feat.broadcast_to(state.shape[0], -1)
+            graph_feat = self.graph_embedding(graph_info)  # Every graph embedded once
+            if graph_idx is None:
+                gnn_feat = graph_feat[0].broadcast_to(state.shape[0], -1)
+            else:
+                gnn_feat = graph_feat[graph_idx]
 
             state = torch.cat((state, node_id_or_ids, gnn_feat), dim=1)  # Add node id and graph embedding
         else:
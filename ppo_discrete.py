@@ -1,13 +1,120 @@
 
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 
 torch.manual_seed(0)
 _engine = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 from modules import RolloutBuffer, ActorCritic
 
-class PPO:
+def _episodes(dones):
+    '''
+    split transitions in episodes ending after a done
+    return: episode and position in the episode of every transition, [episodes, max length] shape
+    '''
+    starts = np.flatnonzero(np.r_[True, dones[:-1]])
+    lengths = np.diff(np.r_[starts, len(dones)])
+    episode = np.repeat(np.arange(len(starts)), lengths)
+    position = np.arange(len(dones)) - starts[episode]
+    return episode, position, (len(starts), lengths.max())
+
+def discounted_returns(rewards, dones, gamma):
+    '''
+    discounted return of every transition, reset after each done
+    reverse scan over the time steps of all episodes at once
+    '''
+    episode, position, shape = _episodes(dones)
+    padded = np.zeros(shape)
+    padded[episode, position] = rewards
+    running = np.zeros(shape[0])
+    for t in reversed(range(shape[1])):
+        running = padded[:, t] + gamma * running
+        padded[:, t] = running
+    return padded[episode, position]
+
+def gae(rewards, values, dones, gamma, lam):
+    '''
+    generalized advantage estimation, the value after the last transition of an episode is 0
+    return: advantages, returns (advantages + values)
+    '''
+    episode, position, shape = _episodes(dones)
+    padded_rewards, padded_values = np.zeros(shape), np.zeros((shape[0], shape[1] + 1))
+    padded_rewards[episode, position] = rewards
+    padded_values[episode, position] = values
+    advantages = np.zeros(shape)
+    running = np.zeros(shape[0])
+    for t in reversed(range(shape[1])):
+        delta = padded_rewards[:, t] + gamma * padded_values[:, t + 1] - padded_values[:, t]
+        running = delta + gamma * lam * running
+        advantages[:, t] = running
+    advantages = advantages[episode, position]
+    return advantages, advantages + values
+
+def actor_critic(args, graphdef, device, state_dim, ntasks=1):
+    '''
+    ActorCritic for the graphs of graphdef (node feature width) on the device topology, on _engine
+    '''
+    return ActorCritic(args=args,
+                       device=device,
+                       state_dim=state_dim,
+                       emb_size=args.emb_size,
+                       action_dim=device['action_dim'],
+                       graph_feat_size=args.graph_feat_size,
+                       gnn_in=graphdef['graph'].ndata['feat'].shape[1],
+                       ntasks=ntasks).to(_engine)
+
+class RolloutPolicy:
+    """Acting side of PPO: samples actions with policy_old and stores the transitions in a rollout buffer
+
+    Actor processes (actor_learner.py) use it alone: they only collect episodes and need neither the
+    trained policy nor its optimizer.
+    """
+    def __init__(self, policy_old):
+        self.policy_old = policy_old
+        self.buffer = RolloutBuffer(device=_engine)
+        self._device_graphs = {}
+
+    def select_action(self, tensor_in, graphdef, node_id, mask):
+        """Sample a tile slice for node_id, tensor_in/mask can hold a batch of states to sample one action per row"""
+        with torch.no_grad():
+            graph_info = self.device_graph(graphdef['graph'])
+            state = torch.tensor(tensor_in, dtype=torch.float32).to(_engine)
+            mask = torch.tensor(mask, dtype=torch.bool).to(_engine)
+            node_id = torch.atleast_2d(torch.tensor(node_id)).to(_engine)
+            if state.dim() == 2:  # batch of states, same node in every row
+                node_id = node_id.expand(state.shape[0], 1)
+            action, action_logprob = self.policy_old.act(state, graph_info, node_id, mask)
+
+        action_idx = action.cpu().numpy() if state.dim() == 2 else action.item()
+        return action_idx, (state, action, graph_info, action_logprob, mask, node_id)
+
+    def device_graph(self, graph):
+        """graph on the policy device, moved once: dgl .to() returns a new graph on every call
+        and the policy caches graph embeddings by graph identity"""
+        cached = self._device_graphs.get(id(graph))
+        if cached is None or cached[0] is not graph:
+            cached = self._device_graphs[id(graph)] = (graph, graph.to(_engine))
+        return cached[1]
+
+    def add_buffer(self, inbuff, reward, done):
+        state, action, graph_info, action_logprob, mask, node_id = inbuff
+        self.buffer.add(state.reshape(1, -1), action, graph_info, action_logprob, mask.reshape(1, -1), node_id, reward, done)
+
+    def add_buffer_batch(self, steps):
+        """Add batched transitions [(inbuff, reward[B], done[B], active[B]), ...] of B lockstep episodes,
+        one episode after the other, only the steps where the episode is active"""
+        inbuffs, rewards, dones, active = zip(*steps)
+        state, action, graph_info, action_logprob, mask, node_id = zip(*inbuffs)
+        keep = torch.as_tensor(np.stack(active, axis=1).reshape(-1))
+        def episodes(x):  # [T, B, ...] -> [B * T, ...] active steps
+            x = torch.stack([torch.as_tensor(t) for t in x], dim=1)
+            return x.reshape((-1,) + x.shape[2:])[keep.to(x.device)]
+        self.buffer.add(episodes(state), episodes(action), graph_info[0], episodes(action_logprob), episodes(mask),
+                        episodes(node_id), episodes(rewards), episodes(dones))
+
+class PPO(RolloutPolicy):
     def __init__(self,
                  args,
                  graphdef,
@@ -22,114 +129,140 @@ class PPO:
         self.state_dim = state_dim  # Input ready time (Number of tiles slices, 1)
         self.action_dim = device['action_dim'] #output (nodes, 48)
         self.gnn_in = graphdef['graph'].ndata['feat'].shape[1]
-        self.buffer = RolloutBuffer()
         self.ntokens = args.device_topology
 
-        self.policy = ActorCritic(args=args,
-                                  device=device,
-                                  state_dim=self.state_dim,
-                                  emb_size=self.args.emb_size,
-                                  action_dim=self.action_dim,
-                                  graph_feat_size=self.args.graph_feat_size,
-                                  gnn_in=self.gnn_in,
-                                  ntasks=ntasks).to(_engine)
+        self.policy = actor_critic(args, graphdef, device, state_dim, ntasks)
         self.optimizer = torch.optim.Adam(self.policy.parameters(), lr=self.args.lr, betas=self.args.betas)
 
-        self.policy_old = ActorCritic(args=args,
-                                      device=device,
-                                      state_dim=self.state_dim,
-                                      emb_size=self.args.emb_size,
-                                      action_dim=self.action_dim,
-                                      graph_feat_size=self.args.graph_feat_size,
-                                      gnn_in=self.gnn_in,
-                                      ntasks=ntasks).to(_engine)
+        super().__init__(actor_critic(args, graphdef, device, state_dim, ntasks))
         self.policy_old.load_state_dict(self.policy.state_dict())
         if args.model != '':
             self.load(args.model)
 
         self.MseLoss = nn.MSELoss()
 
-    def select_action(self, tensor_in, graphdef, node_id, mask):
-        with torch.no_grad():
-            graph_info = graphdef['graph'].to(_engine)
-            state = torch.FloatTensor(tensor_in).to(_engine)
-            mask = torch.tensor(mask, dtype=torch.bool).to(_engine)
-            node_id = torch.atleast_2d(torch.tensor(node_id)).to(_engine)
-            action, action_logprob = self.policy_old.act(state, graph_info, node_id, mask)
-
-        return action.item(), (state, action, graph_info, action_logprob, mask, node_id)
-
-    def add_buffer(self, inbuff, reward, done):
-        state, action, graph_info, action_logprob, mask, node_id = inbuff
-        self.buffer.states.append(state)
-        self.buffer.actions.append(action)
-        self.buffer.graphs.append(graph_info)
-        self.buffer.logprobs.append(action_logprob)
-        self.buffer.rewards.append(reward)
-        self.buffer.is_terminals.append(done)
-        self.buffer.masks.append(mask)
-        self.buffer.node_ids.append(node_id)
-
-
     def update(self):
-        # Monte Carlo estimate of rewards:
-        rewards = []
-        discounted_reward = 0
-        for reward, is_terminal in zip(reversed(self.buffer.rewards), reversed(self.buffer.is_terminals)):
-            if is_terminal:
-                discounted_reward = 0
-            discounted_reward = reward + (self.args.gamma * discounted_reward)
-            rewards.insert(0, discounted_reward)
-
-        # Normalizing the rewards:
-        rewards = torch.tensor(rewards, dtype=torch.float32).to(_engine)
-        rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-7)
-        # rewards = rewards.float().squeeze()
+        buffer_rewards = self.buffer.rewards.cpu().numpy().astype(np.float64)
+        buffer_dones = self.buffer.is_terminals.cpu().numpy()
 
         # convert list to tensor
         old_masks = 0  # Used in transformer mode
-        old_masks = torch.squeeze(torch.stack(self.buffer.masks, dim=0)).detach().to(_engine)
-        old_states = torch.squeeze(torch.stack(self.buffer.states, dim=0)).detach().to(_engine)
-        old_graph = [graph.to(_engine) for graph in self.buffer.graphs]
-        old_actions = torch.squeeze(torch.stack(self.buffer.actions, dim=0)).detach().to(_engine)
-        old_logprobs = torch.squeeze(torch.stack(self.buffer.logprobs, dim=0)).detach().to(_engine)
-        old_node_ids = torch.vstack(self.buffer.node_ids).detach().to(_engine)
+        old_masks = self.buffer.masks
+        old_states = self.buffer.states.float()
+        # Distinct graphs of the buffer batched once, every transition points to its graph
+        old_graph_idx = self.buffer.graph_idx
+        old_graph = self.policy.batch_graphs(self.buffer.graphs)
+        old_actions = self.buffer.actions
+        old_logprobs = self.buffer.logprobs
+        old_node_ids = self.buffer.node_ids
+
+        if getattr(self.args, 'use_gae', False):
+            # Advantages bootstrapped from the critic before the update, critic regresses the returns
+            with torch.no_grad():
+                _, values, _ = self.policy.evaluate(old_states, old_actions, old_graph, old_masks, old_node_ids, old_graph_idx)
+            advantages, rewards = gae(buffer_rewards, values.squeeze(-1).cpu().numpy(), buffer_dones,
+                                      self.args.gamma, self.args.gae_lambda)
+            advantages = torch.tensor(advantages, dtype=torch.float32).to(_engine)
+            advantages = (advantages - advantages.mean()) / (advantages.std() + 1e-7)
+            rewards = torch.tensor(rewards, dtype=torch.float32).to(_engine)
+        else:
+            # Monte Carlo estimate of rewards:
+            rewards = discounted_returns(buffer_rewards, buffer_dones, self.args.gamma)
+
+            # Normalizing the rewards:
+            rewards = torch.tensor(rewards, dtype=torch.float32).to(_engine)
+            rewards = (rewards - rewards.mean()) / (rewards.std() + 1e-7)
+            # rewards = rewards.float().squeeze()
+            advantages = None  # From the critic at every epoch
+
+        num_steps = len(self.buffer)
+        minibatch_size = getattr(self.args, 'minibatch_size', 0)
+        num_minibatches = -(-num_steps // minibatch_size) if 0 < minibatch_size < num_steps else 1
+        distributed = dist.is_available() and dist.is_initialized()
+        if distributed:  # Ranks hold different numbers of steps, but must take the same number of optimizer steps
+            count = torch.tensor(num_minibatches)
+            dist.all_reduce(count, op=dist.ReduceOp.MIN)
+            num_minibatches = int(count)
 
         # Optimize policy for K epochs
         for _ in range(self.args.K_epochs):
-
-            # Evaluating old actions and values
-            if self.args.nnmode == 'transformer':
-                logprobs, state_values, dist_entropy = self.policy.evaluate_seq((old_states, old_masks), old_actions, old_graph)
+            if num_minibatches == 1:
+                minibatches = [slice(None)]  # Full batch
+            elif distributed:
+                minibatches = torch.randperm(num_steps, device=_engine).tensor_split(num_minibatches)
             else:
-                logprobs, state_values, dist_entropy = self.policy.evaluate(old_states, old_actions, old_graph, old_masks, old_node_ids)
+                minibatches = torch.randperm(num_steps, device=_engine).split(minibatch_size)
 
-            # match state_values tensor dimensions with rewards tensor
-            state_values = torch.squeeze(state_values)
+            for idx in minibatches:
+                # Evaluating old actions and values
+                if self.args.nnmode == 'transformer':
+                    logprobs, state_values, dist_entropy = self.policy.evaluate_seq((old_states[idx], old_masks[idx]), old_actions[idx], old_graph)
+                else:
+                    logprobs, state_values, dist_entropy = self.policy.evaluate(old_states[idx], old_actions[idx], old_graph,
+                                                                                old_masks[idx], old_node_ids[idx], old_graph_idx[idx])
 
-            # Finding the ratio (pi_theta / pi_theta__old)
-            ratios = torch.exp(logprobs - old_logprobs.detach())
+                # match state_values tensor dimensions with rewards tensor
+                state_values = state_values.squeeze(-1)
 
-            # Finding Surrogate Loss
-            advantages = rewards - state_values.detach()
-            surr1 = ratios * advantages
-            surr2 = torch.clamp(ratios, 1-self.args.eps_clip, 1+self.args.eps_clip) * advantages
-            loss = -torch.min(surr1, surr2) + \
-                   + self.args.loss_value_c*self.MseLoss(state_values, rewards) + \
-                   - self.args.loss_entropy_c*dist_entropy
+                # Finding the ratio (pi_theta / pi_theta__old)
+                ratios = torch.exp(logprobs - old_logprobs[idx].detach())
 
-            # take gradient step
-            self.optimizer.zero_grad()
-            loss.mean().backward()
-            self.optimizer.step()
+                # Finding Surrogate Loss
+                if advantages is None:
+                    mb_advantages = rewards[idx] - state_values.detach()
+                else:
+                    mb_advantages = advantages[idx]
+                surr1 = ratios * mb_advantages
+                surr2 = torch.clamp(ratios, 1-self.args.eps_clip, 1+self.args.eps_clip) * mb_advantages
+                loss = -torch.min(surr1, surr2) + \
+                       + self.args.loss_value_c*self.MseLoss(state_values, rewards[idx]) + \
+                       - self.args.loss_entropy_c*dist_entropy
+
+                # take gradient step
+                self.optimizer.zero_grad()
+                loss.mean().backward()
+                if distributed:
+                    self.all_reduce_grads()
+                self.optimizer.step()
 
-        # Copy new weights into old policy
+        # Copy new weights into old policy, drops its cached graph embeddings
         self.policy_old.load_state_dict(self.policy.state_dict())
 
         # clear buffer
         self.buffer.clear()
 
 
+    def imitate(self, demos, epochs):
+        """Warm start: maximize the log-likelihood of the actions of a RolloutBuffer of demonstrations
+        (rewards unused) for epochs full batch steps, then copy the weights into the old policy"""
+        graph = self.policy.batch_graphs(demos.graphs)
+        states = demos.states.float()
+        for _ in range(epochs):
+            logprobs, _, _ = self.policy.evaluate(states, demos.actions, graph, demos.masks, demos.node_ids, demos.graph_idx)
+            loss = -logprobs.mean()
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+        self.policy_old.load_state_dict(self.policy.state_dict())
+        return loss.item()
+
+    def all_reduce_grads(self):
+        """Average the policy gradients over the ranks of the default process group, in one flat all-reduce"""
+        params = [param for param in self.policy.parameters() if param.requires_grad]
+        flat = torch.cat([(param.grad if param.grad is not None else torch.zeros_like(param)).reshape(-1)
+                          for param in params])
+        dist.all_reduce(flat)
+        flat /= dist.get_world_size()
+        for param, grad in zip(params, flat.split([param.numel() for param in params])):
+            if param.grad is not None:
+                param.grad.copy_(grad.view_as(param))
+
+    def broadcast_parameters(self, src=0):
+        """Copy the policy weights of rank src to every rank, policy_old included"""
+        for tensor in self.policy.state_dict().values():
+            dist.broadcast(tensor, src)
+        self.policy_old.load_state_dict(self.policy.state_dict())
+
     def save(self, checkpoint_path):
         torch.save(self.policy_old.state_dict(), checkpoint_path)
 
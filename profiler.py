@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import cProfile
+from contextlib import nullcontext
+import torch
+
+class _Phase:
+    __slots__ = ('total', 'calls', '_start')
+
+    def __init__(self):
+        self.total = 0.
+        self.calls = 0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.total += time.perf_counter() - self._start
+        self.calls += 1
+
+class PhaseTimer:
+    """Cumulative wall-clock time and call count per phase of the training loop
+
+    with timer.phase('get_mask'):
+        mask = env.get_mask(node_id)
+
+    When disabled, phase() returns a shared no-op context so the loop runs at full speed.
+    """
+    _noop = nullcontext()
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+        self.start = time.perf_counter()
+
+    def phase(self, name):
+        if not self.enabled:
+            return self._noop
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = _Phase()
+        return phase
+
+    def summary(self):
+        '''
+        return: dict phase -> calls, total seconds, mean microseconds per call, share of the wall time
+        '''
+        wall = time.perf_counter() - self.start
+        summary = {name: {'calls': phase.calls,
+                          'total_s': phase.total,
+                          'mean_us': 1e6 * phase.total / max(phase.calls, 1),
+                          'share': phase.total / wall}
+                   for name, phase in sorted(self.phases.items(), key=lambda p: -p[1].total)}
+        return {'wall_s': wall, 'phases': summary}
+
+    def log(self, writer, step):
+        if not self.enabled:
+            return
+        for name, phase in self.phases.items():
+            writer.add_scalar(f'Profile/{name} total (s)', phase.total, step)
+            writer.add_scalar(f'Profile/{name} per call (us)', 1e6 * phase.total / max(phase.calls, 1), step)
+
+    def save(self, path):
+        '''
+        print the phase table and save the summary as json
+        '''
+        summary = self.summary()
+        print(f'\n{"phase":<16}{"calls":>10}{"total s":>10}{"us/call":>10}{"share":>8}')
+        for name, stats in summary['phases'].items():
+            print(f'{name:<16}{stats["calls"]:>10}{stats["total_s"]:>10.2f}{stats["mean_us"]:>10.1f}{stats["share"]:>8.1%}')
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f'[INFO] Saved profile summary to {path}')
+
+NO_TIMER = PhaseTimer(enabled=False)
+
+class TraceWindow:
+    """Run torch.profiler or cProfile over episodes [start, start + length) of the training loop
+
+    The trace is saved to out_dir: a chrome trace (torch) or pstats file (cprofile).
+    """
+    def __init__(self, kind, start, length, out_dir):
+        assert kind in ['torch', 'cprofile'], 'trace kind must be either "torch" or "cprofile"'
+        self.kind = kind
+        self.start = start
+        self.end = start + length
+        self.out_dir = out_dir
+        self.profiler = None
+        self.done = False
+
+    def step(self, episode):
+        '''
+        call once per iteration of the training loop with the current episode
+        '''
+        if self.done:
+            return
+        if self.profiler is None and episode >= self.start:
+            if self.kind == 'torch':
+                activities = [torch.profiler.ProfilerActivity.CPU]
+                if torch.cuda.is_available():
+                    activities.append(torch.profiler.ProfilerActivity.CUDA)
+                self.profiler = torch.profiler.profile(activities=activities)
+                self.profiler.start()
+            else:
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+        elif self.profiler is not None and episode >= self.end:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None or self.done:
+            return
+        self.done = True
+        os.makedirs(self.out_dir, exist_ok=True)
+        if self.kind == 'torch':
+            self.profiler.stop()
+            path = os.path.join(self.out_dir, 'trace.json')
+            self.profiler.export_chrome_trace(path)
+        else:
+            self.profiler.disable()
+            path = os.path.join(self.out_dir, 'trace.prof')
+            self.profiler.dump_stats(path)
+        print(f'\n[INFO] Saved {self.kind} trace to {path}')
@@ -11,21 +11,28 @@
 
 from random import randint
 from random import random
+from random import getstate, setstate
 from math import exp
 from math import log
-from train_alt import get_nodes_rand
+from util import get_nodes_rand, play_placement, output_json
 from collections import deque
 from tqdm import tqdm
 import time
+import pickle
 import numpy as np
 
 #--- MAIN ---------------------------------------------------------------------+
 
 class minimize():
     '''Simple Simulated Annealing
+
+    The constructor draws the initial placement (or plays init_state, e.g. from greedy.greedy_placement), step(n) runs n annealing steps and run(time_budget)
+    anneals until the cooling schedule ends or the time budget is spent, so the search can be stopped
+    and resumed. state_dict()/load_state_dict() (save()/load() to a file) checkpoint it together with
+    the random number generators, best() returns the best placement found so far.
     '''
 
-    def __init__(self, args, env, graphdef, device, writer, cooling_schedule='linear', step_max=1000, t_min=0, t_max=100, bounds=[], alpha=None, damping=1):
+    def __init__(self, args, env, graphdef, device, writer, cooling_schedule='linear', step_max=1000, t_min=0, t_max=100, bounds=[], alpha=None, damping=1, snapshot_stride=1, verbose=True, init_state=None):
 
         # checks
         assert cooling_schedule in ['linear','exponential','logarithmic', 'quadratic'], 'cooling_schedule must be either "linear", "exponential", "logarithmic", or "quadratic"'
@@ -40,17 +47,27 @@ class minimize():
         self.hist = []
         self.cooling_schedule = cooling_schedule
         self.args, self.env, self.graphdef, self.device, self.writer = args, env, graphdef, device, writer
+        self.verbose = verbose
 
         self.bounds = bounds[:]
         self.damping = damping
         # current_state: vector of all nodes placed
-        # current_energy: mean(reward buf)
-        reward, nodes_place = get_nodes_rand([], self.args, self.env, self.graphdef, self.device, self.reward_buf)
+        # current_energy: graph ready time of current_state (100: no complete placement)
+        # with a process pool of envs (SubprocStreamingEngineEnv) a batch of neighbors is evaluated per step
+        self.num_neighbors = env.num_envs if hasattr(env, 'get_nodes_rand') else 1
+        # env snapshots of current_state every snapshot_stride nodes, neighbors branch from them instead of replaying
+        self.snapshot_stride = snapshot_stride
+        if self.num_neighbors == 1:
+            env.reset()
+            self.snapshots = {0: env.snapshot()}
+        reward, nodes_place = self.rand_rollouts([init_state or []])[0]
         self.current_energy, self.current_state = reward, nodes_place
+        self.snapshots = self.proposed_snapshots
 
         self.best_state = self.current_state
         self.best_energy = self.current_energy
-        print(f'INIT graph ready time yet: {self.best_energy}, {self.best_state}')
+        if self.verbose:
+            print(f'INIT graph ready time yet: {self.best_energy}, {self.best_state}')
 
         # initialize cooling schedule
         if self.cooling_schedule == 'linear':
@@ -76,21 +93,33 @@ class minimize():
         if self.cooling_schedule == 'exponential':
             if alpha == None: self.alpha =  0.8
             else: self.alpha = alpha
-            self.update_t = self.cooling_exponential
+            self.update_t = self.cooling_exponential_m
 
         if self.cooling_schedule == 'logarithmic':
             if alpha == None: self.alpha =  0.8
             else: self.alpha = alpha
-            self.update_t = self.cooling_logarithmic
+            self.update_t = self.cooling_logarithmic_m
 
 
-        # begin optimizing
-        self.step, self.accept = 1, 0
-        i_episode = 0
-        pbar = tqdm(total=self.step_max)
-        while self.step < self.step_max and self.t >= self.t_min and self.t > 0:
+        self.step_count, self.accept = 1, 0
+
+    @property
+    def done(self):
+        return not (self.step_count < self.step_max and self.t >= self.t_min and self.t > 0)
+
+    @property
+    def acceptance_rate(self):
+        return self.accept / self.step_count
+
+    def step(self, n=1):
+        '''
+        run n annealing steps, every proposed neighbor counts as a step even if its rollout failed
+        return: False once the cooling schedule is over
+        '''
+        for _ in range(n):
+            if self.done:
+                break
 
-            env.reset()
             # get neighbor
             reward, proposed_neighbor = self.get_neighbor()
 
@@ -98,53 +127,142 @@ class minimize():
             E_n = reward
             dE = E_n - self.current_energy
 
-            # determine if we should accept the current neighbor
-            if random() < self.safe_exp(-dE / self.t):
+            # determine if we should accept the current neighbor, never a failed rollout (reward 100)
+            if reward < 100 and random() < self.safe_exp(-dE / self.t):
                 self.current_energy = E_n
                 self.current_state = proposed_neighbor[:]
+                self.snapshots = self.proposed_snapshots
                 self.accept += 1
 
             # check if the current neighbor is best solution so far
             if E_n < self.best_energy:
                 self.best_energy = E_n
                 self.best_state = proposed_neighbor[:]
-                print(f'Best graph ready time yet: {self.best_energy}, {self.best_state}')
+                if self.verbose:
+                    print(f'Best graph ready time yet: {self.best_energy}, {self.best_state}')
 
-                self.writer.add_scalar('SA Best readytime/episode', self.best_energy, i_episode)
+                self.writer.add_scalar('SA Best readytime/episode', self.best_energy, self.step_count)
                 self.writer.flush()
 
-
             # persist some info for later
             self.hist.append([
-                self.step,
+                self.step_count,
                 self.t,
                 self.current_energy,
                 self.best_energy])
 
             # update some stuff
-            self.t = self.update_t(self.step)
-            if reward < 100:
-                self.step += 1
-                pbar.update(1)
-            if i_episode % self.args.log_interval == 0:
-                self.writer.add_scalar('SA Mean reward/episode', np.mean(self.reward_buf), i_episode)
+            self.t = self.update_t(self.step_count)
+            if self.step_count % self.args.log_interval == 0:
+                self.writer.add_scalar('SA Mean reward/episode', np.mean(self.reward_buf), self.step_count)
                 self.writer.flush()
-            i_episode += 1
+            self.step_count += 1
+        return not self.done
+
+    def run(self, time_budget=None):
+        '''
+        anneal until the cooling schedule ends or time_budget seconds have passed
+        return: best energy and best state
+        '''
+        deadline = time.perf_counter() + time_budget if time_budget else None
+        pbar = tqdm(total=self.step_max, initial=self.step_count)
+        while not self.done and (deadline is None or time.perf_counter() < deadline):
+            self.step()
+            pbar.update(1)
+        pbar.close()
+        return self.best_energy, self.best_state
+
+    def best(self, out_file_name=None):
+        '''
+        replay the best state found so far, saved with output_json to out_file_name if given
+        return: graph ready time of the replayed best state, placed nodes {node: {'tile_slice', 'ready_time'}}
+                (100, None if no placement completed yet)
+        '''
+        if self.best_energy >= 100:
+            return self.best_energy, None
+        if hasattr(self.env, 'play_placement'):  # process pool of envs, a single placement is played by worker 0
+            ready_time, _ = self.env.play_placement([self.best_state])[0]
+            placed_nodes = self.env.get_placed_nodes(0)
+        else:  # rollouts restore their snapshot first, replaying here doesn't disturb them
+            ready_time, _ = play_placement(self.env, self.best_state, self.args)
+            placed_nodes = {node: dict(info) for node, info in self.env.placed_nodes.items()}
+        if out_file_name:
+            output_json(placed_nodes,
+                        no_of_tiles=self.args.device_topology[0],
+                        spoke_count=self.args.device_topology[1],
+                        out_file_name=out_file_name)
+        return ready_time, placed_nodes
+
+    def set_current(self, state, energy):
+        '''
+        replace the current placement (replica exchange, resume), its snapshots are rebuilt by the next rollouts
+        '''
+        self.current_state, self.current_energy = state, energy
+        if self.num_neighbors == 1:
+            self.snapshots = {0: self.snapshots[0]}
+
+    def state_dict(self):
+        '''
+        search state: current and best placement, temperature, step, history and random number generators
+        '''
+        return {'current_state': self.current_state, 'current_energy': self.current_energy,
+                'best_state': self.best_state, 'best_energy': self.best_energy,
+                't': self.t, 'step_count': self.step_count, 'accept': self.accept, 'hist': self.hist,
+                'reward_buf': list(self.reward_buf), 'random_state': getstate(), 'np_random_state': np.random.get_state()}
+
+    def load_state_dict(self, state):
+        self.set_current(state['current_state'], state['current_energy'])
+        self.best_state, self.best_energy = state['best_state'], state['best_energy']
+        self.t, self.step_count, self.accept, self.hist = state['t'], state['step_count'], state['accept'], state['hist']
+        self.reward_buf = deque(state['reward_buf'], maxlen=100)
+        setstate(state['random_state'])
+        np.random.set_state(state['np_random_state'])
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            pickle.dump(self.state_dict(), file)
 
-        # generate some final stats
-        self.acceptance_rate = self.accept / self.step
+    def load(self, path):
+        with open(path, 'rb') as file:
+            self.load_state_dict(pickle.load(file))
 
 
     def get_neighbor(self):
         '''
         get neighbor by select a node in sequence to drop from current
-        then random place the remaining nodes
+        then random place the remaining nodes, keep the best of num_neighbors tries
         '''
-        x = randint(0, len(self.current_state))
-        cur_s = self.current_state[:x]
-        reward, next_s = get_nodes_rand(cur_s, self.args, self.env, self.graphdef, self.device, self.reward_buf)
+        prefixes = []
+        for _ in range(self.num_neighbors):
+            x = randint(0, len(self.current_state))
+            prefixes.append(self.current_state[:x])
+        reward, next_s = min(self.rand_rollouts(prefixes), key=lambda rollout: rollout[0])
         return reward, next_s
 
+    def rand_rollouts(self, prefixes):
+        '''
+        run get_nodes_rand for every prefix of current_state
+        return: list of (reward, nodes placed)
+        '''
+        if hasattr(self.env, 'get_nodes_rand'):  # process pool of envs
+            self.proposed_snapshots = None
+            return self.env.get_nodes_rand(prefixes, self.reward_buf)
+        rollouts = []
+        for cur_s in prefixes:
+            # restore the deepest snapshot inside the prefix and only replay the rest of it
+            depth = max(d for d in self.snapshots if d <= len(cur_s))
+            self.env.restore(self.snapshots[depth])
+            snapshots = {d: snapshot for d, snapshot in self.snapshots.items() if d <= depth}
+            reward, next_s = get_nodes_rand(cur_s[depth:], self.args, self.env, self.graphdef, self.device, self.reward_buf,
+                                            snapshots=snapshots, snapshot_stride=self.snapshot_stride)
+            if self.env.all_nodes_placed:
+                next_s = cur_s[:depth] + next_s
+            else:
+                snapshots = {0: self.snapshots[0]}
+            rollouts.append((reward, next_s))
+            self.proposed_snapshots = snapshots
+        return rollouts
+
 
     def results(self):
         print('+------------------------ RESULTS -------------------------+\n')
@@ -155,7 +273,7 @@ class minimize():
         print(f'  initial temp: {self.t_max}')
         print(f'    final temp: {self.t:0.6f}')
         print(f'     max steps: {self.step_max}')
-        print(f'    final step: {self.step}\n')
+        print(f'    final step: {self.step_count}\n')
 
         print(f'  final energy: {self.best_energy:0.6f}\n')
         print('+-------------------------- END ---------------------------+')
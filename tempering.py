@@ -0,0 +1,140 @@
+import time
+import random
+import multiprocessing as mp
+from math import exp
+import numpy as np
+
+import sa
+from envs.streaming_engine_env import StreamingEngineEnv
+
+class _NullWriter:
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+def _chain_worker(remote, parent_remote, args, graphdef, device, temperature, seed, snapshot_stride, init_state):
+    '''
+    one SA chain at a fixed temperature with its own env, stepped on commands from remote
+    '''
+    parent_remote.close()
+    random.seed(seed)
+    np.random.seed(seed)
+    env = StreamingEngineEnv(args,
+                             graphdef=graphdef,
+                             tile_count=args.device_topology[0],
+                             spoke_count=args.device_topology[1],
+                             pipeline_depth=args.pipeline_depth)
+    # t_min == t_max: the linear schedule keeps the chain at its temperature
+    opt = sa.minimize(args, env, graphdef, device, _NullWriter(), step_max=100000000000,
+                      t_min=temperature, t_max=temperature, snapshot_stride=snapshot_stride, verbose=False,
+                      init_state=init_state)
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'step':
+            opt.step(data)
+            remote.send((opt.current_energy, opt.current_state, opt.best_energy, opt.best_state))
+        elif cmd == 'set_current':
+            opt.set_current(*data)
+            remote.send(None)
+        elif cmd == 'best':
+            remote.send(opt.best(data))
+        elif cmd == 'close':
+            remote.close()
+            break
+
+class ParallelTempering:
+    """Replica exchange SA: one chain per temperature, each in its own process with its own env
+
+    Chains run sweep_steps SA steps at their fixed temperature, then neighboring temperatures swap their
+    current placements with the Metropolis probability min(1, exp((1/T_i - 1/T_j) * (E_i - E_j))), even and
+    odd pairs alternately, E being the graph ready time of the current placement of a chain (100 if it has none).
+    Hot chains explore, good placements they find move down to the cold chains.
+    All chains start from init_state if given, random placements otherwise.
+    """
+    def __init__(self, args, graphdef, device, writer=None, temperatures=(0.5, 1, 2, 4), sweep_steps=50, snapshot_stride=1, seed=0, init_state=None):
+        self.temperatures = sorted(temperatures)
+        self.sweep_steps = sweep_steps
+        self.writer = writer if writer is not None else _NullWriter()
+        self.sweep = 0
+        self.swaps = np.zeros(len(self.temperatures) - 1, dtype=int)
+        self.swap_attempts = np.zeros(len(self.temperatures) - 1, dtype=int)
+        self.best_energy, self.best_state, self.best_chain = 100, [], 0  # 100: no complete placement (get_nodes_rand)
+
+        self.remotes, self.processes = [], []
+        for k, temperature in enumerate(self.temperatures):
+            remote, work_remote = mp.Pipe()
+            process = mp.Process(target=_chain_worker,
+                                 args=(work_remote, remote, args, graphdef, device, temperature, seed + k, snapshot_stride, init_state),
+                                 daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+    def step(self):
+        '''
+        one sweep: sweep_steps SA steps on every chain in parallel, then a round of swaps
+        return: current energies of the chains, coldest first
+        '''
+        for remote in self.remotes:
+            remote.send(('step', self.sweep_steps))
+        chains = [remote.recv() for remote in self.remotes]
+        energies = [energy for energy, _, _, _ in chains]
+        states = [state for _, state, _, _ in chains]
+        for k, (_, _, best_energy, best_state) in enumerate(chains):
+            if best_energy < self.best_energy:
+                self.best_energy, self.best_state, self.best_chain = best_energy, best_state, k
+                print(f'Best graph ready time yet: {self.best_energy} (T={self.temperatures[k]}), {self.best_state}')
+                self.writer.add_scalar('PT Best readytime/sweep', self.best_energy, self.sweep)
+
+        # Metropolis swaps of neighboring temperatures, even pairs then odd pairs on alternate sweeps
+        swapped = []
+        for i in range(self.sweep % 2, len(self.temperatures) - 1, 2):
+            j = i + 1
+            self.swap_attempts[i] += 1
+            x = (1 / self.temperatures[i] - 1 / self.temperatures[j]) * (energies[i] - energies[j])
+            if x >= 0 or random.random() < exp(x):
+                energies[i], energies[j] = energies[j], energies[i]
+                states[i], states[j] = states[j], states[i]
+                self.swaps[i] += 1
+                swapped += [i, j]
+        for k in swapped:
+            self.remotes[k].send(('set_current', (states[k], energies[k])))
+        for k in swapped:
+            self.remotes[k].recv()
+
+        self.writer.add_scalar('PT Swap acceptance', self.swaps.sum() / max(self.swap_attempts.sum(), 1), self.sweep)
+        self.writer.flush()
+        self.sweep += 1
+        return energies
+
+    def run(self, time_budget=None, sweeps=None):
+        '''
+        run sweeps until time_budget seconds have passed or the number of sweeps is reached
+        return: best energy and best state over all chains
+        '''
+        assert time_budget or sweeps, 'parallel tempering needs a time budget or a number of sweeps'
+        deadline = time.perf_counter() + time_budget if time_budget else None
+        start = self.sweep
+        while (deadline is None or time.perf_counter() < deadline) and (sweeps is None or self.sweep - start < sweeps):
+            self.step()
+        return self.best_energy, self.best_state
+
+    def swap_rates(self):
+        return self.swaps / np.maximum(self.swap_attempts, 1)
+
+    def best(self, out_file_name=None):
+        '''
+        best placement over all chains, replayed by the chain that found it and saved with output_json if out_file_name
+        return: graph ready time of the replayed placement, placed nodes (100, None if no placement completed yet)
+        '''
+        self.remotes[self.best_chain].send(('best', out_file_name))
+        return self.remotes[self.best_chain].recv()
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
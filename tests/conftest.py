@@ -0,0 +1,46 @@
+import os
+import sys
+import glob
+import random
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from util import get_graph_json, create_graph
+import train
+
+INPUT_GRAPHS = sorted(os.path.basename(path) for path in glob.glob(os.path.join(ROOT, 'input_graphs', '*.json')))
+
+@pytest.fixture
+def args():
+    '''
+    default train.py arguments, quiet
+    '''
+    args = train.get_args(['--quiet'])
+    args.device_topology = tuple(args.device_topology)
+    return args
+
+@pytest.fixture
+def load_graph():
+    '''
+    load_graph(name): graphdef of input_graphs/name, load_graph(None, numnodes): seeded synthetic graph
+    '''
+    def load(name, numnodes=10, seed=0):
+        if name is None:
+            random.seed(seed)
+            np.random.seed(seed)
+            return create_graph(None, numnodes=numnodes)
+        return create_graph(get_graph_json(os.path.join(ROOT, 'input_graphs', name)))
+    return load
+
+@pytest.fixture
+def make_env(args):
+    '''
+    make_env(env_class, graphdef, topology, **kwargs): env_class on a tile_count x spoke_count device
+    '''
+    def make(env_class, graphdef, topology=(16, 6), **kwargs):
+        return env_class(args, graphdef=graphdef, tile_count=topology[0], spoke_count=topology[1],
+                         pipeline_depth=args.pipeline_depth, **kwargs)
+    return make
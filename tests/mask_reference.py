@@ -0,0 +1,79 @@
+import numpy as np
+
+# Feasible tile slice masks computed from scratch with the tables of a MaskEngine, the reference the
+# forward-checked domains of StreamingEngineEnv and VectorStreamingEngineEnv are tested against
+
+def mask(engine, occupancy, node_tile, node_spoke, node_ready, preds, siblings, tm_partners, sf_others):
+    """Return boolean mask of feasible tile slices for a node whose predecessors are all placed
+
+    Args:
+        occupancy (np.array): node_idx placed in every slice, -1 if free
+        node_tile, node_spoke, node_ready (np.array): placement of every node, node_tile is -1 if unplaced
+        preds, siblings, tm_partners, sf_others (np.array): node indexes the constraints refer to
+    """
+    mask = occupancy < 0
+
+    # Timing constraint w.r.t. the predecessor with the latest ready time
+    if len(preds) != 0:
+        latest_pred = preds[np.argmax(node_ready[preds])]
+        mask &= engine.timing_table[node_tile[latest_pred], node_spoke[latest_pred]]
+
+    tile_ok = np.ones(engine.tile_count, dtype=bool)
+
+    # Sibling constraint: tiles holding a sibling are unavailable
+    if engine.sibling_constr and len(siblings) != 0:
+        tile_ok[node_tile[siblings][node_tile[siblings] >= 0]] = False
+
+    # TM constraint: only the tile of already placed nodes sharing a tile memory is available
+    if engine.tm_constr and len(tm_partners) != 0:
+        tm_tiles = node_tile[tm_partners]
+        tm_tiles = tm_tiles[tm_tiles >= 0]
+        if len(tm_tiles) != 0:
+            if (tm_tiles != tm_tiles[0]).any():
+                tile_ok[:] = False
+            else:
+                tile_ok[:tm_tiles[0]] = False
+                tile_ok[tm_tiles[0] + 1:] = False
+
+    # SF constraint: sync flow roots can't share a tile
+    if engine.sf_constr and len(preds) == 0 and len(sf_others) != 0:
+        tile_ok[node_tile[sf_others][node_tile[sf_others] >= 0]] = False
+
+    mask &= tile_ok[engine.slice_tile]
+    return mask
+
+def batch_mask(engine, occupancy, node_tile, node_spoke, node_ready, preds, siblings, tm_partners, sf_others):
+    """Batched version of mask over B placements of the same graph, all arrays get a leading batch dim
+
+    Rows where the predecessors are not all placed must be zeroed by the caller.
+    """
+    batch = np.arange(occupancy.shape[0])
+    mask = occupancy < 0
+
+    if len(preds) != 0:
+        latest_pred = preds[np.argmax(node_ready[:, preds], axis=1)]
+        mask &= engine.timing_table[node_tile[batch, latest_pred], node_spoke[batch, latest_pred]]
+
+    tile_ok = np.ones((len(batch), engine.tile_count), dtype=bool)
+
+    if engine.sibling_constr and len(siblings) != 0:
+        sib_tiles = node_tile[:, siblings]
+        rows, cols = np.nonzero(sib_tiles >= 0)
+        tile_ok[rows, sib_tiles[rows, cols]] = False
+
+    if engine.tm_constr and len(tm_partners) != 0:
+        tm_tiles = node_tile[:, tm_partners]
+        placed = tm_tiles >= 0
+        has_tm = placed.any(axis=1)
+        first_tile = np.where(placed, tm_tiles, engine.tile_count).min(axis=1)
+        last_tile = np.where(placed, tm_tiles, -1).max(axis=1)
+        keep = (np.arange(engine.tile_count)[None, :] == first_tile[:, None]) & (first_tile == last_tile)[:, None]
+        tile_ok &= np.where(has_tm[:, None], keep, True)
+
+    if engine.sf_constr and len(preds) == 0 and len(sf_others) != 0:
+        sf_tiles = node_tile[:, sf_others]
+        rows, cols = np.nonzero(sf_tiles >= 0)
+        tile_ok[rows, sf_tiles[rows, cols]] = False
+
+    mask &= tile_ok[:, engine.slice_tile]
+    return mask
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from envs.evaluate import evaluate_placements
+from bnb import BranchAndBound
+from util import play_placement
+
+def exhaustive_optimum(env):
+    '''
+    smallest graph ready time over every placement of every node, scored in one evaluate_placements batch
+    '''
+    slices = np.arange(env.mask_engine.slice_count)
+    placements = np.stack(np.meshgrid(*[slices] * env.plan.num_nodes, indexing='ij'), axis=-1)
+    ready_time, feasible = evaluate_placements(env.plan, placements.reshape(-1, env.plan.num_nodes), env.mask_engine)
+    return ready_time[feasible].min()
+
+@pytest.mark.parametrize('topology, optimum', [((16, 6), 10), ((4, 3), 11)])
+def test_bnb_proves_mul_add_optimum(args, make_env, load_graph, topology, optimum):
+    args.device_topology = topology
+    env = make_env(StreamingEngineEnv, load_graph('mul_add_ir.json'), topology)
+    assert exhaustive_optimum(env) == optimum
+    bnb = BranchAndBound(env, verbose=False)
+    assert bnb.root_bound <= optimum
+    assert bnb.run() == (optimum, optimum) and bnb.optimal and bnb.gap() == 0
+    best_ready_time, placed_nodes = bnb.best()
+    actions = [(node, np.ravel_multi_index(placed_nodes[node]['tile_slice'], topology)) for node in env.plan.topo_order.tolist()]
+    assert play_placement(env, actions, args)[0] == best_ready_time == optimum
+
+def test_bnb_resumes_after_node_limit(make_env, load_graph):
+    env = make_env(StreamingEngineEnv, load_graph('mul_add_ir.json'))
+    bnb = BranchAndBound(env, verbose=False)
+    best_ready_time, lower = bnb.run(node_limit=5)
+    assert not bnb.optimal and lower <= 10 <= best_ready_time
+    assert bnb.run() == (10, 10) and bnb.optimal
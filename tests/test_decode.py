@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+import torch
+from preproc import PreInput
+
+from envs.vector_env import VectorStreamingEngineEnv
+from modules import _engine
+from decode import load_policy, beam_decode
+
+@pytest.mark.parametrize('score', ['logprob', 'ready_time'])
+def test_beam_decode_grows_single_episode_env(args, make_env, load_graph, score):
+    '''
+    beam search from a single episode env finds the placement it finds from a beam_width env
+    '''
+    torch.manual_seed(0)
+    device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+    graphdef = PreInput(args).pre_graph(load_graph('ifft_inner_loop_ir.json'), device)
+    policy = load_policy(args, graphdef, device, '')
+    graph = graphdef['graph'].to(_engine)
+    results = []
+    with torch.inference_mode():
+        for num_envs in [1, 8]:
+            env = make_env(VectorStreamingEngineEnv, graphdef, num_envs=num_envs)
+            results.append(beam_decode(policy, env, graph, beam_width=8, score=score))
+    assert results[0][0] is not None and results[0] == results[1]
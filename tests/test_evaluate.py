@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from envs.evaluate import evaluate_placements
+from util import play_placement
+from conftest import INPUT_GRAPHS
+
+def candidates(env, episodes, rng):
+    '''
+    placements of random masked episodes, completed ones first and the others finished at random,
+    the same with two nodes moved, and uniform random placements
+    return: placements, number of completed ones
+    '''
+    slice_count = env.se.tile_count * env.se.spoke_count
+    complete, partial = [], []
+    for _ in range(episodes):
+        env.reset()
+        placement = rng.integers(slice_count, size=env.plan.num_nodes)
+        for node in env.plan.topo_order.tolist():
+            slices = np.flatnonzero(env.get_mask(node))
+            if not len(slices):
+                break
+            placement[node] = rng.choice(slices)
+            _, _, _, info = env.step([node, *divmod(int(placement[node]), env.se.spoke_count)])
+            if info['dead_end']:
+                break
+        (complete if env.all_nodes_placed else partial).append(placement)
+    placements = np.array(complete + partial)
+    moved = placements.copy()
+    rows = np.arange(episodes)
+    for _ in range(2):
+        moved[rows, rng.integers(env.plan.num_nodes, size=episodes)] = rng.integers(slice_count, size=episodes)
+    uniform = rng.integers(slice_count, size=placements.shape)
+    return np.concatenate([placements, moved, uniform]), len(complete)
+
+@pytest.mark.parametrize('topology', [(16, 6), (4, 3)])
+@pytest.mark.parametrize('name', INPUT_GRAPHS + [None])
+def test_evaluate_placements_matches_play_placement(args, make_env, load_graph, name, topology):
+    args.device_topology = topology
+    env = make_env(StreamingEngineEnv, load_graph(name, numnodes=20), topology)
+    placements, num_complete = candidates(env, 30, np.random.default_rng(0))
+    ready_time, feasible, violations = evaluate_placements(env.plan, placements, env.mask_engine,
+                                                           return_violations=True)
+    assert feasible[:num_complete].all()
+    assert np.array_equal(feasible, violations == 0)
+    for placement, cand_ready_time, cand_feasible in zip(placements, ready_time, feasible):
+        actions = [(node, placement[node]) for node in env.plan.topo_order.tolist()]
+        play_ready_time, _ = play_placement(env, actions, args)
+        assert play_ready_time == cand_ready_time
+        assert (play_ready_time != 100) == cand_feasible
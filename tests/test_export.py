@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+import torch
+from preproc import PreInput
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from modules import _engine
+from decode import load_policy, greedy_decode, ScriptedPolicy
+from export import export_actor, check_parity
+
+@pytest.fixture
+def policy_graph(args, load_graph):
+    '''
+    policy_graph(nnmode): randomly initialized eval ActorCritic and the preprocessed ifft_inner_loop graph
+    '''
+    def make(nnmode):
+        torch.manual_seed(0)
+        args.nnmode = nnmode
+        device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+        graphdef = PreInput(args).pre_graph(load_graph('ifft_inner_loop_ir.json'), device)
+        return load_policy(args, graphdef, device, ''), graphdef
+    return make
+
+@pytest.mark.parametrize('nnmode', ['simple_ff', 'ff_gnn', 'ff_gnn_attention', 'ff_transf_attention'])
+def test_scripted_actor_parity(make_env, policy_graph, nnmode):
+    policy, graphdef = policy_graph(nnmode)
+    env = make_env(StreamingEngineEnv, graphdef)
+    np.random.seed(0)
+    assert check_parity(policy, export_actor(policy), graphdef, env) <= 1e-4
+
+@pytest.mark.parametrize('optimize', [False, True])
+def test_saved_actor_decodes_like_eager(tmp_path, make_env, policy_graph, optimize):
+    '''
+    the saved TorchScript actor loaded by ScriptedPolicy places every node like the eager ActorCritic
+    '''
+    policy, graphdef = policy_graph('ff_gnn_attention')
+    path = str(tmp_path / 'actor.pt')
+    torch.jit.save(export_actor(policy), path)
+    scripted = ScriptedPolicy(path, optimize=optimize)
+    graph = graphdef['graph'].to(_engine)
+    with torch.inference_mode():
+        eager_nodes, eager_ready_time = greedy_decode(policy, make_env(StreamingEngineEnv, graphdef), graph)
+        assert eager_nodes is not None
+        for _ in range(3):  # The profiling executor specializes the graph during the first calls
+            env = make_env(StreamingEngineEnv, graphdef)
+            assert greedy_decode(scripted, env, graph) == (eager_nodes, eager_ready_time)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from conftest import INPUT_GRAPHS
+import mask_reference
+
+def reference_mask(env, node):
+    plan = env.plan
+    return mask_reference.mask(env.mask_engine, env.se.state, env.node_tile, env.node_spoke, env.node_ready,
+                               plan.preds(node), plan.siblings(node), plan.tm_partners(node), plan.sf_nodes)
+
+def random_episodes(env, episodes, seed=0):
+    '''
+    yield after every step of random placements in topological order, until done or a dead end
+    '''
+    rng = np.random.default_rng(seed)
+    spoke_count = env.se.spoke_count
+    for _ in range(episodes):
+        env.reset()
+        for node in env.plan.topo_order.tolist():
+            slices = np.flatnonzero(env.get_mask(node))
+            if not len(slices):
+                break
+            _, _, _, info = env.step([node, *divmod(int(rng.choice(slices)), spoke_count)])
+            yield info
+            if info['dead_end']:
+                break
+
+@pytest.mark.parametrize('topology', [(16, 6), (4, 3), (3, 2)])
+@pytest.mark.parametrize('name', INPUT_GRAPHS + [None])
+def test_domains_match_reference_mask(make_env, load_graph, name, topology):
+    env = make_env(StreamingEngineEnv, load_graph(name, numnodes=20), topology)
+    for info in random_episodes(env, episodes=10):
+        placeable = np.flatnonzero((env.node_tile < 0) & (env.preds_left == 0))
+        for node in placeable.tolist():
+            assert np.array_equal(env.get_mask(node), reference_mask(env, node)), node
+        # A dead end is flagged exactly when an unplaced node has no slice left
+        assert info['dead_end'] == ((env.node_tile < 0) & ~env.domains.any(axis=1)).any()
+
+@pytest.mark.parametrize('flag', ['no_sibling_constr', 'no_tm_constr', 'no_sf_constr'])
+def test_domains_match_reference_mask_without_constraint(args, make_env, load_graph, flag):
+    setattr(args, flag, True)
+    env = make_env(StreamingEngineEnv, load_graph('ifft_2_loops_ir.json'), (4, 3))
+    for _ in random_episodes(env, episodes=10):
+        placeable = np.flatnonzero((env.node_tile < 0) & (env.preds_left == 0))
+        for node in placeable.tolist():
+            assert np.array_equal(env.get_mask(node), reference_mask(env, node)), node
+
+def test_snapshot_restore_domains(make_env, load_graph):
+    env = make_env(StreamingEngineEnv, load_graph('ifft_inner_loop_ir.json'))
+    steps = random_episodes(env, episodes=1)
+    for _ in range(5):
+        next(steps)
+    snapshot = env.snapshot()
+    domains = env.domains.copy()
+    for _ in steps:
+        pass
+    env.restore(snapshot)
+    assert np.array_equal(env.domains, domains)
+    node = next(node for node in env.plan.topo_order.tolist() if env.node_tile[node] < 0)
+    assert np.array_equal(env.get_mask(node), reference_mask(env, node))
@@ -0,0 +1,69 @@
+from collections import deque
+import numpy as np
+import pytest
+import torch
+from preproc import PreInput
+
+from envs.vector_env import VectorStreamingEngineEnv
+from ppo_discrete import PPO
+from train import run_episodes_vec
+
+def uncached_embedding(policy, graph):
+    '''
+    no-grad graph embedding in eval mode, the training mode restored
+    '''
+    training = policy.training
+    policy.eval()
+    with torch.no_grad():
+        graph_feat = policy.graph_embedding(policy.batch_graphs([graph]))
+    policy.train(training)
+    return graph_feat
+
+@pytest.fixture
+def make_ppo(args, load_graph):
+    '''
+    make_ppo(nnmode): PPO and the preprocessed ifft_inner_loop graph
+    '''
+    def make(nnmode):
+        torch.manual_seed(0)
+        args.nnmode = nnmode
+        device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+        graphdef = PreInput(args).pre_graph(load_graph('ifft_inner_loop_ir.json'), device)
+        args.nodes = graphdef['graph'].num_nodes()
+        return PPO(args, graphdef=graphdef, device=device, state_dim=int(device['action_dim'])), graphdef
+    return make
+
+@pytest.mark.parametrize('nnmode', ['ff_gnn', 'ff_gnn_attention', 'ff_transf_attention'])
+def test_cached_embedding_matches_uncached(make_ppo, nnmode):
+    ppo, graphdef = make_ppo(nnmode)
+    policy, graph = ppo.policy_old, graphdef['graph']
+    policy.train()
+    with torch.no_grad():
+        cached = policy.cached_graph_embedding(graph)
+        assert policy.cached_graph_embedding(graph) is cached
+    assert policy.training
+    assert torch.allclose(cached, uncached_embedding(policy, graph))
+
+def test_update_and_load_state_dict_invalidate_cache(make_env, make_ppo):
+    ppo, graphdef = make_ppo('ff_transf_attention')
+    policy, graph = ppo.policy_old, graphdef['graph']
+    with torch.no_grad():
+        cached = policy.cached_graph_embedding(graph)
+
+    env = make_env(VectorStreamingEngineEnv, graphdef, num_envs=4)
+    run_episodes_vec(ppo.args, env, ppo, graphdef, deque())
+    version = policy.policy_version
+    ppo.update()
+    assert policy.policy_version > version
+    with torch.no_grad():
+        updated = policy.cached_graph_embedding(graph)
+    assert not torch.allclose(updated, cached)
+    assert torch.allclose(updated, uncached_embedding(policy, graph))
+
+    torch.manual_seed(1)
+    other, _ = make_ppo('ff_transf_attention')
+    policy.load_state_dict(other.policy.state_dict())
+    with torch.no_grad():
+        loaded = policy.cached_graph_embedding(graph)
+    assert torch.allclose(loaded, uncached_embedding(other.policy, graph))
+    assert not torch.allclose(loaded, updated)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from ppo_discrete import discounted_returns, gae
+
+def reference_returns(rewards, dones, gamma):
+    '''
+    reverse loop over the transitions, as PPO.update computed the returns before they were vectorized
+    '''
+    returns, running = [], 0.
+    for reward, done in zip(reversed(rewards), reversed(dones)):
+        if done:
+            running = 0.
+        running = reward + gamma * running
+        returns.insert(0, running)
+    return np.array(returns)
+
+def reference_gae(rewards, values, dones, gamma, lam):
+    advantages, running, next_value = [], 0., 0.
+    for reward, value, done in zip(reversed(rewards), reversed(values), reversed(dones)):
+        if done:
+            running, next_value = 0., 0.
+        delta = reward + gamma * next_value - value
+        running = delta + gamma * lam * running
+        advantages.insert(0, running)
+        next_value = value
+    advantages = np.array(advantages)
+    return advantages, advantages + values
+
+def transitions(seed, size):
+    '''
+    random rewards, values and episode ends; the last episode may be cut before its done
+    '''
+    rng = np.random.default_rng(seed)
+    rewards = rng.choice([-10., -1., 0., 0.5, 1.], size=size)
+    values = rng.normal(size=size)
+    dones = rng.random(size) < 0.2
+    dones[rng.integers(size)] = True
+    return rewards, values, dones
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('size', [1, 2, 17, 200])
+@pytest.mark.parametrize('gamma', [0.99, 1.])
+def test_discounted_returns_match_reference(seed, size, gamma):
+    rewards, _, dones = transitions(seed, size)
+    assert np.allclose(discounted_returns(rewards, dones, gamma), reference_returns(rewards, dones, gamma))
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('size', [1, 2, 17, 200])
+@pytest.mark.parametrize('gamma, lam', [(0.99, 0.95), (0.9, 0.), (1., 1.)])
+def test_gae_matches_reference(seed, size, gamma, lam):
+    rewards, values, dones = transitions(seed, size)
+    advantages, returns = gae(rewards, values, dones, gamma, lam)
+    expected_advantages, expected_returns = reference_gae(rewards, values, dones, gamma, lam)
+    assert np.allclose(advantages, expected_advantages)
+    assert np.allclose(returns, expected_returns)
+
+def test_gae_with_lambda_one_is_discounted_return():
+    rewards, values, dones = transitions(0, 100)
+    _, returns = gae(rewards, values, dones, 0.99, 1.)
+    assert np.allclose(returns, discounted_returns(rewards, dones, 0.99))
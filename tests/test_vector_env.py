@@ -0,0 +1,96 @@
+from collections import deque
+import numpy as np
+import pytest
+import torch
+from preproc import PreInput
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from envs.vector_env import VectorStreamingEngineEnv
+from ppo_discrete import PPO
+from train import run_episodes_vec
+from conftest import INPUT_GRAPHS
+import mask_reference
+
+@pytest.mark.parametrize('topology', [(16, 6), (4, 3), (3, 2)])
+@pytest.mark.parametrize('name', INPUT_GRAPHS + [None])
+def test_vector_env_matches_single_envs(make_env, load_graph, name, topology):
+    '''
+    B lockstep episodes step like B StreamingEngineEnv, rows at a dead end are no longer stepped
+    '''
+    num_envs = 6
+    graphdef = load_graph(name, numnodes=20)
+    vec_env = make_env(VectorStreamingEngineEnv, graphdef, topology, num_envs=num_envs)
+    envs = [make_env(StreamingEngineEnv, graphdef, topology) for _ in range(num_envs)]
+    rng = np.random.default_rng(0)
+    for _ in range(4):
+        vec_env.reset()
+        for env in envs:
+            env.reset()
+        active = np.ones(num_envs, dtype=bool)
+        for node in vec_env.plan.topo_order.tolist():
+            mask = vec_env.get_mask(node)
+            plan = vec_env.plan
+            reference = mask_reference.batch_mask(vec_env.mask_engine, vec_env.state, vec_env.node_tile,
+                                                  vec_env.node_spoke, vec_env.node_ready, plan.preds(node),
+                                                  plan.siblings(node), plan.tm_partners(node), plan.sf_nodes)
+            assert np.array_equal(mask[active], reference[active])
+            slices = []
+            for row, env in enumerate(envs):
+                if active[row]:
+                    assert np.array_equal(env.get_mask(node), mask[row])
+                feasible = np.flatnonzero(mask[row])
+                slices.append(rng.choice(feasible) if len(feasible) else 0)
+            tile, spoke = np.unravel_index(np.array(slices), topology)
+            state, reward, done, info = vec_env.step([node, tile, spoke])
+            for row, env in enumerate(envs):
+                if not active[row]:
+                    assert reward[row] == 0 and done[row] and info['dead_end'][row]
+                    continue
+                env_state, env_reward, env_done, env_info = env.step([node, tile[row], spoke[row]])
+                assert np.array_equal(env_state, state[row])
+                assert env_reward == reward[row] and env_info['ready_time'] == info['ready_time'][row]
+                assert env_info['dead_end'] == info['dead_end'][row]
+                assert (env_done or env_info['dead_end']) == done[row]
+                assert env.placed_nodes == vec_env.get_placed_nodes(row)
+                assert env.graph_ready_time == vec_env.graph_ready_time[row]
+                active[row] = not env_info['dead_end']
+            if not active.any():
+                break
+
+def test_run_episodes_vec_ends_episodes_at_dead_end(args, make_env, load_graph):
+    '''
+    every episode ends with a terminal transition, dead ends with the -10 penalty and no transition after it
+    '''
+    torch.manual_seed(0)
+    args.device_topology = (4, 3)
+    device = {'topology': args.device_topology, 'action_dim': np.prod(args.device_topology)}
+    graphdef = PreInput(args).pre_graph(load_graph('ifft_inner_loop_ir.json'), device)
+    args.nodes = graphdef['graph'].num_nodes()
+    env = make_env(VectorStreamingEngineEnv, graphdef, args.device_topology, num_envs=6)
+    ppo = PPO(args, graphdef=graphdef, device=device, state_dim=env.observation_space.n)
+    for _ in range(3):
+        start = len(ppo.buffer)
+        run_episodes_vec(args, env, ppo, graphdef, deque())
+        rewards = ppo.buffer.rewards[start:].numpy()
+        dones = ppo.buffer.is_terminals[start:].numpy()
+        assert len(rewards) == env.placed_count.sum()
+        assert dones.sum() == env.num_envs and dones[-1]
+        assert (rewards == -10).sum() == env.dead_end.sum()
+
+def test_set_graph_reuses_buffers(make_env, load_graph):
+    '''
+    a graph with the same number of nodes reuses the episode buffers and steps like a new env
+    '''
+    env = make_env(VectorStreamingEngineEnv, load_graph(None, numnodes=20, seed=0), num_envs=4)
+    env.reset()
+    node = env.plan.topo_order[0]
+    env.step([node, np.zeros(4, dtype=int), np.arange(4)])
+    domains = env.domains
+    graphdef = load_graph(None, numnodes=20, seed=1)
+    env.set_graph(graphdef)
+    assert env.domains is domains
+    new_env = make_env(VectorStreamingEngineEnv, graphdef, num_envs=4)
+    for name in ['node_tile', 'node_spoke', 'node_ready', 'placed_count', 'domains', 'preds_left', 'dead_end']:
+        assert np.array_equal(getattr(env, name), getattr(new_env, name)), name
+    env.set_graph(load_graph('ifft_inner_loop_ir.json'))
+    assert env.domains.shape == (4, env.num_nodes, env.slice_count)
@@ -14,13 +14,18 @@ from tqdm import tqdm
 import random
 
 from envs.streaming_engine_env import StreamingEngineEnv
+from envs.vector_env import VectorStreamingEngineEnv
+from envs.subproc_env import SubprocStreamingEngineEnv
 from ppo_discrete import PPO
+from modules import RolloutBuffer, _engine
+from greedy import greedy_placement
+from profiler import PhaseTimer, TraceWindow, NO_TIMER
 
 torch.manual_seed(0)
 random.seed(0)
 np.random.seed(0)
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(description='Streaming Engine RL Mapper')
     arg = parser.add_argument
 
@@ -43,9 +48,14 @@ def get_args():
     arg('--graph_feat_size', type=int, default=128, help='graph_feat_size')
     arg('--emb_size', type=int, default=64, help='embedding size')
     arg('--update_timestep', type=int, default=100, help='update policy every n episodes')
+    arg('--num_envs', type=int, default=1, help='number of episodes stepped in lockstep by a vectorized env')
+    arg('--env_workers', type=int, default=0, help='number of env worker processes stepping one episode each, overrides num_envs')
     arg('--K_epochs', type=int, default=5, help='update policy for K epochs')
     arg('--eps_clip', type=float, default=0.2, help='clip parameter for PPO')
     arg('--gamma', type=float, default=0.99, help='discount factor')
+    arg('--use_gae', action='store_true', help='use generalized advantage estimation instead of normalized Monte Carlo returns')
+    arg('--gae_lambda', type=float, default=0.95, help='lambda of generalized advantage estimation')
+    arg('--minibatch_size', type=int, default=0, help='minibatch size of PPO updates with shuffling, 0 for full batch')
     arg('--lr', type=float, default=1e-3, help='parameters for Adam optimizer')
     arg('--betas', type=float, default=(0.9, 0.999), help='')
     arg('--loss_entropy_c', type=float, default=0.01, help='coefficient for entropy term in loss')
@@ -53,9 +63,133 @@ def get_args():
     arg('--model', type=str, default='', help='load saved model from file')
     arg('--log_interval', type=int, default=100, help='interval for logging data')
     arg('--quiet', action='store_true', help='dont save model and tensorboard')
-    args = parser.parse_args()
+    arg('--warm_start', type=int, default=0, help='imitate the greedy mapper placements for n epochs before PPO training')
+
+    # Actor-learner (actor_learner.py)
+    arg('--actors', type=int, default=4, help='rollout worker processes streaming episodes to the learner')
+    arg('--max_policy_lag', type=int, default=1, help='drop episodes collected by a policy more than n updates behind the learner')
+
+    # Data-parallel (train_dist.py)
+    arg('--world_size', type=int, default=2, help='number of processes launched locally, ignored under torchrun')
+    arg('--graphs', type=str, default='', help='pickle of graphs from create_graphs.py to train on instead of --input')
+    arg('--graph_nodes', nargs='+', type=int, default=None, help='node counts of the --graphs pickle to train on, all by default')
+
+    # Profiling
+    arg('--profile', action='store_true', help='time every phase of the training loop, logged to tensorboard and profile.json')
+    arg('--profile_trace', type=str, default='', choices=['', 'torch', 'cprofile'], help='trace a window of episodes with torch.profiler or cProfile')
+    arg('--profile_window', nargs=2, type=int, default=(100, 20), help='first episode and number of episodes to trace')
+    args = parser.parse_args(argv)
     return args
 
+def run_episode(args, env, ppo, graphdef, reward_buf, timer=NO_TIMER):
+    '''
+    place every node of graphdef with the policy and save the transitions to the ppo buffer
+    return: total reward, placed nodes (None if not all placed), graph ready time
+    '''
+    state = env.reset()
+    total_reward = 0
+    done = False
+    # Iterate over nodes to place in topological order
+    for node_id in env.plan.topo_order.tolist():
+    # for node_id in range(args.nodes):
+        with timer.phase('get_mask'):
+            mask = env.get_mask(node_id)
+        with timer.phase('select_action'):
+            tile_slice_idx, tobuff = ppo.select_action(state, graphdef, node_id, mask)
+        tile, spoke = np.unravel_index(tile_slice_idx, args.device_topology)
+        action = [node_id, tile, spoke]
+        with timer.phase('env_step'):
+            state, reward, done, info = env.step(action)
+        if info['dead_end']:  # Episode can't be completed anymore, end it with the failure penalty
+            reward, done = -10.0, True
+
+        total_reward += reward
+        if node_id == args.nodes - 1:
+            done = True
+
+        # Save things to buffer
+        with timer.phase('add_buffer'):
+            ppo.add_buffer(tobuff, reward, done)
+        reward_buf.append(reward)
+        if info['dead_end']:
+            break
+
+    if not env.all_nodes_placed:
+        return total_reward, None, float('inf')
+    return total_reward, env.placed_nodes, env.graph_ready_time
+
+def run_episodes_vec(args, env, ppo, graphdef, reward_buf, timer=NO_TIMER):
+    '''
+    run_episode for the num_envs episodes of a VectorStreamingEngineEnv, one policy forward per node
+    return: mean total reward, placed nodes and graph ready time of the best complete episode
+    '''
+    state = env.reset()
+    total_reward = np.zeros(env.num_envs)
+    active = np.ones(env.num_envs, dtype=bool)  # Episodes not ended by a dead end yet
+    steps = []
+    for node_id in env.plan.topo_order.tolist():
+        with timer.phase('get_mask'):
+            mask = env.get_mask(node_id)
+        with timer.phase('select_action'):
+            tile_slice_idx, tobuff = ppo.select_action(state, graphdef, node_id, mask)
+        tile, spoke = np.unravel_index(tile_slice_idx, args.device_topology)
+        with timer.phase('env_step'):
+            state, reward, done, info = env.step([node_id, tile, spoke])
+        # Like run_episode: a dead end ends the episode with the failure penalty, later steps are dropped
+        reward = np.where(info['dead_end'], -10.0, reward)
+        done = done | info['dead_end']
+
+        total_reward += np.where(active, reward, 0.)
+        if node_id == args.nodes - 1:
+            done = np.ones_like(done)
+        steps.append((tobuff, reward, done, active))
+        reward_buf.extend(reward[active])
+        active = active & ~info['dead_end']
+        if not active.any():
+            break
+
+    # Save things to buffer, episode by episode
+    with timer.phase('add_buffer'):
+        ppo.add_buffer_batch(steps)
+
+    ready_time = np.where(env.all_nodes_placed, env.graph_ready_time, np.inf)
+    best = np.argmin(ready_time)
+    if not env.all_nodes_placed[best]:
+        return np.mean(total_reward), None, float('inf')
+    return np.mean(total_reward), env.get_placed_nodes(best), int(ready_time[best])
+
+def warm_start(args, ppo, graphs):
+    '''
+    behavior cloning of greedy.greedy_placement on preprocessed graphs, placed in topological order like
+    the episodes, for args.warm_start epochs
+    return: final imitation loss
+    '''
+    demos = RolloutBuffer(device=_engine)
+    for graphdef in graphs:
+        env = StreamingEngineEnv(args,
+                                 graphdef = graphdef,
+                                 tile_count = args.device_topology[0],
+                                 spoke_count = args.device_topology[1],
+                                 pipeline_depth = args.pipeline_depth)
+        ready_time, place_nodes = greedy_placement(env, order=env.plan.topo_order)
+        if not place_nodes:
+            continue
+        # Replay the placement for the states and masks the policy sees
+        graph = ppo.device_graph(graphdef['graph'])
+        state = env.reset()
+        for node_id, tile_slice_idx in place_nodes:
+            mask = env.get_mask(node_id)
+            demos.add(torch.tensor(state, dtype=torch.float32).reshape(1, -1), torch.tensor([tile_slice_idx]), graph,
+                      torch.zeros(1), torch.tensor(mask).reshape(1, -1), torch.tensor([[node_id]]), 0., False)
+            tile, spoke = np.unravel_index(tile_slice_idx, args.device_topology)
+            state, _, _, _ = env.step([node_id, tile, spoke])
+    if len(demos) == 0:
+        print('[INFO] No greedy placement to warm start from')
+        return None
+    loss = ppo.imitate(demos, args.warm_start)
+    print(f'[INFO] Warm started from {len(demos)} greedy placement steps, imitation loss {loss:.3f}')
+    return loss
+
 def run_mapper(args, graphs, writer=None):
     # Parse arguments
     args.device_topology = tuple(args.device_topology)
@@ -96,11 +230,27 @@ def run_mapper(args, graphs, writer=None):
 
 
     # Init gym env
-    env = StreamingEngineEnv(args,
-                             graphdef = graphdef,
-                             tile_count = args.device_topology[0], 
-                             spoke_count = args.device_topology[1], 
-                             pipeline_depth = args.pipeline_depth)
+    if args.env_workers > 0:
+        args.num_envs = args.env_workers
+        env = SubprocStreamingEngineEnv(args,
+                                        graphs,
+                                        num_envs = args.env_workers,
+                                        tile_count = args.device_topology[0],
+                                        spoke_count = args.device_topology[1],
+                                        pipeline_depth = args.pipeline_depth)
+    elif args.num_envs > 1:
+        env = VectorStreamingEngineEnv(args,
+                                       graphdef = graphdef,
+                                       num_envs = args.num_envs,
+                                       tile_count = args.device_topology[0],
+                                       spoke_count = args.device_topology[1],
+                                       pipeline_depth = args.pipeline_depth)
+    else:
+        env = StreamingEngineEnv(args,
+                                 graphdef = graphdef,
+                                 tile_count = args.device_topology[0], 
+                                 spoke_count = args.device_topology[1], 
+                                 pipeline_depth = args.pipeline_depth)
 
     # Init ppo
     ppo = PPO(args,
@@ -108,6 +258,8 @@ def run_mapper(args, graphs, writer=None):
              device = device,
              state_dim = env.observation_space.n,  # Will change later to include node to be placed
     )
+    if args.warm_start:
+        warm_start(args, ppo, graphs if isinstance(graphs, list) else [graphdef])
 
     # Setup logging variables
     reward_buf = deque(maxlen=100)
@@ -116,65 +268,66 @@ def run_mapper(args, graphs, writer=None):
     time_step = 0
     best_ready_time = float('inf')
     best_reward = 0
+    timer = PhaseTimer(enabled=args.profile)
+    profile_dir = f'{writer.log_dir}_profile'  # Next to the run directory
+    trace = TraceWindow(args.profile_trace, args.profile_window[0], args.profile_window[1], profile_dir) if args.profile_trace else None
 
-    # Start training loop
-    for i_episode in range(1, args.epochs + 1):
+    # Start training loop, each iteration runs num_envs episodes
+    for i_episode in range(args.num_envs, args.epochs + 1, args.num_envs):
+        if trace is not None:
+            trace.step(i_episode)
         if isinstance(graphs, list):
             graphdef = random.choice(graphs)
-            env.set_graph(graphdef)
+            with timer.phase('set_graph'):
+                env.set_graph(graphdef)
 
-        state = env.reset()
+        if args.num_envs > 1:
+            total_reward, placed_nodes, ready_time = run_episodes_vec(args, env, ppo, graphdef, reward_buf, timer)
+        else:
+            total_reward, placed_nodes, ready_time = run_episode(args, env, ppo, graphdef, reward_buf, timer)
         time_step += 1
-        total_reward = 0
-        done = False
-        # Iterate over nodes to place in topological order
-        asc = dgl.topological_nodes_generator(graphdef['graph'])
-        lnodes = [i.item() for t in asc for i in t]
-        for node_id in lnodes:
-        # for node_id in range(args.nodes):
-            mask = env.get_mask(node_id)
-            tile_slice_idx, tobuff = ppo.select_action(state, graphdef, node_id, mask)
-            tile, spoke = np.unravel_index(tile_slice_idx, args.device_topology)
-            action = [node_id, tile, spoke]
-            state, reward, done, _ = env.step(action)
-
-            total_reward += reward
-            if node_id == args.nodes - 1:
-                done = True
-
-            # Save things to buffer
-            ppo.add_buffer(tobuff, reward, done)
-            reward_buf.append(reward)
+        nodes_placed = len(env.placed_nodes) if args.num_envs == 1 else np.mean(env.placed_count)
 
         if not args.quiet:
-            writer.add_scalar('No. of nodes placed', len(env.placed_nodes), i_episode)
+            writer.add_scalar('No. of nodes placed', nodes_placed, i_episode)
 
-        if env.all_nodes_placed and env.graph_ready_time < best_ready_time:
-            best_ready_time = env.graph_ready_time
+        if placed_nodes is not None and ready_time < best_ready_time:
+            best_ready_time = ready_time
             best_reward = np.mean(reward_buf)
             if not args.quiet:
-                print(f'\nEpisode {i_episode}: {env.placed_nodes}')
+                print(f'\nEpisode {i_episode}: {placed_nodes}')
                 print(f'Best graph ready time yet: {best_ready_time}')
                 # Save mapping json
                 suffix = os.path.basename(args.input)
-                output_json(env.placed_nodes,
-                            no_of_tiles=args.device_topology[0],
-                            spoke_count=args.device_topology[1],
-                            out_file_name=f'mappings/mapping_{suffix}')
+                with timer.phase('output_json'):
+                    output_json(placed_nodes,
+                                no_of_tiles=args.device_topology[0],
+                                spoke_count=args.device_topology[1],
+                                out_file_name=f'mappings/mapping_{suffix}')
             
         # learning:
-        if i_episode % args.update_timestep == 0:
-            ppo.update()
+        if i_episode % args.update_timestep < args.num_envs:
+            with timer.phase('update'):
+                ppo.update()
 
         # logging
-        if i_episode % args.log_interval == 0:
+        if i_episode % args.log_interval < args.num_envs:
             end = time.time()
-            print(f'\rEpisode: {i_episode} | best time {best_ready_time} | Total reward: {total_reward} | Mean Reward: {np.mean(reward_buf):.2f} | Nodes placed: {len(env.placed_nodes)} | Time elpased: {end - start:.2f}s', end='')
+            print(f'\rEpisode: {i_episode} | best time {best_ready_time} | Total reward: {total_reward} | Mean Reward: {np.mean(reward_buf):.2f} | Nodes placed: {nodes_placed} | Time elpased: {end - start:.2f}s', end='')
             if not args.quiet:
                 writer.add_scalar('Mean reward/episode', np.mean(reward_buf), i_episode)
+                timer.log(writer, i_episode)
                 writer.flush()
-                torch.save(ppo.policy.state_dict(), 'model_epoch.pth')
+                with timer.phase('save_model'):
+                    torch.save(ppo.policy.state_dict(), 'model_epoch.pth')
 
+    if trace is not None:
+        trace.stop()
+    if args.profile:
+        os.makedirs(profile_dir, exist_ok=True)
+        timer.save(os.path.join(profile_dir, 'profile.json'))
+    if args.env_workers > 0:
+        env.close()
     return best_ready_time, best_reward
 
 if __name__ == "__main__":
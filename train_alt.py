@@ -5,7 +5,7 @@ import logging
 from collections import deque
 import dgl
 import torch
-from util import get_graph_json, create_graph, output_json, print_graph
+from util import get_graph_json, create_graph, output_json, print_graph, get_nodes_rand, play_placement
 from preproc import PreInput
 import numpy as np
 from coolname import generate_slug
@@ -13,8 +13,14 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import sa
 import random
+from tempering import ParallelTempering
+from bnb import BranchAndBound
+from greedy import greedy_placement
 
 from envs.streaming_engine_env import StreamingEngineEnv
+from envs.subproc_env import SubprocStreamingEngineEnv
+from envs.mask_engine import MaskEngine
+from envs.evaluate import evaluate_placements
 from ppo_discrete import PPO
 
 def get_args():
@@ -50,49 +56,45 @@ def get_args():
     arg('--model', type=str, default='', help='load saved model from file')
     arg('--log_interval', type=int, default=100, help='interval for logging data')
     arg('--quiet', action='store_true', help='dont save model and tensorboard')
+    arg('--env_workers', type=int, default=0, help='evaluate SA/ES candidates on n env worker processes')
+    arg('--mapper', type=str, default='sa', choices=['sa', 'es', 'bnb', 'greedy'], help='simulated annealing, nevergrad evolution strategy, branch and bound or critical path greedy mapper')
+
+    # SA
+    arg('--sa_step_max', type=int, default=100000000000, help='length of the SA cooling schedule in steps')
+    arg('--sa_time_budget', type=float, default=0, help='stop SA after n seconds, 0 to run the whole schedule')
+    arg('--sa_init', type=str, default='rand', choices=['rand', 'greedy'], help='initial SA placement: random or greedy.greedy_placement')
+    arg('--sa_checkpoint', type=str, default='', help='resume SA from this file if it exists, save the search state to it when stopping')
+    arg('--sa_chains', type=int, default=1, help='parallel tempering with n SA chain processes at fixed temperatures if > 1')
+    arg('--pt_temperatures', nargs=2, type=float, default=(0.5, 8), help='coldest and hottest chain temperature, geometric ladder in between')
+    arg('--pt_sweep_steps', type=int, default=50, help='SA steps of every chain between replica exchanges')
+    arg('--pt_sweeps', type=int, default=0, help='number of replica exchange sweeps, 0 to stop after --sa_time_budget only')
+
+    # ES
+    arg('--es_batch', type=int, default=64, help='ES candidates asked, scored and told back together')
+    arg('--es_time_budget', type=float, default=0, help='stop ES after n seconds, 0 to score --epochs candidates')
+
+    # Branch and bound
+    arg('--bnb_node_limit', type=int, default=0, help='stop branch and bound after n search nodes, 0 for no limit')
+    arg('--bnb_time_limit', type=float, default=0, help='stop branch and bound after n seconds, 0 for no limit')
     args = parser.parse_args()
     return args
 
-# get a node placement given mask
-def get_masked_rand(mask, device):
-    l = []
-    for i in range(device['action_dim']):
-        if mask[i] == 1:
-            l.append(i)
-    tile_idx = random.choice(l)
-    return tile_idx
-
-# generate node placement random in sequence
-def get_nodes_rand(init_nodes, args, env, graphdef, device, reward_buf):
-
-    init_nodeid, place_nodes = [], []
-    readytime = 100
-    #init_nodes: nodes already placed (node_id, tile_slice_idx)
-    for s in init_nodes:
-        tile, spoke = np.unravel_index(s[1], args.device_topology)
-        action = [s[0], tile, spoke]
-        state, reward, done, mdata = env.step(action)
-        readytime = mdata['ready_time']
-        place_nodes.append((s[0], s[1]))
-        init_nodeid.append(s[0])
-
-    asc = dgl.topological_nodes_generator(graphdef['graph'])
-    lnodes = [i.item() for t in asc for i in t]
-    for node_id in lnodes:
-        if node_id in init_nodeid:
-            continue
-        mask = env.get_mask(node_id)
-        if np.all(mask == 0):
-            return 100, []
-        tile_slice_idx = get_masked_rand(mask, device)
-        tile, spoke = np.unravel_index(tile_slice_idx, args.device_topology)
-        action = [node_id, tile, spoke]
-        state, reward, done, mdata = env.step(action)
-        readytime = mdata['ready_time']
-        reward_buf.append(reward)
-        place_nodes.append((node_id, tile_slice_idx))
-
-    return readytime, place_nodes
+def make_env(args, graphdef):
+    '''
+    single env, or a pool of env worker processes if args.env_workers > 0
+    '''
+    if args.env_workers > 0:
+        return SubprocStreamingEngineEnv(args,
+                                         graphdef,
+                                         num_envs=args.env_workers,
+                                         tile_count=args.device_topology[0],
+                                         spoke_count=args.device_topology[1],
+                                         pipeline_depth=args.pipeline_depth)
+    return StreamingEngineEnv(args,
+                              graphdef=graphdef,
+                              tile_count=args.device_topology[0],
+                              spoke_count=args.device_topology[1],
+                              pipeline_depth=args.pipeline_depth)
 
 def run_sa_mapper(args, graphs, writer=None):
     # Parse arguments
@@ -131,17 +133,48 @@ def run_sa_mapper(args, graphs, writer=None):
     else:
         graphdef = preproc.pre_graph(graphdef, device)
 
-    # Init gym env
-    env = StreamingEngineEnv(args,
-                             graphdef = graphdef,
-                             tile_count = args.device_topology[0],
-                             spoke_count = args.device_topology[1],
-                             pipeline_depth = args.pipeline_depth)
+    suffix = os.path.basename(args.input)
+    init_state, init_note = None, ''
+    if args.sa_init == 'greedy':  # in topological order like the SA rollouts
+        greedy_env = StreamingEngineEnv(args,
+                                        graphdef=graphdef,
+                                        tile_count=args.device_topology[0],
+                                        spoke_count=args.device_topology[1],
+                                        pipeline_depth=args.pipeline_depth)
+        ready_time, init_state = greedy_placement(greedy_env, order=greedy_env.plan.topo_order)
+        print(f'[INFO] Greedy initial placement, graph ready time {ready_time}')
+        init_note = f' (greedy initial placement {ready_time})'
+    if args.sa_chains > 1:
+        temperatures = np.geomspace(args.pt_temperatures[0], args.pt_temperatures[1], args.sa_chains).tolist()
+        pt = ParallelTempering(args, graphdef, device, writer, temperatures=temperatures, sweep_steps=args.pt_sweep_steps,
+                               init_state=init_state)
+        pt.run(args.sa_time_budget or None, args.pt_sweeps or None)
+        print(f'\nSwap acceptance per temperature pair: {np.round(pt.swap_rates(), 2)}')
+        best_ready_time, placed_nodes = pt.best(None if args.quiet else f'mappings/mapping_{suffix}')
+        print(f'Best graph ready time: {best_ready_time}{init_note}')
+        pt.close()
+        return best_ready_time, 0
 
-    best_ready_time = float('inf')
-    best_reward = 0
-    opt = sa.minimize(args, env, graphdef, device, writer, cooling_schedule='linear', step_max=100000000000, t_max=1, t_min=0)
+    # Init gym env
+    env = make_env(args, graphdef)
+
+    opt = sa.minimize(args, env, graphdef, device, writer, cooling_schedule='linear', step_max=args.sa_step_max, t_max=1, t_min=0,
+                      init_state=init_state)
+    if args.sa_checkpoint and os.path.exists(args.sa_checkpoint):
+        opt.load(args.sa_checkpoint)
+        print(f'[INFO] Resumed SA from {args.sa_checkpoint} at step {opt.step_count}')
+    opt.run(args.sa_time_budget)
+    if args.sa_checkpoint:
+        opt.save(args.sa_checkpoint)
+        print(f'[INFO] Saved SA state to {args.sa_checkpoint}')
     opt.results()
+
+    # Save mapping json
+    best_ready_time, placed_nodes = opt.best(None if args.quiet else f'mappings/mapping_{suffix}')
+    print(f'Best graph ready time: {best_ready_time}{init_note}')
+    best_reward = np.mean(opt.reward_buf)
+    if args.env_workers > 0:
+        env.close()
     return best_ready_time, best_reward
 
 
@@ -173,23 +206,19 @@ def run_mapper_es(args, graphdef):
     graphdef = preproc.pre_graph(graphdef, device)
 
     # Init gym env
-    env = StreamingEngineEnv(args,
-                             graphdef=graphdef,
-                             tile_count=args.device_topology[0],
-                             spoke_count=args.device_topology[1],
-                             pipeline_depth=args.pipeline_depth)
+    env = make_env(args, graphdef)
 
     # randomly occupy with nodes (not occupied=0 value):
     device_topology = args.device_topology
     # Setup logging variables
-    best_ready_time = 100
+    best_ready_time = float('inf')  # Best feasible candidate
     best_reward = 0
     final_value = None
 
     import nevergrad as ng
 
     budget = args.epochs  # How many steps of training we will do before concluding.
-    workers = 16
+    workers = args.es_batch  # Candidates evaluated in parallel
     # param = ng.p.Array(shape=(int(nodes), 1)).set_integer_casting().set_bounds(lower=0, upper=ROW*COL*nodes)
     param = ng.p.Array(shape=(int(args.nodes), 1)).set_integer_casting().set_bounds(lower=0, upper=np.prod(device_topology)-1)
     # ES optim
@@ -197,46 +226,152 @@ def run_mapper_es(args, graphdef):
     optim = ng.optimizers.registry[names](parametrization=param, budget=budget, num_workers=workers)
     # optim = ng.optimizers.RandomSearch(parametrization=param, budget=budget, num_workers=workers)
     # optim = ng.optimizers.NGOpt(parametrization=param, budget=budget, num_workers=workers)
-    def es_calculate_reward(actions):
-        ready_buf = []
-        reward_buf = []
-        xv = [i[0] for i in actions]
-        for node_id, act in enumerate(xv):
-            tile, spoke = np.unravel_index(act, args.device_topology)
-            action = [node_id, tile, spoke]
-            state, reward, done, mdata = env.step(action)
-            ready_buf.append(mdata['ready_time'])
-            reward_buf.append(reward)
-            if done and reward < 0:
-                return 100, -10
-        return np.max(ready_buf), np.mean(reward_buf)
-
-    def isvalid(x):
-        xv = [i[0] for i in x]
-        return len(set(xv)) == len(xv)
-
+    mask_engine = MaskEngine.from_args(args, device_topology[0], device_topology[1], args.pipeline_depth)
+    node_order = np.arange(args.nodes)  # ES candidates are placed in node id order
+    def to_actions(value):
+        return list(enumerate(i[0] for i in value))
+
+    # Above any feasible graph ready time: every node at most pipeline_depth plus the longest hop or spoke
+    # after its predecessor
+    infeasible_loss = args.nodes * (args.pipeline_depth + max(device_topology))
+    def es_calculate_losses(values):
+        '''
+        return: graph ready times, feasibility and shaped ES losses of the candidates, infeasible ones lose
+        infeasible_loss + number of violated constraints, so ES can move towards feasibility
+        '''
+        placements = np.reshape(values, (len(values), -1))
+        if args.env_workers > 0:  # split the batch over the env worker processes
+            ready_time, feasible, violations = env.evaluate_placements(placements, order=node_order, return_violations=True)
+        else:
+            ready_time, feasible, violations = evaluate_placements(env.plan, placements, mask_engine, order=node_order,
+                                                                   return_violations=True)
+        return ready_time, feasible, np.where(feasible, ready_time, infeasible_loss + violations)
+
+    def es_replay_reward(value):
+        # mean reward is only needed for the best candidate, replay it in the env
+        if args.env_workers > 0:
+            return env.play_placement([to_actions(value)])[0][1]
+        return play_placement(env, to_actions(value), args)[1]
+
+    # Whole batches are asked, scored at once and told back, candidates reusing a slice score as infeasible
     print('Running ES optimization ...')
-    for _ in tqdm(range(budget)):
-        x = optim.ask()
-        while isvalid(x.value):
-            x = optim.ask()
-        loss, reward = es_calculate_reward(x.value)
-        optim.tell(x, loss)
-        if best_ready_time > loss:
-            final_value = x.value
-            best_ready_time = loss
-            best_reward = reward
+    start = time.perf_counter()
+    deadline = start + args.es_time_budget if args.es_time_budget else None
+    evaluated = 0
+    pbar = tqdm(total=budget)
+    while evaluated < budget and (deadline is None or time.perf_counter() < deadline):
+        xs = [optim.ask() for _ in range(min(workers, budget - evaluated))]
+        for x, ready_time, feasible, loss in zip(xs, *es_calculate_losses([x.value for x in xs])):
+            optim.tell(x, float(loss))
+            if feasible and best_ready_time > ready_time:
+                final_value = x.value
+                best_ready_time = int(ready_time)
+        evaluated += len(xs)
+        pbar.update(len(xs))
+        if not args.quiet and final_value is not None:
+            writer.add_scalar('ES Best readytime/candidate', best_ready_time, evaluated)
+    pbar.close()
+    elapsed = time.perf_counter() - start
 
     rec = optim.recommend()
-    es_calculate_reward(rec.value)
-    print('best score found:', best_ready_time)
+    ready_time, feasible, _ = es_calculate_losses([rec.value])
+    if feasible[0] and best_ready_time > ready_time[0]:
+        final_value = rec.value
+        best_ready_time = int(ready_time[0])
+    if final_value is not None:
+        best_reward = es_replay_reward(final_value)
+        print(f'best graph ready time found: {best_ready_time}, {evaluated} candidates in {elapsed:.1f}s ({evaluated / elapsed:.0f}/s)')
+    else:
+        print(f'no feasible placement found, {evaluated} candidates in {elapsed:.1f}s ({evaluated / elapsed:.0f}/s)')
     if args.debug:
         print('optim placement:\n', final_value)
+    if args.env_workers > 0:
+        env.close()
 
     return best_ready_time, best_reward
 
+def run_bnb_mapper(args, graphdef):
+    '''
+    branch and bound mapping of graphdef, optimal unless stopped by --bnb_node_limit or --bnb_time_limit
+    return: best graph ready time, lower bound on the optimal graph ready time
+    '''
+    args.device_topology = tuple(args.device_topology)
+    args.nodes = graphdef['graph'].number_of_nodes()
+
+    # SE Device attributes
+    device = {}
+    device['topology'] = args.device_topology
+    device['action_dim'] = np.prod(args.device_topology)
+
+    preproc = PreInput(args)
+    graphdef = preproc.pre_graph(graphdef, device)
+    env = StreamingEngineEnv(args,
+                             graphdef=graphdef,
+                             tile_count=args.device_topology[0],
+                             spoke_count=args.device_topology[1],
+                             pipeline_depth=args.pipeline_depth)
+
+    print('Running branch and bound ...')
+    bnb = BranchAndBound(env)
+    start = time.perf_counter()
+    best_ready_time, lower = bnb.run(args.bnb_node_limit or None, args.bnb_time_limit or None)
+    elapsed = time.perf_counter() - start
+    if bnb.optimal:
+        print(f'\nOptimal graph ready time: {best_ready_time}, {bnb.nodes} nodes in {elapsed:.1f}s')
+    else:
+        print(f'\nStopped after {bnb.nodes} nodes in {elapsed:.1f}s: best graph ready time {best_ready_time}, '
+              f'lower bound {lower} (root {bnb.root_bound}), gap {100 * bnb.gap():.1f}%')
+
+    if not args.quiet:
+        os.makedirs('mappings', exist_ok=True)
+        bnb.best(f'mappings/mapping_{os.path.basename(args.input)}', args.device_topology)
+    return best_ready_time, lower
+
+def run_greedy_mapper(args, graphdef):
+    '''
+    critical path list scheduling of graphdef with greedy.greedy_placement
+    return: graph ready time, placed nodes [(node_id, tile_slice_idx)]
+    '''
+    args.device_topology = tuple(args.device_topology)
+    args.nodes = graphdef['graph'].number_of_nodes()
+
+    # SE Device attributes
+    device = {}
+    device['topology'] = args.device_topology
+    device['action_dim'] = np.prod(args.device_topology)
+
+    preproc = PreInput(args)
+    graphdef = preproc.pre_graph(graphdef, device)
+    env = StreamingEngineEnv(args,
+                             graphdef=graphdef,
+                             tile_count=args.device_topology[0],
+                             spoke_count=args.device_topology[1],
+                             pipeline_depth=args.pipeline_depth)
+
+    start = time.perf_counter()
+    ready_time, place_nodes = greedy_placement(env)
+    elapsed = time.perf_counter() - start
+    if not place_nodes:
+        print(f'Greedy mapper ran into a dead end on {args.input} ({1e3 * elapsed:.1f}ms)')
+        return ready_time, place_nodes
+    print(f'Greedy graph ready time: {ready_time} ({1e3 * elapsed:.1f}ms)')
+    if not args.quiet:
+        os.makedirs('mappings', exist_ok=True)
+        output_json(env.placed_nodes,
+                    no_of_tiles=args.device_topology[0],
+                    spoke_count=args.device_topology[1],
+                    out_file_name=f'mappings/mapping_{os.path.basename(args.input)}')
+    return ready_time, place_nodes
+
 if __name__ == "__main__":
     args = get_args()  # Holds all the input arguments
     graph_json = get_graph_json(args.input)# Get computation graph definition
     graphdef = create_graph(graph_json)
-    run_sa_mapper(args, graphdef)
+    if args.mapper == 'es':
+        run_mapper_es(args, graphdef)
+    elif args.mapper == 'bnb':
+        run_bnb_mapper(args, graphdef)
+    elif args.mapper == 'greedy':
+        run_greedy_mapper(args, graphdef)
+    else:
+        run_sa_mapper(args, graphdef)
@@ -0,0 +1,196 @@
+import os
+import time
+import pickle
+import random
+from collections import deque
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from coolname import generate_slug
+from torch.utils.tensorboard import SummaryWriter
+from util import get_graph_json, create_graph, output_json
+from preproc import PreInput
+
+from envs.streaming_engine_env import StreamingEngineEnv
+from envs.vector_env import VectorStreamingEngineEnv
+from ppo_discrete import PPO
+from train import get_args, run_episode, run_episodes_vec, warm_start
+
+def load_graphs(args):
+    '''
+    graphs of the --graphs pickle ({node count: [graphdef, ...]} as saved by create_graphs.py), or the --input graph
+    '''
+    if not args.graphs:
+        return [create_graph(get_graph_json(args.input))]
+    with open(args.graphs, 'rb') as file:
+        dataset = pickle.load(file)
+    if isinstance(dataset, list):
+        return dataset
+    node_counts = args.graph_nodes if args.graph_nodes else sorted(dataset)
+    return [graphdef for nnodes in node_counts for graphdef in dataset[nnodes]]
+
+def pad_node_features(graphs):
+    '''
+    zero pad the node features of graphs to the widest one, graphs differ in their number of tile memory variables
+    '''
+    width = max(graphdef['graph'].ndata['feat'].shape[1] for graphdef in graphs)
+    for graphdef in graphs:
+        feat = graphdef['graph'].ndata['feat']
+        graphdef['graph'].ndata['feat'] = torch.nn.functional.pad(feat, (0, width - feat.shape[1]))
+
+def run_worker(rank, world_size, args):
+    '''
+    one rank of the data-parallel training: episodes on its shard of the graphs, gradients all-reduced
+    in PPO.update, logging and checkpoints on rank 0
+    return: best graph ready time and mean reward over all ranks
+    '''
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    is_main = rank == 0
+    args.device_topology = tuple(args.device_topology)
+    if is_main:
+        print(args)
+
+    # SE Device attributes
+    device = {}
+    device['topology'] = args.device_topology
+    device['action_dim'] = np.prod(args.device_topology)
+
+    # Every rank loads and preprocesses the full graph set the same way, then keeps its shard
+    graphs = load_graphs(args)
+    preproc = PreInput(args)
+    graphs = [preproc.pre_graph(graphdef, device) for graphdef in graphs]
+    pad_node_features(graphs)
+    if len(graphs) >= world_size:
+        shard = graphs[rank::world_size]
+    elif args.graphs:
+        raise ValueError(f'{len(graphs)} graphs in {args.graphs} for {world_size} ranks, every rank needs its own shard')
+    else:  # The single --input graph, ranks only differ by their episodes
+        shard = graphs
+    graphdef = shard[0]
+    args.nodes = graphdef['graph'].number_of_nodes()
+
+    # Init gym env
+    if args.num_envs > 1:
+        env = VectorStreamingEngineEnv(args,
+                                       graphdef = graphdef,
+                                       num_envs = args.num_envs,
+                                       tile_count = args.device_topology[0],
+                                       spoke_count = args.device_topology[1],
+                                       pipeline_depth = args.pipeline_depth)
+    else:
+        env = StreamingEngineEnv(args,
+                                 graphdef = graphdef,
+                                 tile_count = args.device_topology[0],
+                                 spoke_count = args.device_topology[1],
+                                 pipeline_depth = args.pipeline_depth)
+
+    # Same initial weights on every rank, different episodes
+    ppo = PPO(args,
+              graphdef = graphdef,
+              device = device,
+              state_dim = env.observation_space.n)
+    if args.warm_start and is_main:  # on all the graphs, the weights are broadcast to the other ranks
+        warm_start(args, ppo, graphs)
+    ppo.broadcast_parameters()
+    torch.manual_seed(rank)
+    random.seed(rank)
+    np.random.seed(rank)
+
+    # Tensorboard logging
+    writer = None
+    if is_main:
+        writer = SummaryWriter(comment=f'_{generate_slug(2)}')
+        print(f'[INFO] Saving log data to {writer.log_dir}, {world_size} ranks, {len(shard)} graphs per rank')
+        if shard is graphs and world_size > 1:
+            print(f'[INFO] Single input graph: all {world_size} ranks train on {args.input}')
+        writer.add_text('experiment config', str(args))
+        writer.flush()
+
+    # Setup logging variables
+    reward_buf = deque(maxlen=100)
+    reward_buf.append(0)
+    start = time.time()
+    best_ready_time = float('inf')
+    best_placed_nodes = None
+    best_reward = 0
+
+    # args.epochs episodes in total, every rank runs its share in lockstep with the others
+    for i_episode in range(args.num_envs, args.epochs // world_size + 1, args.num_envs):
+        if len(shard) > 1:
+            graphdef = random.choice(shard)
+            env.set_graph(graphdef)
+
+        if args.num_envs > 1:
+            total_reward, placed_nodes, ready_time = run_episodes_vec(args, env, ppo, graphdef, reward_buf)
+        else:
+            total_reward, placed_nodes, ready_time = run_episode(args, env, ppo, graphdef, reward_buf)
+        nodes_placed = len(env.placed_nodes) if args.num_envs == 1 else np.mean(env.placed_count)
+
+        if placed_nodes is not None and ready_time < best_ready_time:
+            best_ready_time = ready_time
+            best_placed_nodes = placed_nodes
+            best_reward = np.mean(reward_buf)
+
+        # learning:
+        if i_episode % args.update_timestep < args.num_envs:
+            ppo.update()
+
+        # logging, statistics reduced over all ranks
+        if i_episode % args.log_interval < args.num_envs:
+            stats = torch.tensor([np.mean(reward_buf), nodes_placed], dtype=torch.float64)
+            dist.all_reduce(stats)
+            stats /= world_size
+            best = torch.tensor(float(best_ready_time), dtype=torch.float64)
+            dist.all_reduce(best, op=dist.ReduceOp.MIN)
+            if is_main:
+                end = time.time()
+                episode = i_episode * world_size
+                print(f'\rEpisode: {episode} | best time {best.item()} | Mean Reward: {stats[0]:.2f} | Nodes placed: {stats[1]:.2f} | Time elpased: {end - start:.2f}s', end='')
+                if not args.quiet:
+                    writer.add_scalar('Mean reward/episode', stats[0].item(), episode)
+                    writer.add_scalar('No. of nodes placed', stats[1].item(), episode)
+                    writer.add_scalar('Best graph ready time', best.item(), episode)
+                    writer.flush()
+                    torch.save(ppo.policy.state_dict(), 'model_epoch.pth')
+
+    # Best mapping over all ranks, saved when training on the single --input graph. The tensors of these last
+    # collectives stay referenced until the process group is destroyed: a gloo worker thread releases its
+    # work after the collective completes, and freeing a tensor created in python from there needs the GIL,
+    # which destroy_process_group holds while it joins the worker threads.
+    result = torch.tensor([best_ready_time, best_reward], dtype=torch.float64)
+    results = [torch.empty_like(result) for _ in range(world_size)]
+    dist.all_gather(results, result)
+    best_rank = int(torch.stack(results)[:, 0].argmin())  # Lowest rank on ties
+    best_ready_time, best_reward = results[best_rank].tolist()
+    placement = torch.full((args.nodes, 3), -1, dtype=torch.int64)  # tile, spoke, ready time of every node
+    if rank == best_rank and best_placed_nodes is not None:
+        for node, info in best_placed_nodes.items():
+            placement[node] = torch.tensor([*info['tile_slice'], info['ready_time']])
+    best_placed_nodes = None
+    if best_ready_time < float('inf'):
+        best_ready_time = int(best_ready_time)
+        if not args.graphs:
+            dist.broadcast(placement, best_rank)
+            best_placed_nodes = {node: {'tile_slice': (tile, spoke), 'ready_time': ready_time}
+                                 for node, (tile, spoke, ready_time) in enumerate(placement.tolist())}
+        if is_main:
+            print(f'\nBest graph ready time: {best_ready_time}')
+    if is_main and not args.quiet and best_placed_nodes is not None:
+        suffix = os.path.basename(args.input)
+        output_json(best_placed_nodes,
+                    no_of_tiles=args.device_topology[0],
+                    spoke_count=args.device_topology[1],
+                    out_file_name=f'mappings/mapping_{suffix}')
+    dist.barrier()  # No rank closes its connections while another is still in a collective
+    dist.destroy_process_group()
+    return best_ready_time, best_reward
+
+if __name__ == "__main__":
+    args = get_args()  # Holds all the input arguments
+    if 'RANK' in os.environ:  # Launched by torchrun, one process per rank on every node
+        run_worker(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), args)
+    else:
+        os.environ.setdefault('MASTER_ADDR', 'localhost')
+        os.environ.setdefault('MASTER_PORT', '29500')
+        mp.spawn(run_worker, args=(args.world_size, args), nprocs=args.world_size)
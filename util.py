@@ -202,3 +202,66 @@ def initial_fill(num_nodes, grid_shape, manual = None):
 
 
 
+# get a node placement given mask
+def get_masked_rand(mask, device):
+    tile_idx = random.choice(np.flatnonzero(mask[:device['action_dim']]))
+    return tile_idx
+
+# generate node placement random in sequence
+def get_nodes_rand(init_nodes, args, env, graphdef, device, reward_buf, snapshots=None, snapshot_stride=1):
+    '''
+    snapshots: if given, env.snapshot() is saved in it every snapshot_stride placed nodes, keyed by depth
+    return: graph ready time and nodes placed [(node_id, tile_slice_idx)], (100, []) if a node can't be placed
+    '''
+    place_nodes = []
+    #init_nodes: nodes already placed (node_id, tile_slice_idx)
+    for s in init_nodes:
+        tile, spoke = np.unravel_index(s[1], args.device_topology)
+        action = [s[0], tile, spoke]
+        state, reward, done, mdata = env.step(action)
+        if mdata['dead_end']:
+            return 100, []
+        place_nodes.append((s[0], s[1]))
+        _save_snapshot(env, snapshots, snapshot_stride)
+
+    for node_id in env.plan.topo_order.tolist():
+        if node_id in env.placed_nodes:  # init_nodes or restored from a snapshot
+            continue
+        mask = env.get_mask(node_id)
+        if np.all(mask == 0):
+            return 100, []
+        tile_slice_idx = get_masked_rand(mask, device)
+        tile, spoke = np.unravel_index(tile_slice_idx, args.device_topology)
+        action = [node_id, tile, spoke]
+        state, reward, done, mdata = env.step(action)
+        reward_buf.append(reward)
+        if mdata['dead_end']:  # Some node can't be placed anymore
+            return 100, []
+        place_nodes.append((node_id, tile_slice_idx))
+        _save_snapshot(env, snapshots, snapshot_stride)
+
+    return env.graph_ready_time, place_nodes
+
+def _save_snapshot(env, snapshots, snapshot_stride):
+    depth = len(env.placed_nodes)
+    if snapshots is not None and depth % snapshot_stride == 0:
+        snapshots[depth] = env.snapshot()
+
+# place nodes in sequence at given tile slices, used to score ES candidates
+def play_placement(env, actions, args):
+    '''
+    actions: list of (node_id, tile_slice_idx)
+    return: graph ready time and mean reward, (100, -10) if a node can't be placed
+    '''
+    env.reset()
+    ready_buf, reward_buf = [], []
+    for node_id, tile_slice_idx in actions:
+        if not env.get_mask(node_id)[tile_slice_idx]:
+            return 100, -10
+        tile, spoke = np.unravel_index(tile_slice_idx, args.device_topology)
+        state, reward, done, mdata = env.step([node_id, tile, spoke])
+        if mdata['dead_end']:
+            return 100, -10
+        ready_buf.append(mdata['ready_time'])
+        reward_buf.append(reward)
+    return np.max(ready_buf), np.mean(reward_buf)